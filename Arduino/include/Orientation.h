@@ -9,6 +9,9 @@
 #ifndef ORIENTATION_H 
 #define ORIENTATION_H
 
+#include <stdint.h>
+#include <stddef.h>
+
 // Intervals are in ms
 
 // Watchdog timer
@@ -25,11 +28,48 @@
 #define READY_MESSAGE             "Ready"
 #define CONFIRMATION_MESSAGE      "Confirmation"
 #define CONNECTED_MESSAGE         "Connected"
+// "Config <rate> <stable samples> <x> <y> <z>": new configuration while
+// running (text link, FRAME_CONFIG on a binary link)
+#define CONFIG_MESSAGE            "Config"
 #define READY_MESSAGE_INTERVAL    300
 #define CHECK_CONNECTION_INTERVAL 1000
 
 #define COMMAND_START             "<"
 #define COMMAND_END               ">"
+// Longest text message received ("Config ..."), longer lines are cut
+#define LINE_MAX_LENGTH           64
+
+// Binary framing (see framing.py) ---------------------------------------------
+
+// Frame: SYNC | VERSION | TYPE | SEQ | LEN | PAYLOAD | CRC16 (little endian)
+// CRC16-CCITT (initial value 0xFFFF) of VERSION to the end of PAYLOAD.
+// Agreed on during the handshake: "Ready BIN1" / "Confirmation BIN1 <baud>"
+#define BINARY_TOKEN              "BIN1"
+#define FRAME_SYNC                0xA5
+#define FRAME_VERSION             1
+#define FRAME_HEADER_SIZE         4     // VERSION, TYPE, SEQ, LEN
+#define FRAME_MAX_PAYLOAD         64
+
+#define FRAME_ORIENTATION         0x01  // Arduino -> PC, 1 byte orientation
+#define FRAME_CONFIG              0x02  // PC -> Arduino, CONFIG_PAYLOAD_SIZE
+                                        // (handshake and while running)
+#define FRAME_HEARTBEAT           0x03  // PC -> Arduino, "Connected"
+#define FRAME_SAMPLE              0x04  // Arduino -> PC, float x, y, z
+#define FRAME_MOTION              0x05  // Arduino -> PC, float x, y, z,
+                                        // gx, gy, gz (gyroscope)
+
+// uint16 sampling rate, uint16 stable samples, float x, y and z thresholds
+#define CONFIG_PAYLOAD_SIZE       16
+
+// Host classification (see classifier.py) -------------------------------------
+
+// "Ready ... RAW" / "Confirmation ... RAW": stream raw acceleration samples
+// every sampling_rate_ms instead of orientations
+#define RAW_TOKEN                 "RAW"
+// "Ready ... GYRO" / "Confirmation ... RAW GYRO": add the angular rate in
+// degrees per second to every raw sample (predictive rotation, see
+// prediction.py)
+#define GYRO_TOKEN                "GYRO"
 
 // Default configuration values for reference ----------------------------------
 
@@ -70,26 +110,70 @@ struct Configuration {
     Configuration();
     Configuration(int num_sam, int sam_rate, 
                   float x_thr, float y_thr, float z_thr);
+    Configuration(const uint8_t* payload);
     void displayConfig();
 };
 
+class FrameParser {
+    enum State { WAIT_SYNC, HEADER, PAYLOAD, CRC_LOW, CRC_HIGH };
+    State state = WAIT_SYNC;
+    uint8_t header[FRAME_HEADER_SIZE];
+    uint8_t index = 0;
+    uint16_t crc = 0;
+
+  public:
+    uint8_t type = 0;
+    uint8_t length = 0;
+    uint8_t payload[FRAME_MAX_PAYLOAD];
+    // returns true when byte completes a valid frame
+    bool feed(uint8_t byte);
+};
+
+class LineParser {
+    uint8_t length = 0;
+
+  public:
+    char line[LINE_MAX_LENGTH + 1];
+    // returns true when byte ends a line (line has no "\r\n")
+    bool feed(uint8_t byte);
+};
+
 class IMUData {
     float x = 0, y = 0, z = 0;
+    float gx = 0, gy = 0, gz = 0;
+    // rolling stable-sample window: orientation of the last samples and how
+    // many samples in a row gave it after the first one
+    Orientation candidate = START_ORIENTATION;
+    int stable_samples = 0;
     void setAcceleration(float x_, float y_, float z_);
     Orientation getOrientation(Orientation old_orientation, 
                                Configuration config) const;
     void readAcceleration();
+    void readGyroscope();
 
   public:
-    Orientation orientation(Orientation old_orientation, Configuration config);
+    bool detect(Orientation& orientation, const Configuration& config);
     void sendOrientation(Orientation orientation) const;
+    void sendOrientationFrame(Orientation orientation) const;
+    void sendAcceleration();
     void displayAcceleration() const;
+    void displayMotion() const;
 };
 
 
+// true if binary framing was agreed on during the handshake
+extern bool binary_link;
+// true if the PC classifies raw acceleration samples
+extern bool raw_samples;
+// true if the raw samples include the angular rate
+extern bool gyro_samples;
+
+uint16_t crc16(const uint8_t* data, size_t length, uint16_t crc = 0xFFFF);
+void sendFrame(uint8_t type, const uint8_t* payload, uint8_t length);
+
 void establishContact();
 Configuration getConfigParams();
 
-void checkConnection();
+void checkConnection(Configuration& config);
 
 #endif
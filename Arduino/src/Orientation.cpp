@@ -9,6 +9,10 @@
 #include <Arduino_LSM6DS3.h>
 #include <Adafruit_SleepyDog.h>
 
+bool binary_link = false;
+bool raw_samples = false;
+bool gyro_samples = false;
+
 void IMUData::setAcceleration(float x_, float y_, float z_) {
     x = x_;
     y = y_;
@@ -23,6 +27,11 @@ void IMUData::readAcceleration() {
     }
 }
 
+void IMUData::readGyroscope() {
+    if (IMU.gyroscopeAvailable())
+        IMU.readGyroscope(gx, gy, gz);
+}
+
 
 Orientation IMUData::getOrientation(Orientation old_orientation, 
                                     Configuration config) const {
@@ -38,19 +47,23 @@ Orientation IMUData::getOrientation(Orientation old_orientation,
     return old_orientation;
 }
 
-Orientation IMUData::orientation(Orientation old_orientation, 
-                                 Configuration config) {
+// Reads one sample, returns true if orientation changed: the last
+// number_stable_samples + 1 samples all gave the new one. Never waits, loop()
+// calls it every sampling_rate_ms.
+bool IMUData::detect(Orientation& orientation, const Configuration& config) {
     readAcceleration();
-    Orientation new_orientation = getOrientation(old_orientation, config);
-    delay(config.sampling_rate_ms);
-
-    for (int i = 0; i < config.number_stable_samples; i++) {
-        readAcceleration();
-        if (new_orientation != getOrientation(old_orientation, config))
-            return old_orientation;
-        delay(config.sampling_rate_ms);
+    Orientation new_orientation = getOrientation(orientation, config);
+    if (new_orientation != candidate) {
+        candidate = new_orientation;
+        stable_samples = 0;
+    } else if (stable_samples < config.number_stable_samples) {
+        stable_samples++;
     }
-    return new_orientation;
+    if (candidate == orientation
+        || stable_samples < config.number_stable_samples)
+        return false;
+    orientation = candidate;
+    return true;
 }
 
 
@@ -65,6 +78,29 @@ void IMUData::sendOrientation(Orientation orientation) const {
     }
 }
 
+void IMUData::sendOrientationFrame(Orientation orientation) const {
+    uint8_t payload = orientation;
+    sendFrame(FRAME_ORIENTATION, &payload, 1);
+}
+
+void IMUData::sendAcceleration() {
+    readAcceleration();
+    if (gyro_samples) {
+        readGyroscope();
+        if (binary_link) {
+            float payload[6] = { x, y, z, gx, gy, gz };
+            sendFrame(FRAME_MOTION, (const uint8_t*)payload, sizeof(payload));
+        } else {
+            displayMotion();
+        }
+    } else if (binary_link) {
+        float payload[3] = { x, y, z };
+        sendFrame(FRAME_SAMPLE, (const uint8_t*)payload, sizeof(payload));
+    } else {
+        displayAcceleration();
+    }
+}
+
 void IMUData::displayAcceleration() const {
     Serial.print(x);
     Serial.print('\t');
@@ -73,6 +109,20 @@ void IMUData::displayAcceleration() const {
     Serial.println(z);
 }
 
+void IMUData::displayMotion() const {
+    Serial.print(x);
+    Serial.print('\t');
+    Serial.print(y);
+    Serial.print('\t');
+    Serial.print(z);
+    Serial.print('\t');
+    Serial.print(gx);
+    Serial.print('\t');
+    Serial.print(gy);
+    Serial.print('\t');
+    Serial.println(gz);
+}
+
 Configuration::Configuration() {
 
     sampling_rate_ms        = SAMPLING_RATE_MS;                            
@@ -94,6 +144,18 @@ Configuration::Configuration(int sam_rate, int num_sam,
     z_threshold             = z_thr;
 }
 
+Configuration::Configuration(const uint8_t* payload) {
+
+    uint16_t sam_rate, num_sam;
+    memcpy(&sam_rate,    payload,      2);
+    memcpy(&num_sam,     payload + 2,  2);
+    memcpy(&x_threshold, payload + 4,  4);
+    memcpy(&y_threshold, payload + 8,  4);
+    memcpy(&z_threshold, payload + 12, 4);
+    sampling_rate_ms        = sam_rate;
+    number_stable_samples   = num_sam;
+}
+
 void Configuration::displayConfig() {
     Serial.println("Current configuration parameters:"); 
 
@@ -125,14 +187,108 @@ void Configuration::displayConfig() {
 
 }
 
+uint16_t crc16(const uint8_t* data, size_t length, uint16_t crc) {
+    for (size_t i = 0; i < length; i++) {
+        crc ^= (uint16_t)data[i] << 8;
+        for (int bit = 0; bit < 8; bit++)
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+    return crc;
+}
+
+void sendFrame(uint8_t type, const uint8_t* payload, uint8_t length) {
+    static uint8_t seq = 0;
+    uint8_t header[FRAME_HEADER_SIZE] = { FRAME_VERSION, type, seq++, length };
+    uint16_t crc = crc16(payload, length, crc16(header, FRAME_HEADER_SIZE));
+    Serial.write(FRAME_SYNC);
+    Serial.write(header, FRAME_HEADER_SIZE);
+    Serial.write(payload, length);
+    Serial.write(crc & 0xFF);
+    Serial.write(crc >> 8);
+}
+
+bool FrameParser::feed(uint8_t byte) {
+    switch (state) {
+        case WAIT_SYNC:
+            if (byte == FRAME_SYNC) {
+                state = HEADER;
+                index = 0;
+            }
+            return false;
+        case HEADER:
+            header[index++] = byte;
+            if (index == FRAME_HEADER_SIZE) {
+                type   = header[1];
+                length = header[3];
+                index  = 0;
+                if (header[0] != FRAME_VERSION || length > FRAME_MAX_PAYLOAD)
+                    state = WAIT_SYNC;
+                else
+                    state = length ? PAYLOAD : CRC_LOW;
+            }
+            return false;
+        case PAYLOAD:
+            payload[index++] = byte;
+            if (index == length) state = CRC_LOW;
+            return false;
+        case CRC_LOW:
+            crc = byte;
+            state = CRC_HIGH;
+            return false;
+        case CRC_HIGH:
+            crc |= (uint16_t)byte << 8;
+            state = WAIT_SYNC;
+            return crc == crc16(payload, length,
+                                crc16(header, FRAME_HEADER_SIZE));
+    }
+    return false;
+}
+
+bool LineParser::feed(uint8_t byte) {
+    if (byte == '\n') {
+        line[length] = '\0';
+        length = 0;
+        return true;
+    }
+    if (byte != '\r' && length < LINE_MAX_LENGTH)
+        line[length++] = byte;
+    return false;
+}
+
 void establishContact() {
-  while (Serial.readStringUntil('\n') != CONFIRMATION_MESSAGE) {
-    Serial.println(READY_MESSAGE);
+  String confirmation;
+  // Advertise binary framing, older scripts only look for READY_MESSAGE
+  while (!(confirmation = Serial.readStringUntil('\n'))
+          .startsWith(CONFIRMATION_MESSAGE)) {
+    Serial.println(READY_MESSAGE " " BINARY_TOKEN " " RAW_TOKEN " "
+                   GYRO_TOKEN);
     delay(READY_MESSAGE_INTERVAL);
   }
+  raw_samples = confirmation.indexOf(RAW_TOKEN) >= 0;
+  gyro_samples = raw_samples && confirmation.indexOf(GYRO_TOKEN) >= 0;
+  // "Confirmation BIN1 <baud rate>" if the PC agreed on binary framing
+  int token = confirmation.indexOf(BINARY_TOKEN);
+  binary_link = token >= 0;
+  if (binary_link) {
+    long baud_rate = confirmation.substring(token + strlen(BINARY_TOKEN))
+                                 .toInt();
+    if (baud_rate > 0) {
+      Serial.flush();
+      Serial.begin(baud_rate);
+    }
+  }
 }
 
 Configuration getConfigParams() {
+    if (binary_link) {
+        FrameParser parser;
+        while (true) {
+            while(!Serial.available()){}
+            if (parser.feed(Serial.read()) && parser.type == FRAME_CONFIG
+                && parser.length == CONFIG_PAYLOAD_SIZE)
+                return Configuration(parser.payload);
+        }
+    }
     while(!Serial.available()){}
     int sam_rate = Serial.parseInt();                         
     int num_sam  = Serial.parseInt();
@@ -143,7 +299,48 @@ Configuration getConfigParams() {
                          x_thr, y_thr, z_thr);
 }
 
-void checkConnection() {
-     if(Serial.readStringUntil('\n') == CONNECTED_MESSAGE)
-         Watchdog.reset();
+static bool parseConfigMessage(const String& message, Configuration& config) {
+    // "Config <rate> <stable samples> <x> <y> <z>", config is only changed
+    // if the 5 values are there
+    float values[5];
+    int start = strlen(CONFIG_MESSAGE);
+    for (int i = 0; i < 5; i++) {
+        while (message.charAt(start) == ' ') start++;
+        int end = message.indexOf(' ', start);
+        if (end < 0) end = message.length();
+        if (end == start) return false;
+        values[i] = message.substring(start, end).toFloat();
+        start = end;
+    }
+    config = Configuration((int)values[0], (int)values[1],
+                           values[2], values[3], values[4]);
+    return true;
+}
+
+// Heartbeats reset the watchdog, new configurations apply to the next sample.
+// Only reads the bytes already received, complete frames or lines are
+// handled as they arrive.
+void checkConnection(Configuration& config) {
+    if (binary_link) {
+        static FrameParser parser;
+        while (Serial.available()) {
+            if (!parser.feed(Serial.read())) continue;
+            if (parser.type == FRAME_HEARTBEAT)
+                Watchdog.reset();
+            else if (parser.type == FRAME_CONFIG
+                     && parser.length == CONFIG_PAYLOAD_SIZE)
+                config = Configuration(parser.payload);
+        }
+        return;
+    }
+    static LineParser parser;
+    while (Serial.available()) {
+        if (!parser.feed(Serial.read())) continue;
+        String message = parser.line;
+        message.trim();
+        if (message == CONNECTED_MESSAGE)
+            Watchdog.reset();
+        else if (message.startsWith(CONFIG_MESSAGE))
+            parseConfigMessage(message, config);
+    }
 }
@@ -28,10 +28,9 @@
 // ### SETUP ###################################################################
 
 IMUData data;
-Orientation old_orientation = START_ORIENTATION;
-Orientation orientation = old_orientation;
+Orientation orientation = START_ORIENTATION;
 Configuration config;
-unsigned long previous_millis = 0;
+unsigned long previous_sample_millis = 0;
 
 void setup() {
 
@@ -61,8 +60,8 @@ void setup() {
   }
   // Indicate that data is ready to be received
 
-  //  Read and store configuration variables
-  old_orientation = data.orientation(old_orientation, config);
+  // The first orientation is reported by loop() once it is stable
+  previous_sample_millis = millis();
 }
 
 void blink() {
@@ -73,20 +72,34 @@ void blink() {
 
 // ### LOOP ####################################################################
 
+// Nothing in loop() waits: every pass handles the bytes received, and takes a
+// sample when config.sampling_rate_ms elapsed. A new orientation is reported
+// at most (number_stable_samples + 1) * sampling_rate_ms after the sensor
+// reached it.
 void loop() {
 
+  checkConnection(config);
+
   unsigned long current_millis = millis();
-  if (current_millis - previous_millis >= CHECK_CONNECTION_INTERVAL) {
-    checkConnection();
-    previous_millis = current_millis;
+  if (current_millis - previous_sample_millis
+      < (unsigned long)config.sampling_rate_ms)
+    return;
+  previous_sample_millis = current_millis;
+
+  // The PC detects the orientation from the raw samples
+  if (raw_samples) {
+    data.sendAcceleration();
+    return;
   }
 
-  orientation = data.orientation(old_orientation, config);
-  if(orientation != old_orientation) {
-    Serial.print(COMMAND_START);
-    data.sendOrientation(orientation);
-    Serial.println(COMMAND_END);
-    old_orientation = orientation;
+  if (data.detect(orientation, config)) {
+    if (binary_link) {
+      data.sendOrientationFrame(orientation);
+    } else {
+      Serial.print(COMMAND_START);
+      data.sendOrientation(orientation);
+      Serial.println(COMMAND_END);
+    }
     // blink(); // for debugging
   }
   // data.displayAcceleration();
@@ -0,0 +1,496 @@
+#  Asyncio engine of the serial link
+#  async_engine.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Serves the Arduino (or every Arduino of the [DEVICES] section) once
+#  main() found it, with tasks of a single event loop:
+#  - the transport of a device is the only owner of its serial port. On POSIX
+#    it is registered with loop.add_reader(). pySerial has nothing to wait on
+#    elsewhere (Windows): there, each device keeps one thread of the serial
+#    executor blocked on read(), a thread per device that only waits. The
+#    serial executor is not the default one, so the reads never hold up the
+#    display changes and the port enumerations.
+#  - the reconnect task of a device owns its link state (Ready/Confirmation
+#    handshake, port attach/detach events, reconnection).
+#  - the heartbeat task of a device sends "Connected" every
+#    CHECK_CONNECTION_INTERVAL.
+#  - the display task of a device applies the latest <CMD> received on its
+#    monitor.
+#  - the port task hands the port attach/detach events, the configuration
+#    changes (config_watch.py) and the mode switches of the control socket
+#    (control.py) to every device.
+#  Tasks only exchange messages through queues, in the order they arrived.
+#  Nothing that enumerates the ports (port watcher, USB serial numbers) runs
+#  on the event loop: it is done in the default executor, and the serial
+#  numbers are kept until their port is attached or detached again.
+
+### IMPORTS ####################################################################
+
+import os
+import time
+import asyncio
+import concurrent.futures
+
+import metrics
+from protocol import (
+    READY_MESSAGE, READY_MESSAGE_INTERVAL, CHECK_CONNECTION_INTERVAL,
+    LineSplitter, LinkMode, isCommand, commandName, confirmReady, isStaleReady,
+    sendConnected
+)
+from port_watch import (
+    PortEvent, PORT_ATTACHED, PORT_DETACHED, createPortWatcher
+)
+from config_watch import ConfigChange
+from framing import ORIENTATION_INDEX
+from display_backend import DisplayStager, printApplied
+
+### Global Constants ###########################################################
+
+# control message put by the transport when the serial port fails
+LINK_LOST                       = "Link lost"
+
+### Classes ####################################################################
+
+class ThreadsafeNotify:
+    # Lets the port watcher thread put events in an asyncio queue
+    def __init__(self, loop, queue):
+        self.loop   = loop
+        self.queue  = queue
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+class DeviceLink:
+    # Link state of one Arduino.
+    # binding:  USB serial number or port (lower case) of the Arduino, None
+    #           for any Arduino port
+    # monitor:  monitor rotated by this Arduino, None for data.monitor
+    # index:    device number of the records of engine.recorder
+    def __init__(self, engine, data, binding=None, monitor=None, port=None,
+                 link_mode=LinkMode(), index=0):
+        self.engine                 = engine
+        self.binding                = binding
+        self.index                  = index
+        self.monitor                = monitor
+        self.data                   = (data if monitor is None
+                                       else data.forMonitor(monitor))
+        self.port                   = port
+        self.ser                    = None
+        self.link_mode              = link_mode
+        # predictions are staged with the requests of the display task
+        self.stager                 = DisplayStager(
+            engine.backend,
+            lambda orientation: engine.orientation_request(orientation,
+                                                           self.data),
+            engine.rotation_control)
+        self.classifier             = self.data.createClassifier(link_mode,
+                                                                 self.stager)
+        self.applied                = 0
+        self.dropped_stale          = 0
+        self.dropped_repeat         = 0
+        self.last_orientation       = None
+        self._splitter              = LineSplitter()
+        self._read_task             = None
+        # by binding with [DEVICES]
+        labels = {"device": binding} if binding is not None else {}
+        self.latency            = metrics.histogram(
+            "dispatch_latency_seconds", **labels)
+        self.disconnects        = metrics.counter("disconnects_total", **labels)
+        self.reconnects         = metrics.counter("reconnects_total", **labels)
+        self.ready_messages     = metrics.counter("ready_messages_total",
+                                                  **labels)
+        self.heartbeats_sent    = metrics.counter("heartbeats_sent_total",
+                                                  **labels)
+        self.heartbeat_errors   = metrics.counter("heartbeat_errors_total",
+                                                  **labels)
+        self.serial_bytes       = metrics.counter("serial_bytes_total",
+                                                  **labels)
+        self.serial_lines       = metrics.counter("serial_lines_total",
+                                                  **labels)
+        self.serial_read_errors = metrics.counter("serial_read_errors_total",
+                                                  **labels)
+        self.commands_discarded = metrics.counter("commands_discarded_total",
+                                                  **labels)
+        splitter = self._splitter
+        metrics.gauge("serial_crc_errors", lambda: splitter.crc_errors,
+                      **labels)
+        metrics.gauge("serial_lost_frames", lambda: splitter.lost_frames,
+                      **labels)
+        metrics.gauge("rotations_applied", lambda: self.applied, **labels)
+        metrics.gauge("rotations_dropped_stale", lambda: self.dropped_stale,
+                      **labels)
+        metrics.gauge("rotations_dropped_repeat", lambda: self.dropped_repeat,
+                      **labels)
+
+    def name(self):
+        return self.port if self.port is not None else str(self.binding)
+
+    async def run(self, ser=None):
+        self.commands   = asyncio.Queue()
+        self.control    = asyncio.Queue()
+        self.configured = asyncio.Event()
+        if ser is not None:
+            # main() sent the configuration before starting the engine
+            self.configured.set()
+            self.attach(ser)
+        await asyncio.gather(self.reconnectTask(), self.heartbeatTask(),
+                             self.displayTask())
+
+    async def matches(self, port):
+        # True if the Arduino on port is the one bound to this device
+        if self.binding is None:
+            return True
+        if self.binding == port.lower():
+            return True
+        serial_number = await self.engine.serialNumber(port)
+        return self.binding == str(serial_number).lower()
+
+    ### Transport ##############################################################
+
+    def attach(self, ser):
+        loop = self.engine.loop
+        self.ser = ser
+        self._splitter.reset()
+        if os.name == "posix" and hasattr(ser, "fileno"):
+            ser.timeout = 0
+            loop.add_reader(ser.fileno(), self._onReadable, ser)
+        else:
+            ser.timeout = None
+            self._read_task = loop.create_task(self._readInExecutor(ser))
+
+    def detach(self):
+        ser, self.ser = self.ser, None
+        if ser is None:
+            return
+        if self._read_task is not None:
+            self._read_task = None
+            try:
+                ser.cancel_read()
+            except Exception:
+                pass
+        else:
+            try:
+                self.engine.loop.remove_reader(ser.fileno())
+            except Exception:
+                pass
+        try:
+            ser.close()
+        except Exception:
+            pass
+
+    def sendConnected(self):
+        try:
+            sendConnected(self.ser, self.link_mode)
+            self.heartbeats_sent.inc()
+        # to avoid an error when Arduino is unplugged
+        except Exception:
+            self.heartbeat_errors.inc()
+
+    def _onReadable(self, ser):
+        try:
+            chunk = ser.read(ser.in_waiting or 1)
+        except Exception:
+            self._lost(ser)
+            return
+        self._feed(chunk)
+
+    async def _readInExecutor(self, ser):
+        while self.ser is ser:
+            try:
+                chunk = await self.engine.loop.run_in_executor(
+                    self.engine.serialExecutor(), self._blockingRead, ser)
+            except Exception:
+                self._lost(ser)
+                return
+            if self.ser is ser:
+                self._feed(chunk)
+
+    @staticmethod
+    def _blockingRead(ser):
+        return ser.read(ser.in_waiting or 1)
+
+    def _lost(self, ser):
+        self.serial_read_errors.inc()
+        if self.ser is ser:
+            self.detach()
+            self.control.put_nowait(LINK_LOST)
+
+    def _feed(self, chunk):
+        recorder = self.engine.recorder
+        self.serial_bytes.inc(len(chunk))
+        if recorder is not None:
+            recorder.recordRaw(chunk, self.index)
+        for line, arrival in self._splitter.feed(chunk, time.perf_counter()):
+            self.serial_lines.inc()
+            if isCommand(line):
+                if recorder is not None:
+                    recorder.recordOrientation(commandName(line),
+                                               device=self.index)
+                # Commands received during a (re)connection are not valid yet
+                if self.configured.is_set():
+                    self.commands.put_nowait((line, arrival))
+                else:
+                    self.commands_discarded.inc()
+            else:
+                self.control.put_nowait(line)
+        samples, arrival = self._splitter.takeSamples()
+        rates = self._splitter.takeRates()
+        if samples and recorder is not None:
+            recorder.recordSamples(samples, self.index, rates)
+        if samples and self.classifier is not None \
+                and self.configured.is_set():
+            for orientation in self.classifier.feedBytes(samples, rates):
+                if recorder is not None:
+                    recorder.recordDecision(orientation, self.index)
+                self.commands.put_nowait((ORIENTATION_INDEX[orientation],
+                                          arrival))
+
+    ### Tasks ##################################################################
+
+    async def reconnectTask(self):
+        engine = self.engine
+        attach_time = None
+        if self.ser is None:
+            await self._reconnect()
+        while True:
+            if self.ser is None:
+                # retry every CHECK_CONNECTION_INTERVAL while disconnected
+                try:
+                    message = await asyncio.wait_for(
+                        self.control.get(), CHECK_CONNECTION_INTERVAL)
+                except asyncio.TimeoutError:
+                    message = None
+            else:
+                message = await self.control.get()
+
+            if isinstance(message, PortEvent):
+                if (message.kind == PORT_DETACHED and message.port == self.port
+                        and self.ser is not None):
+                    print("Arduino disconnected from " + self.port)
+                    self.disconnects.inc()
+                    self.configured.clear()
+                    self.detach()
+                    engine.watcher.detach_latency.add(
+                        time.perf_counter() - message.time)
+                    print("Disconnection detected in " + "{:.1f} ms".format(
+                        1000*engine.watcher.detach_latency.last))
+                elif message.kind == PORT_ATTACHED and self.ser is None:
+                    attach_time = message.time
+            elif isinstance(message, ConfigChange):
+                data = message.data
+                if self.monitor is not None:
+                    data = data.forMonitor(self.monitor)
+                if self.data.replaceWith(data) and self.configured.is_set():
+                    self.data.pushConfigParameters(self.ser, self.link_mode)
+                    self.classifier = self.data.createClassifier(
+                        self.link_mode, self.stager)
+            elif message == LINK_LOST:
+                print("Serial connection lost on " + self.name())
+                self.configured.clear()
+            elif (message is not None and READY_MESSAGE in message
+                    and isStaleReady(self.link_mode)):
+                pass
+            elif message is not None and READY_MESSAGE in message:
+                print("Ready message received on " + self.port)
+                self.ready_messages.inc()
+                self.configured.clear()
+                try:
+                    self.link_mode = confirmReady(
+                        self.ser, message, self.data.classification == "host",
+                        self.data.prediction == "gyro")
+                except Exception:
+                    pass
+                # self.data is kept up to date by the ConfigChange messages
+                # wait a bit for the arduino to react to the confirmation
+                # message before sending configuration parameters
+                await asyncio.sleep(READY_MESSAGE_INTERVAL)
+                if self.ser is not None:
+                    self.data.sendConfigParameters(self.ser, self.link_mode)
+                    self.classifier = self.data.createClassifier(
+                        self.link_mode, self.stager)
+                    self.configured.set()
+                    # its first orientation is compared with the monitors
+                    # as they are now
+                    self.last_orientation = None
+                    engine.backend.reconcile()
+                    if attach_time is not None:
+                        engine.watcher.attach_latency.add(
+                            time.perf_counter() - attach_time)
+                        print("Reconnected in " + "{:.1f} ms".format(
+                            1000*engine.watcher.attach_latency.last))
+                        attach_time = None
+
+            if self.ser is None and not isinstance(message, str):
+                await self._reconnect()
+
+    async def _reconnect(self):
+        engine = self.engine
+        ports = await engine.loop.run_in_executor(None, engine.watcher.ports)
+        for port in ports:
+            if not(engine.isFree(port)) or not(await self.matches(port)):
+                continue
+            print("Attempting serial connection to " + port + "...")
+            try:
+                ser = await engine.loop.run_in_executor(None, engine.connect,
+                                                        port)
+            except IOError:
+                print("Connection failed on " + port + "\n")
+                continue
+            # another device may have taken the port in the meantime
+            if not(engine.isFree(port)):
+                ser.close()
+                continue
+            self.port = port
+            self.reconnects.inc()
+            self.attach(ser)
+            return
+
+    async def heartbeatTask(self):
+        # Sending "Connected" message to Arduino to reset watchdog timer
+        while True:
+            await asyncio.sleep(CHECK_CONNECTION_INTERVAL)
+            if self.ser is not None and self.configured.is_set():
+                self.sendConnected()
+
+    async def displayTask(self):
+        engine = self.engine
+        while True:
+            orientation, arrival = await self.commands.get()
+            # only apply the latest orientation
+            while not self.commands.empty():
+                orientation, arrival = self.commands.get_nowait()
+                self.dropped_stale += 1
+            self.latency.add(time.perf_counter() - arrival)
+            print(self.name() + ": " + commandName(orientation)
+                  + " (dispatch latency: " + str(self.latency) + ")")
+            if orientation == self.last_orientation:
+                self.dropped_repeat += 1
+                continue
+            # held while the rotation is paused, repeats are dropped all
+            # the same
+            self.last_orientation = orientation
+            if (engine.rotation_control is not None and not(
+                    engine.rotation_control.allows(commandName(orientation),
+                                                   self.data.monitor))):
+                continue
+            request = engine.orientation_request(orientation, self.data)
+            if request is not None:
+                await engine.loop.run_in_executor(None, engine.backend.apply,
+                                                  request)
+                printApplied(request)
+            self.applied += 1
+            print("Rotation commands applied: " + str(self.applied)
+                  + ", dropped (stale): " + str(self.dropped_stale)
+                  + ", dropped (repeat): " + str(self.dropped_repeat))
+
+class AsyncEngine:
+    # data:                 ConfigurationData, already sent to the Arduino
+    # port, ser:            serial connection returned by data.initSerial(),
+    #                       None with bindings
+    # link_mode:            LinkMode agreed on during the handshake
+    # backend:              DisplayBackend
+    # list_ports:           returns the list of Arduino ports
+    # connect:              opens a serial port (connectToPort)
+    # orientation_request:  orientation index -> DisplayRequest or None
+    # port_watcher:         creates the PortWatcher (createPortWatcher)
+    # bindings:             {USB serial number or port: monitor} of several
+    #                       Arduinos (data.devices), each one connected and
+    #                       configured by the engine
+    # serial_number:        port -> USB serial number or None
+    # config_watcher:       ConfigWatcher started with the engine, None for
+    #                       no reload
+    # rotation_control:     RotationControl of the control socket, or None
+    # recorder:             Recorder of the serial streams (recorder.py), or
+    #                       None. Devices are recorded in the order of bindings.
+    def __init__(self, data, config_filename, port, ser, link_mode, backend,
+                 list_ports, connect, orientation_request,
+                 port_watcher=createPortWatcher, bindings=None,
+                 serial_number=lambda port: None, config_watcher=None,
+                 rotation_control=None, recorder=None):
+        self.data                   = data
+        self.config_filename        = config_filename
+        self.backend                = backend
+        self.list_ports             = list_ports
+        self.connect                = connect
+        self.orientation_request    = orientation_request
+        self.port_watcher           = port_watcher
+        self.serial_number          = serial_number
+        self.config_watcher         = config_watcher
+        self.rotation_control       = rotation_control
+        self.recorder               = recorder
+        self._initial_ser           = ser
+        # {port: USB serial number}, until the port is attached or detached
+        self._serial_numbers        = {}
+        self._serial_executor       = None
+        if bindings:
+            self.devices = [DeviceLink(self, data, binding.lower(), monitor,
+                                       index=index) for index, (binding,
+                            monitor) in enumerate(bindings.items())]
+        else:
+            self.devices = [DeviceLink(self, data, port=port,
+                                       link_mode=link_mode)]
+
+    async def run(self):
+        self.loop       = asyncio.get_running_loop()
+        self.control    = asyncio.Queue()
+        self.watcher    = self.port_watcher(
+            self.list_ports, ThreadsafeNotify(self.loop, self.control))
+        if self.config_watcher is not None:
+            self.config_watcher.subscribe(
+                ThreadsafeNotify(self.loop, self.control))
+            self.config_watcher.start()
+        if self.rotation_control is not None:
+            self.rotation_control.subscribe(
+                ThreadsafeNotify(self.loop, self.control))
+        tasks = [self.portTask()]
+        for device in self.devices:
+            ser = self._initial_ser if device.binding is None else None
+            tasks.append(device.run(ser))
+        await asyncio.gather(*tasks)
+
+    def serialExecutor(self):
+        # Threads of the blocking reads, one per device at most
+        if self._serial_executor is None:
+            self._serial_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.devices), thread_name_prefix="serial")
+        return self._serial_executor
+
+    async def serialNumber(self, port):
+        if port not in self._serial_numbers:
+            self._serial_numbers[port] = await self.loop.run_in_executor(
+                None, self.serial_number, port)
+        return self._serial_numbers[port]
+
+    def isFree(self, port):
+        # True if no device uses port
+        return all(device.ser is None or device.port != port
+                   for device in self.devices)
+
+    async def portTask(self):
+        # every device checks if the event is about its own port, and takes
+        # the configuration changes
+        while True:
+            event = await self.control.get()
+            if isinstance(event, PortEvent):
+                # another Arduino may be plugged in on the same port
+                self._serial_numbers.pop(event.port, None)
+            for device in self.devices:
+                device.control.put_nowait(event)
+
+### Functions ##################################################################
+
+def runEngine(*args, **kwargs):
+    asyncio.run(AsyncEngine(*args, **kwargs).run())
+
+def runDevices(data, config_filename, backend, list_ports, connect,
+               orientation_request, serial_number,
+               port_watcher=createPortWatcher, config_watcher=None,
+               rotation_control=None, recorder=None):
+    # One event loop for every Arduino of data.devices
+    runEngine(data, config_filename, None, None, LinkMode(), backend,
+              list_ports, connect, orientation_request, port_watcher,
+              data.devices, serial_number, config_watcher, rotation_control,
+              recorder)
@@ -0,0 +1,497 @@
+#  End-to-end latency benchmark with a virtual Arduino (POSIX only)
+#  benchmark.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Runs the serial link of rotate_screen.py against virtual_device.py and a
+#  FakeDisplayBackend:
+#  - replays an orientation trace and measures the latency from the frame
+#    being sent by the device to the display backend being called (p50, p99)
+#  - unplugs and plugs the device and measures the reconnect time (from the
+#    plug to the configuration being received by the device)
+#  - measures the CPU used by the process while idle
+#  With --devices, the same trace is replayed on several virtual devices
+#  bound to their own monitor and served by one event loop, to check that the
+#  latency of each device doesn't grow with the number of devices.
+#  With --turn SECONDS, the orientations are physical turns of that length
+#  (raw samples with angular rates) and the latency is measured from the
+#  start of every turn, --predict adds the gyroscope prediction
+#  (prediction.py).
+#  With --configs RATExSTABLE,..., the device detects the orientations with
+#  the stable-sample window of the firmware for every SamplingRate x
+#  NumberStableSamples. Every orientation must reach the display backend
+#  within the report bound of the firmware loop
+#  (virtual_device.reportLatencyBound) plus BOUND_ALLOWANCE, or the run exits
+#  with 1.
+#  Every run is appended to a JSON results file, --compare checks the last run
+#  against the previous one with the same options.
+#  --throughput feeds synthetic high-rate streams (text and binary commands
+#  and samples) to the LineSplitter of the serial readers in chunks of every
+#  THROUGHPUT_CHUNKS size, and prints the MB/s and the lines and samples per
+#  second parsed, without a device.
+#
+#  Trace files have one "<seconds> <orientation>" pair per line, seconds being
+#  the time since the start of the trace, e.g. "0.50 Y_POS". Lines starting
+#  with # are ignored.
+#
+#  python benchmark.py [--trace FILE] [--text] [--raw] [--devices 1,2,4,8]
+#                      [--turn SECONDS [--predict]] [--configs 20x10,10x5]
+#                      [--compare]
+#  python benchmark.py --throughput
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import threading
+
+import rotate_screen
+from display_backend import DisplayRequest, FakeDisplayBackend
+from virtual_device import VirtualArduino, reportLatencyBound
+from async_engine import runEngine, runDevices
+from port_watch import PollingPortWatcher
+from framing import (
+    ORIENTATION_NAMES, ORIENTATION_INDEX, FRAME_ORIENTATION, FRAME_SAMPLE,
+    SAMPLE_PAYLOAD, encodeFrame
+)
+import protocol
+
+### Global Constants ###########################################################
+
+DIRECTORY                       = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILENAME                 = os.path.join(DIRECTORY,
+                                               rotate_screen.CONFIG_FILENAME)
+RESULTS_FILENAME                = os.path.join(DIRECTORY,
+                                               "benchmark_results.json")
+
+# Synthetic trace: every rotated orientation in turn, in seconds
+TRACE_INTERVAL                  = 0.5
+TRACE_LENGTH                    = 40
+TRACE_ORIENTATIONS              = ("X_POS", "Y_POS", "X_NEG", "Y_NEG")
+# with --turn, leaves time for the classifier after every turn
+TURN_TRACE_INTERVAL             = 1.5
+# with --configs, at least this many report bounds between two orientations
+BOUND_TRACE_FACTOR              = 2
+# Allowance over the report bound, in seconds, for what the firmware loop
+# doesn't include: the serial link and the dispatch to the display backend
+# (under 1 ms at p99, see the run without --configs), and the wakeups of the
+# thread of the virtual device, which shares the interpreter with the host
+# threads (1 to 3 ms over the bound here, up to 7 ms on a busy single core)
+BOUND_ALLOWANCE                 = 0.010
+# GIL switch interval during --configs runs, so the thread of the virtual
+# device doesn't wait for the default 5 ms to take a sample
+BOUND_SWITCH_INTERVAL           = 0.0005
+
+# Intervals in seconds
+CONNECTION_TIMEOUT              = 10
+SETTLE_TIME                     = 1
+UNPLUGGED_TIME                  = 0.5
+IDLE_TIME                       = 3
+
+# --throughput: bytes of every synthetic stream, and sizes of the chunks it is
+# fed in (what in_waiting holds for a slow and a busy reader)
+THROUGHPUT_BYTES                = 4 * 1024 * 1024
+THROUGHPUT_CHUNKS               = (64, 4096)
+
+# A run is a regression if a measure grows by more than this (0.2 = 20 %)
+REGRESSION_TOLERANCE            = 0.2
+COMPARED_MEASURES               = ("p50_ms", "p99_ms", "worst_device_p99_ms",
+                                   "reconnect_ms", "idle_cpu_percent")
+
+### Functions ##################################################################
+
+def parseConfigs(text):
+    # "20x10,10x5" -> [(20, 10), (10, 5)]
+    configs = []
+    for config in text.split(","):
+        sampling_rate, stable_samples = config.lower().split("x")
+        configs.append((int(sampling_rate), int(stable_samples)))
+    return configs
+
+def configArguments(argv, config):
+    # argv with --configs replaced by config alone
+    arguments, skip = [], False
+    for argument in argv:
+        if skip:
+            skip = False
+        elif argument == "--configs":
+            skip = True
+        elif not argument.startswith("--configs="):
+            arguments.append(argument)
+    return arguments + ["--configs", config]
+
+def syntheticTrace(interval=TRACE_INTERVAL):
+    return [(i*interval, TRACE_ORIENTATIONS[i % len(TRACE_ORIENTATIONS)])
+            for i in range(TRACE_LENGTH)]
+
+def loadTrace(filename):
+    trace = []
+    with open(filename) as file:
+        for line in file:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            offset, orientation = line.split()
+            if orientation not in ORIENTATION_NAMES:
+                raise ValueError("Unknown orientation in trace: " + orientation)
+            trace.append((float(offset), orientation))
+    return trace
+
+def throughputStream(kind):
+    # About THROUGHPUT_BYTES of the serial stream of one kind of link
+    names = ORIENTATION_NAMES
+    if kind == "text commands":
+        unit = b"".join((protocol.COMMAND_START + name + protocol.COMMAND_END
+                         + "\r\n").encode() for name in names)
+    elif kind == "text samples":
+        unit = b"".join("{:.2f}\t{:.2f}\t{:.2f}\r\n".format(
+            0.01*i, -0.98 + 0.01*i, 0.12).encode() for i in range(10))
+    elif kind == "binary commands":
+        unit = b"".join(encodeFrame(FRAME_ORIENTATION, bytes([i]))
+                        for i in range(len(names)))
+    else:
+        unit = b"".join(encodeFrame(FRAME_SAMPLE, SAMPLE_PAYLOAD.pack(
+            0.01*i, -0.98 + 0.01*i, 0.12)) for i in range(10))
+    return unit * (THROUGHPUT_BYTES // len(unit))
+
+def measureThroughput(stream, chunk_size):
+    # (MB/s, lines and samples/s) of a LineSplitter fed stream in chunks
+    splitter = protocol.LineSplitter()
+    chunks = [stream[i:i+chunk_size]
+              for i in range(0, len(stream), chunk_size)]
+    items = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        items += len(splitter.feed(chunk, start))
+        samples, _ = splitter.takeSamples()
+        items += len(samples) // SAMPLE_PAYLOAD.size
+    elapsed = time.perf_counter() - start
+    return len(stream) / elapsed / 1e6, items / elapsed
+
+def runThroughput():
+    print("{:<18}{:>8}{:>10}{:>14}".format("stream", "chunk", "MB/s",
+                                           "items/s"))
+    for kind in ("text commands", "text samples", "binary commands",
+                 "binary samples"):
+        stream = throughputStream(kind)
+        for chunk_size in THROUGHPUT_CHUNKS:
+            rate, items = measureThroughput(stream, chunk_size)
+            print("{:<18}{:>8}{:>10.2f}{:>14.0f}".format(kind, chunk_size,
+                                                          rate, items))
+
+def percentile(values, fraction):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction*len(values)), len(values) - 1)]
+
+def matchLatencies(device, backend, data):
+    # For every backend call on the monitor of data, the latest orientation
+    # sent before it that gives the same request. Coalesced orientations have
+    # no call.
+    latencies = []
+    sent = list(device.sent)
+    monitor = DisplayRequest(data.monitor).monitor
+    for call_time, request in list(backend.calls):
+        if request.monitor != monitor:
+            continue
+        for sent_time, orientation in reversed(sent):
+            if sent_time > call_time:
+                continue
+            expected = rotate_screen.orientationRequest(
+                ORIENTATION_INDEX[orientation], data)
+            if expected is not None and str(expected) == str(request):
+                latencies.append(call_time - sent_time)
+            break
+    return latencies
+
+def pollingWatcher(list_ports, notify):
+    # pseudo terminals are created in /dev/pts, which the inotify watcher
+    # doesn't watch
+    return PollingPortWatcher(list_ports, notify).start()
+
+def startLink(data, device, backend):
+    # Same steps as rotate_screen.main() on the port of the virtual device
+    list_ports = lambda: [device.port] if device.isPlugged() else []
+    is_connected, ser = rotate_screen.attemptConnection(
+        device.port, raw_samples=data.classification == "host",
+        gyro=data.prediction == "gyro")
+    if not is_connected:
+        raise IOError("No ready message from the virtual device")
+    data.sendConfigParameters(ser, rotate_screen.link_mode)
+    # no reset_output_buffer(): on a pseudo terminal flush() returns before
+    # the device read the configuration
+    ser.reset_input_buffer()
+    threading.Thread(target=runEngine, args=(
+        data, CONFIG_FILENAME, device.port, ser, rotate_screen.link_mode,
+        backend, list_ports, rotate_screen.connectToPort,
+        rotate_screen.orientationRequest, pollingWatcher),
+        daemon=True).start()
+
+def startDevices(data, devices, backend):
+    # Same as rotate_screen.main() with a [DEVICES] section binding the
+    # serial number of every virtual device to its own monitor
+    data.devices = {device.serial_number: str(i + 1)
+                    for i, device in enumerate(devices)}
+    list_ports = lambda: [device.port for device in devices
+                          if device.isPlugged()]
+    serial_number = lambda port: next((device.serial_number
+                                       for device in devices
+                                       if device.port == port), None)
+    threading.Thread(target=runDevices, args=(
+        data, CONFIG_FILENAME, backend, list_ports, rotate_screen.connectToPort,
+        rotate_screen.orientationRequest, serial_number, pollingWatcher),
+        daemon=True).start()
+
+def runBenchmark(trace, binary=True, raw_samples=False, count=0, turn=None,
+                 predict=False, config=None):
+    # count:  number of virtual devices bound in a [DEVICES] section, 0 for a
+    #         single device
+    # turn:   duration of the physical turns in seconds (raw samples with
+    #         angular rates), None to change the orientations at once
+    # config: (SamplingRate, NumberStableSamples) detected by the device,
+    #         None to report the orientations at once
+    protocol.BINARY_PROTOCOL = binary
+    raw_samples = raw_samples or turn is not None
+    data = rotate_screen.ConfigurationData(CONFIG_FILENAME)
+    data.classification = "host" if raw_samples else "firmware"
+    data.prediction = "gyro" if predict else "off"
+    bound = None
+    if config is not None:
+        data.sampling_rate, data.number_stable_samples = config
+        bound = reportLatencyBound(*config)
+    devices = [VirtualArduino(binary=binary, raw_samples=raw_samples,
+                              serial_number="VIRTUAL" + str(i),
+                              gyro=turn is not None,
+                              detection=config is not None)
+               for i in range(max(count, 1))]
+    backend = FakeDisplayBackend()
+    for device in devices:
+        device.plug()
+    if count:
+        startDevices(data, devices, backend)
+    else:
+        startLink(data, devices[0], backend)
+    for device in devices:
+        if not device.configured.wait(CONNECTION_TIMEOUT):
+            raise IOError("The virtual device was not configured")
+    device = devices[0]
+
+    # Replay, on every device at once
+    for device in devices:
+        del device.sent[:]
+    del backend.calls[:]
+    start = time.perf_counter()
+    for offset, orientation in trace:
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        for device in devices:
+            if turn is not None:
+                device.turn(orientation, turn)
+            else:
+                device.setOrientation(orientation)
+    time.sleep(SETTLE_TIME + (turn or 0))
+    if count:
+        device_latencies = [matchLatencies(device, backend,
+                                           data.forMonitor(str(i + 1)))
+                            for i, device in enumerate(devices)]
+    else:
+        device_latencies = [matchLatencies(devices[0], backend, data)]
+    latencies = [latency for values in device_latencies for latency in values]
+    device = devices[0]
+
+    # Reconnect
+    device.unplug()
+    time.sleep(UNPLUGGED_TIME)
+    plug_time = time.perf_counter()
+    device.plug()
+    if device.configured.wait(CONNECTION_TIMEOUT):
+        reconnect = device.configured_time - plug_time
+    else:
+        reconnect = None
+    time.sleep(SETTLE_TIME)
+
+    # Idle CPU (heartbeats, port watcher, raw samples)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    time.sleep(IDLE_TIME)
+    idle_cpu = ((time.process_time() - cpu_start)
+                / (time.perf_counter() - wall_start))
+    for device in devices:
+        device.unplug()
+
+    milliseconds = lambda value: None if value is None else 1000*value
+    return {
+        "time"              : datetime.datetime.now().isoformat(
+                                  timespec="seconds"),
+        "binary"            : binary,
+        "raw_samples"       : raw_samples,
+        "devices"           : count,
+        "turn_s"            : turn,
+        "prediction"        : predict,
+        "sampling_rate_ms"  : config and config[0],
+        "stable_samples"    : config and config[1],
+        # every device replays the trace
+        "events"            : len(trace) * len(devices),
+        "backend_calls"     : len(latencies),
+        "unreported"        : sum(max(len(trace) - len(values), 0)
+                                  for values in device_latencies),
+        "p50_ms"            : milliseconds(percentile(latencies, 0.50)),
+        "p99_ms"            : milliseconds(percentile(latencies, 0.99)),
+        "max_ms"            : milliseconds(max(latencies, default=None)),
+        "worst_device_p99_ms": milliseconds(max(
+            (percentile(values, 0.99) for values in device_latencies
+             if values), default=None)),
+        "bound_ms"          : milliseconds(bound),
+        "over_bound"        : None if bound is None else
+                              sum(latency > bound + BOUND_ALLOWANCE
+                                  for latency in latencies),
+        "reconnect_ms"      : milliseconds(reconnect),
+        "idle_cpu_percent"  : 100*idle_cpu
+    }
+
+def boundFailures(result):
+    # Reasons why a --configs run exceeds the report bound, empty if it
+    # doesn't
+    failures = []
+    if result["over_bound"]:
+        failures.append(str(result["over_bound"]) + " latencies over "
+                        "{:.1f} ms (max {:.1f} ms)".format(
+                            result["bound_ms"] + 1000*BOUND_ALLOWANCE,
+                            result["max_ms"]))
+    if result["unreported"]:
+        failures.append(str(result["unreported"])
+                        + " orientations never reported")
+    return failures
+
+def loadResults(filename):
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as file:
+        return json.load(file)
+
+def saveResult(filename, result):
+    results = loadResults(filename)
+    results.append(result)
+    with open(filename, "w") as file:
+        json.dump(results, file, indent=2)
+    return results
+
+def compareResults(results):
+    # Returns the list of regressions of the last run against the previous
+    # run with the same options
+    last = results[-1]
+    options = ("binary", "raw_samples", "devices", "turn_s", "prediction",
+               "sampling_rate_ms", "stable_samples")
+    previous = [r for r in results[:-1]
+                if all(r.get(key) == last.get(key) for key in options)]
+    if not previous:
+        print("No previous run to compare with")
+        return []
+    previous = previous[-1]
+    regressions = []
+    for measure in COMPARED_MEASURES:
+        old, new = previous.get(measure), last.get(measure)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0
+        print("{:<22}{:>10.2f} -> {:>10.2f} ({:+.0%})".format(
+            measure, old, new, change))
+        if change > REGRESSION_TOLERANCE:
+            regressions.append(measure)
+    return regressions
+
+def printResult(result):
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = "{:.2f}".format(value)
+        print("{:<22}{}".format(key, value))
+
+### Main function ##############################################################
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="recorded orientation trace")
+    parser.add_argument("--text", action="store_true",
+                        help="text protocol instead of binary framing")
+    parser.add_argument("--raw", action="store_true",
+                        help="raw samples classified on the host")
+    parser.add_argument("--devices",
+                        help="comma separated numbers of virtual devices "
+                             "served by one event loop, e.g. 1,2,4,8")
+    parser.add_argument("--turn", type=float, metavar="SECONDS",
+                        help="replay the orientations as physical turns of "
+                             "SECONDS (raw samples with angular rates)")
+    parser.add_argument("--predict", action="store_true",
+                        help="gyroscope prediction of the turns")
+    parser.add_argument("--configs",
+                        help="comma separated SamplingRate x "
+                             "NumberStableSamples detected by the device, "
+                             "e.g. 20x10,10x5")
+    parser.add_argument("--throughput", action="store_true",
+                        help="parsing throughput of synthetic streams")
+    parser.add_argument("--results", default=RESULTS_FILENAME)
+    parser.add_argument("--compare", action="store_true",
+                        help="exit with 1 if a measure regressed by more "
+                             "than REGRESSION_TOLERANCE")
+    args = parser.parse_args()
+
+    if args.throughput:
+        runThroughput()
+        return
+    if args.predict and args.turn is None:
+        parser.error("--predict needs --turn")
+    if args.configs and (args.raw or args.turn is not None):
+        parser.error("--configs needs the firmware classification")
+    try:
+        configs = parseConfigs(args.configs) if args.configs else [None]
+    except ValueError:
+        parser.error("--configs expects RATExSTABLE, e.g. 20x10")
+    if len(configs) > 1:
+        # the link mode of the first connection is a global of
+        # rotate_screen, so every config runs in its own process
+        status = 0
+        for config in args.configs.split(","):
+            status = max(status, subprocess.call(
+                [sys.executable] + configArguments(sys.argv, config)))
+        sys.exit(status)
+    config = configs[0]
+    interval = TURN_TRACE_INTERVAL if args.turn else TRACE_INTERVAL
+    if config is not None:
+        interval = max(interval,
+                       BOUND_TRACE_FACTOR * reportLatencyBound(*config))
+        sys.setswitchinterval(BOUND_SWITCH_INTERVAL)
+    trace = (loadTrace(args.trace) if args.trace else
+             syntheticTrace(interval))
+    counts = ([int(count) for count in args.devices.split(",")]
+              if args.devices else [0])
+    regressions, failures = [], []
+    for count in counts:
+        result = runBenchmark(trace, not(args.text), args.raw, count,
+                              args.turn, args.predict, config)
+        print()
+        printResult(result)
+        results = saveResult(args.results, result)
+        if args.compare:
+            regressions += compareResults(results)
+        if config is not None:
+            failures += boundFailures(result)
+    if regressions:
+        print("Regression: " + ", ".join(regressions))
+    if failures:
+        print("Over the report bound: " + ", ".join(failures))
+    if regressions or failures:
+        sys.exit(1)
+
+################################################################################
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,156 @@
+#  Host-side orientation detection over raw accelerometer samples
+#  classifier.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Same decisions as IMUData::detect in Orientation.cpp, computed on NumPy
+#  batches: every sample gives an orientation (the old one if no threshold is
+#  exceeded), and a new orientation is decided on the last of
+#  NumberStableSamples + 1 samples in a row that give it (rolling window).
+#  Runs are found with run lengths and searchsorted, so the Python loop only
+#  runs once per run of samples that leave the current orientation.
+#  The thresholds are rounded to float32 like on the Arduino, so decisions are
+#  bit-identical to the firmware for the float32 samples of binary framing
+#  (FRAME_SAMPLE, FRAME_MOTION). With the text protocol the firmware prints
+#  the samples with 2 decimals (Serial.print), so a sample within 0.005 G of a
+#  threshold can be decided differently than on the Arduino.
+
+### IMPORTS ####################################################################
+
+import numpy as np
+
+from framing import ORIENTATION_NAMES
+
+### Global Constants ###########################################################
+
+# Same values as enum Orientation in Orientation.h
+X_POS, X_NEG, Y_POS, Y_NEG, FLAT, START_ORIENTATION = range(6)
+NO_ORIENTATION                  = -1    # no threshold exceeded
+
+# Maximum acceleration value in Gs (X_MAX, Y_MAX, Z_MAX in Orientation.h)
+X_MAX                           = 1.00
+Y_MAX                           = 1.00
+Z_MAX                           = 1.00
+
+### Functions ##################################################################
+
+def _threshold(threshold, maximum):
+    # float threshold * double maximum, as computed by the firmware
+    return np.float64(np.float32(threshold)) * maximum
+
+def classifySamples(samples, x_threshold, y_threshold, z_threshold):
+    # IMUData::getOrientation for every row (x, y, z) of samples, with
+    # NO_ORIENTATION instead of the old orientation.
+    x = samples[:, 0].astype(np.float64)
+    y = samples[:, 1].astype(np.float64)
+    z = samples[:, 2].astype(np.float64)
+    classes = np.full(len(samples), NO_ORIENTATION, dtype=np.int8)
+    # lowest priority first, x overrides y which overrides z
+    classes[np.abs(z) > _threshold(z_threshold, Z_MAX)] = FLAT
+    y_mask = np.abs(y) > _threshold(y_threshold, Y_MAX)
+    classes[y_mask] = np.where(y[y_mask] > 0, Y_POS, Y_NEG)
+    x_mask = np.abs(x) > _threshold(x_threshold, X_MAX)
+    classes[x_mask] = np.where(x[x_mask] > 0, X_POS, X_NEG)
+    return classes
+
+def _runs(classes, old):
+    # run boundaries, and samples leaving old
+    bounds = np.flatnonzero(classes[1:] != classes[:-1]) + 1
+    others = np.flatnonzero((classes != old) & (classes != NO_ORIENTATION))
+    return classes, bounds, others
+
+### Classes ####################################################################
+
+class StreamingClassifier:
+    # feed() takes float32 arrays of shape (n, 3) and returns the list of
+    # (sample index, orientation) decided, where sample index counts every
+    # sample fed so far and points at the last sample of the run.
+    # hysteresis (0-1) is added to the thresholds of the axes that would leave
+    # the current orientation. 0 gives the firmware behaviour.
+    def __init__(self, number_stable_samples, x_threshold, y_threshold,
+                 z_threshold, hysteresis=0.0, orientation=START_ORIENTATION):
+        self.number_stable_samples  = number_stable_samples
+        self.thresholds             = (x_threshold, y_threshold, z_threshold)
+        self.hysteresis             = hysteresis
+        self.orientation            = orientation
+        self.position               = 0     # samples fed so far
+        self._carry                 = np.empty((0, 3), dtype=np.float32)
+
+    def _thresholds(self, orientation):
+        if self.hysteresis == 0 or orientation == START_ORIENTATION:
+            return self.thresholds
+        # index of the axis of the current orientation (x, y or z)
+        axis = min(orientation // 2, 2)
+        return tuple(thr if i == axis else thr + self.hysteresis
+                     for i, thr in enumerate(self.thresholds))
+
+    def feed(self, samples):
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1, 3)
+        if len(self._carry):
+            samples = np.concatenate((self._carry, samples))
+        cache = {}
+        def runs(old):
+            if old not in cache:
+                classes = classifySamples(samples, *self._thresholds(old))
+                cache[old] = _runs(classes, old)
+            return cache[old]
+        changes, k = self._detect(len(samples), runs)
+        self._carry = samples[k:]
+        return changes
+
+    def feedClasses(self, classes):
+        # Same as feed() for the output of classifySamples() with the
+        # thresholds of this classifier (hysteresis must be 0). Settings that
+        # only differ by number_stable_samples can share the classification.
+        # Don't mix with feed() on the same classifier.
+        classes = np.asarray(classes, dtype=np.int8)
+        if len(self._carry):
+            classes = np.concatenate((self._carry, classes))
+        cache = {}
+        def runs(old):
+            if old not in cache:
+                cache[old] = _runs(classes, old)
+            return cache[old]
+        changes, k = self._detect(len(classes), runs)
+        self._carry = classes[k:]
+        return changes
+
+    def _detect(self, length, runs):
+        # Runs the rolling window over the carried and new samples, runs
+        # gives the classes of the samples for the current orientation.
+        # Returns the changes and the number of samples consumed.
+        start = self.position - len(self._carry)
+        window = self.number_stable_samples + 1
+        changes = []
+        k = 0
+        while k < length:
+            classes, bounds, others = runs(self.orientation)
+            # first sample from k on that leaves the current orientation
+            i = np.searchsorted(others, k)
+            if i == len(others):
+                k = length
+                break
+            m = others[i]
+            # end of its run
+            j = np.searchsorted(bounds, m, side="right")
+            end = bounds[j] if j < len(bounds) else length
+            if end - m >= window:
+                changes.append((start + m + window - 1, int(classes[m])))
+                self.orientation = classes[m]
+                k = m + window
+            elif end < length:
+                k = end             # run broken by sample end
+            else:
+                k = m               # need more samples
+                break
+        self.position = start + length
+        return changes, k
+
+    def feedBytes(self, samples, rates=b""):
+        # Same as feed() for packed float32 x, y, z values. Returns the names
+        # of the orientations decided. rates (angular rates) are only used by
+        # PredictiveClassifier (prediction.py).
+        changes = self.feed(np.frombuffer(samples, dtype="<f4"))
+        return [ORIENTATION_NAMES[orientation] for _, orientation in changes]
@@ -0,0 +1,144 @@
+#  Configuration file hot-reload
+#  config_watch.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  ConfigWatcher checks the modification time of the configuration file every
+#  CONFIG_POLL_INTERVAL. When it changes, the content hash tells if the file
+#  really changed. Only the sections that differ from the last version are
+#  parsed and validated again (ConfigurationData.reloaded()), into a new
+#  ConfigurationData that is never modified afterwards. Invalid files are
+#  reported once and the last valid configuration is kept.
+#  A configuration restored from the startup snapshot (startup.py) is checked
+#  once against a ConfigurationData parsed from the file alone
+#  (ConfigurationData.parsed()), which replaces it if any value differs.
+#  Every subscriber (a queue, or any object with put()) then receives a
+#  ConfigChange: every device of the engine (async_engine.py) swaps the values
+#  of its configuration at once and pushes the Arduino parameters over the
+#  live link if they changed.
+
+### IMPORTS ####################################################################
+
+import os
+import copy
+import hashlib
+import threading
+import configparser
+
+import metrics
+
+### Global Constants ###########################################################
+
+CONFIG_POLL_INTERVAL            = 1     # seconds
+
+### Classes ####################################################################
+
+class ConfigChange:
+    # data:     new ConfigurationData, never modified afterwards
+    # sections: names of the sections that changed
+    def __init__(self, data, sections):
+        self.data       = data
+        self.sections   = sections
+
+class ConfigWatcher:
+    # data:     ConfigurationData in use
+    # verify:   parse every section again on the first check, for a
+    #           configuration restored from the startup snapshot: if the
+    #           values differ, the subscribers replace the snapshot ones with
+    #           the values parsed from the file
+    # start() once the subscribers are known
+    def __init__(self, data, verify=False, interval=CONFIG_POLL_INTERVAL):
+        self.data           = copy.copy(data)
+        self.filename       = data.filename
+        self.verify         = verify
+        self.interval       = interval
+        self.reloads        = metrics.counter("config_reloads_total")
+        self.errors         = metrics.counter("config_reload_errors_total")
+        self._subscribers   = []
+        self._mtime         = None
+        self._hash          = None
+        self._sections      = None
+        self._stop          = threading.Event()
+        self._thread        = None
+
+    def subscribe(self, notify):
+        self._subscribers.append(notify)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        self._read(full=self.verify)
+        while not self._stop.wait(self.interval):
+            self._read()
+
+    def _read(self, full=False):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+            if mtime == self._mtime and not(full):
+                return
+            self._mtime = mtime
+            with open(self.filename, "rb") as file:
+                content = file.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if digest == self._hash and not(full):
+                return
+            self._hash = digest
+            text = content.decode("utf-8", "ignore")
+            config = configparser.ConfigParser()
+            config.read_string(text)
+            # values written in each section, without the DEFAULT ones
+            raw = configparser.ConfigParser(default_section=None)
+            raw.read_string(text)
+            sections = {name: dict(raw[name]) for name in raw.sections()}
+        except (OSError, configparser.Error) as error:
+            self.errors.inc()
+            print("Configuration not reloaded: " + str(error))
+            return
+        if self._sections is None and not(full):
+            # first version of the file, already validated by main()
+            self._sections = sections
+            return
+        old = self._sections or {}
+        changed = sorted(name for name in set(sections) | set(old)
+                         if sections.get(name) != old.get(name))
+        # the snapshot values are checked against the file alone
+        verifying = self._sections is None
+        try:
+            if verifying:
+                data = self.data.parsed(config)
+            else:
+                data = self.data.reloaded(config, changed)
+        except Exception as error:      # missing option...
+            print(error)
+            data = None
+        if data is None:
+            self.errors.inc()
+            print("Configuration not reloaded, the last valid one is kept.")
+            return
+        self._sections = sections
+        # subscribers get every valid version, e.g. for the startup snapshot
+        # of the new file, even if no value used changed
+        if vars(data) != vars(self.data):
+            self.reloads.inc()
+            if verifying:
+                restored, parsed = vars(self.data), vars(data)
+                print("The startup snapshot doesn't match " + self.filename
+                      + ", its values are replaced by the ones of the file ("
+                      + ", ".join(sorted(
+                          name for name in set(restored) | set(parsed)
+                          if restored.get(name) != parsed.get(name)))
+                      + ")")
+            else:
+                print("Configuration reloaded (" + ", ".join(changed) + ")")
+        self.data = data
+        change = ConfigChange(data, changed)
+        for notify in self._subscribers:
+            notify.put(change)
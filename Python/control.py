@@ -0,0 +1,308 @@
+#  Local control socket: query, switch mode, pause, resume, force a rotation
+#  control.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  python rotate_screen.py --control-socket PATH (Unix socket) or
+#  --control-port PORT (127.0.0.1, also on Windows) accepts one command per
+#  line and answers each one with a line of JSON:
+#    status                        mode, modes, paused, last orientations
+#    mode <MODE>                   switch to a section of the configuration
+#    pause / resume                stop / restart the automatic rotation
+#    rotate <ORIENTATION> [<MON>]  X_POS, Y_POS, X_NEG, Y_NEG, FLAT (mapped by
+#                                  the mode) or PORTRAIT, PORTRAIT_FLIPPED,
+#                                  LANDSCAPE, LANDSCAPE_FLIPPED
+#    record [<FILE>]               write the records of --record (recorder.py)
+#  Every mode section is validated and compiled into a lookup table at
+#  startup (and after every reload of the file), so no command reads the
+#  configuration file or waits for a rotation to be applied.
+#  A mode switch lasts until the configuration file is saved again.
+#
+#  Client for scripts and hotkeys:
+#    python control.py --socket PATH|--port PORT <command> [<argument>...]
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+import json
+import socket
+import inspect
+import argparse
+import threading
+import socketserver
+
+import metrics
+from display_backend import DisplayRequest
+from config_watch import ConfigChange
+
+### Global Constants ###########################################################
+
+CONTROL_HOST                    = "127.0.0.1"
+# seconds the client waits for an answer
+CONTROL_TIMEOUT                 = 5
+
+### Error messages #############################################################
+
+def ERROR_COMMAND(command):
+    return (command + " is not a valid command. Valid commands are: status, "
+            "mode, pause, resume, rotate, record")
+
+def ERROR_MODE(mode, modes):
+    return mode + " is not a valid mode. Valid modes are: " + ", ".join(modes)
+
+def ERROR_ORIENTATION(orientation, orientations):
+    return (orientation + " is not a valid orientation. Valid orientations "
+            "are: " + ", ".join(orientations))
+
+def ERROR_MONITOR(monitor, monitors):
+    return (str(monitor) + " is not a rotated monitor. Rotated monitors are: "
+            + ", ".join(monitors))
+
+ERROR_NO_RECORDER       = "Nothing is recorded, start with --record SECONDS"
+
+def ERROR_ARGUMENTS(command):
+    return "Wrong number of arguments for " + command
+
+def ERROR_INTERNAL(error):
+    return "Command failed: " + type(error).__name__ + ": " + str(error)
+
+### Classes ####################################################################
+
+class ControlError(ValueError):
+    pass
+
+class RotationControl:
+    # State changed by the commands of the control socket, shared with the
+    # engine.
+    # data:             ConfigurationData in use
+    # compile_modes:    ConfigurationData -> {mode: (ConfigurationData,
+    #                   {orientation: (angle, position) or None})} of every
+    #                   valid mode of its configuration file
+    # backend:          DisplayBackend, forced rotations are submitted to it
+    # recorder:         Recorder written by the record command, or None
+    # The engine subscribes to the mode switches (ConfigChange, like the
+    # reloads of ConfigWatcher) and ask allows() before every rotation.
+    # ConfigWatcher hands the reloads of the file to put().
+    def __init__(self, data, compile_modes, backend, recorder=None):
+        self.compile_modes  = compile_modes
+        self.backend        = backend
+        self.recorder       = recorder
+        self.modes          = compile_modes(data)
+        self.mode           = data.mode
+        self.paused         = False
+        # last orientation sent by the Arduino of every rotated monitor
+        self.monitors       = [_monitor(monitor) for monitor in
+                               (list(data.devices.values()) or [data.monitor])]
+        self.orientations   = {monitor: None for monitor in self.monitors}
+        self.commands       = {
+            "status"    : self.status,
+            "mode"      : self.switchMode,
+            "pause"     : self.pause,
+            "resume"    : self.resume,
+            "rotate"    : self.rotate,
+            "record"    : self.record
+        }
+        self._subscribers   = []
+        self._lock          = threading.Lock()
+
+    def subscribe(self, notify):
+        self._subscribers.append(notify)
+
+    def put(self, change):
+        # reload of the configuration file: its mode applies again
+        modes = self.compile_modes(change.data)
+        with self._lock:
+            self.modes  = modes
+            self.mode   = change.data.mode
+
+    def allows(self, orientation, monitor):
+        # Called by the engine for every orientation received. False while
+        # paused, resume() applies the last one.
+        with self._lock:
+            self.orientations[_monitor(monitor)] = orientation
+            return not(self.paused)
+
+    ### Commands ###############################################################
+
+    def execute(self, line):
+        # One command line -> answer (dict)
+        words = line.split()
+        if not words:
+            raise ControlError(ERROR_COMMAND(""))
+        command = self.commands.get(words[0].lower())
+        if command is None:
+            raise ControlError(ERROR_COMMAND(words[0]))
+        metrics.counter("control_commands_total",
+                        command=words[0].lower()).inc()
+        # checked before the call: a TypeError of the command itself is not
+        # a wrong number of arguments
+        try:
+            inspect.signature(command).bind(*words[1:])
+        except TypeError:
+            raise ControlError(ERROR_ARGUMENTS(words[0]))
+        return command(*words[1:])
+
+    def status(self):
+        with self._lock:
+            return {
+                "mode"          : self.mode,
+                "modes"         : sorted(self.modes),
+                "paused"        : self.paused,
+                "orientations"  : dict(self.orientations)
+            }
+
+    def switchMode(self, mode):
+        with self._lock:
+            if mode not in self.modes:
+                raise ControlError(ERROR_MODE(mode, sorted(self.modes)))
+            self.mode = mode
+            data, table = self.modes[mode]
+            paused = self.paused
+            orientations = dict(self.orientations)
+        # Arduino parameters are pushed by the engine, as for a reload
+        change = ConfigChange(data, ["MODE"])
+        for notify in self._subscribers:
+            notify.put(change)
+        if not(paused):
+            # the current orientations, as mapped by the new mode
+            for monitor, orientation in orientations.items():
+                self._submit(table, orientation, monitor)
+        return self.status()
+
+    def pause(self):
+        with self._lock:
+            self.paused = True
+        return self.status()
+
+    def resume(self):
+        with self._lock:
+            self.paused = False
+            table = self.modes[self.mode][1]
+            orientations = dict(self.orientations)
+        # orientations received while paused
+        for monitor, orientation in orientations.items():
+            self._submit(table, orientation, monitor)
+        return self.status()
+
+    def rotate(self, orientation, monitor=None):
+        # Applied even while paused. The next orientation sent by the Arduino
+        # replaces it.
+        orientation = orientation.upper()
+        with self._lock:
+            table = self.modes[self.mode][1]
+        if orientation not in table:
+            raise ControlError(ERROR_ORIENTATION(orientation, list(table)))
+        if monitor is not None and monitor not in self.monitors:
+            raise ControlError(ERROR_MONITOR(monitor, self.monitors))
+        for target in ([monitor] if monitor is not None else self.monitors):
+            self._submit(table, orientation, target)
+        return self.status()
+
+    def record(self, filename=None):
+        if self.recorder is None:
+            raise ControlError(ERROR_NO_RECORDER)
+        from recorder import RECORDING_FILENAME
+        filename = filename or RECORDING_FILENAME
+        try:
+            records = self.recorder.dump(filename)
+        except OSError as error:
+            raise ControlError(str(error))
+        return dict(self.status(), recording=os.path.abspath(filename),
+                    records=records)
+
+    def _submit(self, table, orientation, monitor):
+        # Rotations are applied by the worker of the backend, in order with
+        # the ones of the engine. No answer waits for them.
+        if table.get(orientation) is None:
+            return
+        angle, position = table[orientation]
+        self.backend.submit(DisplayRequest(monitor, angle, position))
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        control = self.server.control
+        for line in self.rfile:
+            try:
+                answer = dict(ok=True, **control.execute(
+                    line.decode("utf-8", "ignore")))
+            except ControlError as error:
+                answer = {"ok": False, "error": str(error)}
+            # any other error is answered too, the connection stays open
+            except Exception as error:
+                print(ERROR_INTERNAL(error))
+                answer = {"ok": False, "error": ERROR_INTERNAL(error)}
+            self.wfile.write((json.dumps(answer) + "\n").encode())
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+if hasattr(socket, "AF_UNIX"):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+class ControlServer:
+    # address: path of a Unix socket, or local TCP port number
+    def __init__(self, control, address):
+        if isinstance(address, int):
+            self.server = _TCPServer((CONTROL_HOST, address), _Handler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)      # left by a previous run
+            self.server = _UnixServer(address, _Handler)
+        self.server.control = control
+        self.address = address
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.address, int):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+### Functions ##################################################################
+
+def _monitor(monitor):
+    # monitor numbers as in DisplayRequest
+    return monitor if monitor != "" else "1"
+
+def sendCommand(address, command):
+    # Answer (dict) of the control socket at address to one command line
+    if isinstance(address, int):
+        client = socket.create_connection((CONTROL_HOST, address),
+                                          CONTROL_TIMEOUT)
+    else:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(CONTROL_TIMEOUT)
+        client.connect(address)
+    with client, client.makefile("rwb") as stream:
+        stream.write((command + "\n").encode())
+        stream.flush()
+        return json.loads(stream.readline())
+
+################################################################################
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--socket", help="Unix socket of rotate_screen.py")
+    group.add_argument("--port", type=int,
+                       help="local port of rotate_screen.py")
+    parser.add_argument("command", nargs="+",
+                        help="status, mode <MODE>, pause, resume, "
+                        "rotate <ORIENTATION> [<MONITOR>] or record [<FILE>]")
+    args = parser.parse_args()
+    answer = sendCommand(args.socket or args.port, " ".join(args.command))
+    print(json.dumps(answer, indent=2))
+    sys.exit(0 if answer["ok"] else 1)
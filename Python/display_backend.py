@@ -0,0 +1,520 @@
+#  Display backends applying screen rotations and positions
+#  display_backend.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Every backend owns one long-lived worker thread. Rotate/position requests
+#  are handed to it through a queue, so no process is started per rotation
+#  (except for the legacy display64 backend).
+#  The win32 and fake backends plan the whole desktop for every request
+#  (layout.py) and apply every monitor that changes in one transaction.
+#  A request can be staged ahead of time (gyroscope prediction, see
+#  prediction.py): its transaction is planned, and its display settings are
+#  prepared in memory on Windows. Nothing is written before the commit, so a
+#  rollback or a crash leaves the registry as it was. Applying the same
+#  request then only commits it, any other request or unstage() discards it.
+#  One request is staged at a time.
+#  The monitors are read from the snapshot of the monitor topology
+#  (monitor_topology.py): a request for a monitor that is not connected fails
+#  before anything is applied.
+#  A request that leaves every monitor as it is sets no display mode and is
+#  counted as skipped. The backends compare against the state of the display
+#  they track (the topology snapshot, or what display64 applied last), which
+#  is reconciled with the monitors at startup and by reconcile() after every
+#  (re)connection of an Arduino, whose first orientation is then skipped if
+#  the screen is already in it.
+
+### IMPORTS ####################################################################
+
+import sys
+import time
+import queue
+import threading
+import importlib.util
+
+import metrics
+from layout import (
+    MonitorGeometry, LayoutError, ERROR_UNKNOWN_MONITOR, planLayout
+)
+from monitor_topology import sharedTopology
+
+# Windows only, imported by the worker thread of Win32DisplayBackend (see
+# importWin32) so that startup doesn't wait for them
+win32api = None
+win32con = None
+
+### Global Constants ###########################################################
+
+DISPLAY64_EXECUTABLE            = "display64.exe"
+# Windows: don't open a console window for display64.exe
+CREATE_NO_WINDOW                = 0x08000000
+
+# display64 angles (degrees) to DEVMODE display orientations
+ANGLE_TO_DMDO = {
+    "0"     : 0,
+    "90"    : 1,
+    "180"   : 2,
+    "270"   : 3
+}
+
+# Monitors of the fake backend, added side by side when first requested
+FAKE_MONITOR_SIZE               = (1920, 1080)
+
+# What the worker does with a DisplayRequest
+APPLY                           = "apply"
+STAGE                           = "stage"
+UNSTAGE                         = "unstage"
+RECONCILE                       = "reconcile"
+
+### Error messages #############################################################
+
+ERROR_NO_WIN32      = "win32api is required for the win32 display backend."
+
+def ERROR_UNKNOWN_BACKEND(name):
+    return (name + " is not a valid display backend.\n Valid backends are:"
+            + str(list(DISPLAY_BACKENDS)))
+
+def ERROR_DISPLAY_CHANGE(device, result):
+    return ("Display settings of " + device + " could not be changed (error "
+            + str(result) + ").")
+
+def ERROR_DISPLAY64(request, result):
+    return (DISPLAY64_EXECUTABLE + " " + str(request) + " failed (exit code "
+            + str(result) + ").")
+
+### Classes ####################################################################
+
+class DisplayRequest:
+    # monitor:  monitor number as in the configuration file ("" for 1)
+    # angle:    "0", "90", "180", "270" or "" to keep the current rotation
+    # position: (x, y) of the top left corner or None to keep it
+    # action:   APPLY, STAGE, UNSTAGE (see DisplayBackend.stage()) or
+    #           RECONCILE
+    # skipped:  set if applying the request changed nothing
+    def __init__(self, monitor, angle="", position=None, action=APPLY):
+        self.monitor    = monitor if monitor != "" else "1"
+        self.angle      = angle
+        self.position   = position
+        self.action     = action
+        self.apply_time = None
+        self.error      = None
+        self.skipped    = False
+        self.done       = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def copy(self):
+        # a request is applied once: new request for the same change
+        return DisplayRequest(self.monitor, self.angle, self.position,
+                              self.action)
+
+    def key(self):
+        return (self.monitor, self.angle, self.position, self.action)
+
+    def __eq__(self, other):
+        # same change, whatever happened when applying them (configurations
+        # holding the same requests are equal)
+        if not isinstance(other, DisplayRequest):
+            return NotImplemented
+        return self.key() == other.key()
+
+    __hash__ = None
+
+    def __str__(self):
+        text = "/device " + self.monitor
+        if self.angle != "":
+            text += " /rotate " + self.angle
+        if self.position is not None:
+            text += " /position " + str(self.position[0]) + " " \
+                    + str(self.position[1])
+        return text
+
+class DisplayBackend:
+    # Base class. Subclasses implement currentLayout() and applyLayout(), or
+    # replace applyRequest() (and stageRequest()). They always run in the
+    # worker thread. setUp() is an optional one-time initialization,
+    # stageLayout(), commitLayout() and discardLayout() are optional too.
+    # topology: MonitorTopology the requested monitors are checked against,
+    #           None not to check them
+    def __init__(self, topology=None):
+        backend = type(self).__name__
+        self.apply_time = metrics.histogram("display_apply_seconds",
+                                            backend=backend)
+        self.errors     = metrics.counter("display_errors_total",
+                                          backend=backend)
+        # display settings changed, one per monitor of every transaction,
+        # and requests that didn't need any
+        self.mode_sets  = metrics.counter("display_mode_sets_total",
+                                          backend=backend)
+        self.skipped    = metrics.counter("display_mode_sets_skipped_total",
+                                          backend=backend)
+        self.reconciles = metrics.counter("display_reconciles_total",
+                                          backend=backend)
+        self.stages     = metrics.counter("display_stages_total",
+                                          backend=backend)
+        self.commits    = metrics.counter("display_commits_total",
+                                          backend=backend)
+        self.rollbacks  = metrics.counter("display_rollbacks_total",
+                                          backend=backend)
+        self.topology   = topology
+        # (str(request), target, changed) of the staged request, or None
+        self._staged    = None
+        self._requests  = queue.Queue()
+        self._thread    = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        self._requests.put(request)
+        return request
+
+    def apply(self, request):
+        # blocking version of submit()
+        self.submit(request).wait()
+        return request
+
+    def stage(self, request):
+        # Prepares request so that applying it later is only a commit
+        request.action = STAGE
+        return self.submit(request)
+
+    def unstage(self):
+        # Discards the staged request, if any
+        return self.submit(DisplayRequest("", action=UNSTAGE))
+
+    def reconcile(self):
+        # Takes the state of the monitors again before the next requests
+        return self.submit(DisplayRequest("", action=RECONCILE))
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def setUp(self):
+        pass
+
+    def reconcileState(self):
+        # The monitors as they are now, at startup and on reconcile()
+        self.reconciles.inc()
+        if self.topology is not None:
+            self.topology.refresh()
+
+    def checkMonitor(self, request):
+        # an unplugged monitor fails here rather than in the middle of a
+        # transaction or in display64.exe
+        if (self.topology is not None
+                and request.monitor not in self.topology.snapshot()):
+            raise LayoutError(ERROR_UNKNOWN_MONITOR(request.monitor))
+
+    def applyRequest(self, request):
+        # Target desktop of the request, applied at once. Nothing is done if
+        # no monitor changes (e.g. the rotation is already the right one).
+        if self._staged is not None and self._staged[0] == str(request):
+            _, target, changed = self._staged
+            self._staged = None
+            if changed:
+                self.commitLayout(target, changed)
+                self.mode_sets.inc(len(changed))
+            else:
+                self.skip(request)
+            self.commits.inc()
+            return
+        self.unstageRequest()
+        target, changed = planLayout(self.currentLayout(), request)
+        if changed:
+            self.applyLayout(target, changed)
+            self.mode_sets.inc(len(changed))
+        else:
+            self.skip(request)
+
+    def skip(self, request):
+        request.skipped = True
+        self.skipped.inc()
+
+    def stageRequest(self, request):
+        self.unstageRequest()
+        target, changed = planLayout(self.currentLayout(), request)
+        if changed:
+            self.stageLayout(target, changed)
+        self._staged = (str(request), target, changed)
+        self.stages.inc()
+
+    def unstageRequest(self):
+        if self._staged is None:
+            return
+        _, target, changed = self._staged
+        self._staged = None
+        if changed:
+            self.discardLayout(changed)
+        self.rollbacks.inc()
+
+    def currentLayout(self):
+        # {monitor number: MonitorGeometry} of the desktop
+        raise NotImplementedError
+
+    def applyLayout(self, target, changed):
+        # target: {monitor number: MonitorGeometry}, changed: monitors to set
+        raise NotImplementedError
+
+    def stageLayout(self, target, changed):
+        # written ahead of commitLayout(), nothing visible changes
+        pass
+
+    def commitLayout(self, target, changed):
+        # applies a staged layout
+        self.applyLayout(target, changed)
+
+    def discardLayout(self, changed):
+        # undoes stageLayout()
+        pass
+
+    def _run(self):
+        self.setUp()
+        self.reconcileState()
+        actions = {
+            APPLY       : self.applyRequest,
+            STAGE       : self.stageRequest,
+            UNSTAGE     : lambda request: self.unstageRequest(),
+            RECONCILE   : lambda request: self.reconcileState()
+        }
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            start = time.perf_counter()
+            try:
+                if request.action in (APPLY, STAGE):
+                    self.checkMonitor(request)
+                actions[request.action](request)
+            except Exception as e:
+                request.error = e
+                self.errors.inc()
+                print(e)
+            request.apply_time = time.perf_counter() - start
+            if request.action == APPLY:
+                self.apply_time.add(request.apply_time)
+            request.done.set()
+
+class Win32DisplayBackend(DisplayBackend):
+    # Changes display settings in-process through ChangeDisplaySettingsEx.
+    # The desktop is planned from the topology snapshot, only the settings of
+    # the monitors that change are read.
+    def __init__(self, topology=None):
+        if importlib.util.find_spec("win32api") is None:
+            raise ImportError(ERROR_NO_WIN32)
+        DisplayBackend.__init__(self, topology)
+
+    def setUp(self):
+        importWin32()
+        if self.topology is None:
+            self.topology = sharedTopology()
+        self._devices = {}
+        # [(device, DEVMODE)] of the staged transaction
+        self._devmodes = []
+
+    def currentLayout(self):
+        snapshot = self.topology.snapshot()
+        self._devices = snapshot.devices
+        return snapshot.layout()
+
+    def applyLayout(self, target, changed):
+        # Every monitor is staged with CDS_NORESET, then one call without
+        # arguments applies them all: a single desktop reflow
+        self.stageLayout(target, changed)
+        self.commitLayout(target, changed)
+
+    def stageLayout(self, target, changed):
+        # DEVMODE of every monitor that changes, only kept in memory
+        devmodes = []
+        for monitor in changed:
+            device = self._devices[monitor]
+            devmode = win32api.EnumDisplaySettings(
+                device, win32con.ENUM_CURRENT_SETTINGS)
+            geometry = target[monitor]
+            devmode.DisplayOrientation = ANGLE_TO_DMDO[geometry.angle]
+            devmode.PelsWidth = geometry.width
+            devmode.PelsHeight = geometry.height
+            devmode.Position_x = geometry.x
+            devmode.Position_y = geometry.y
+            devmode.Fields |= (win32con.DM_DISPLAYORIENTATION
+                               | win32con.DM_PELSWIDTH | win32con.DM_PELSHEIGHT
+                               | win32con.DM_POSITION)
+            devmodes.append((device, devmode))
+        self._devmodes = devmodes
+
+    def commitLayout(self, target, changed):
+        # written to the registry without being applied, then applied at once
+        devmodes, self._devmodes = self._devmodes, []
+        try:
+            for device, devmode in devmodes:
+                result = win32api.ChangeDisplaySettingsEx(
+                    device, devmode,
+                    win32con.CDS_UPDATEREGISTRY | win32con.CDS_NORESET)
+                if result != win32con.DISP_CHANGE_SUCCESSFUL:
+                    raise IOError(ERROR_DISPLAY_CHANGE(device, result))
+            result = win32api.ChangeDisplaySettingsEx()
+        finally:
+            # taken again on WM_DISPLAYCHANGE, or by the next snapshot()
+            self.topology.invalidate()
+        if result != win32con.DISP_CHANGE_SUCCESSFUL:
+            raise IOError(ERROR_DISPLAY_CHANGE("the desktop", result))
+
+    def discardLayout(self, changed):
+        # nothing was written
+        self._devmodes = []
+
+class Display64Backend(DisplayBackend):
+    # Legacy backend: one display64.exe process per request (no shell), the
+    # neighbours of the monitor are not moved. Keeps the rotation and the
+    # position applied to every monitor, taken from the topology snapshot
+    # when there is one, so no process is started for a request that changes
+    # neither.
+    def setUp(self):
+        if self.topology is None:
+            self.topology = sharedTopology()
+        # {monitor number: (angle, (x, y))}, "" or None if not known
+        self._state = {}
+
+    def reconcileState(self):
+        DisplayBackend.reconcileState(self)
+        if self.topology is None:
+            # the monitors may have been changed since, nothing is known
+            self._state = {}
+            return
+        state = {monitor: (geometry.angle, (geometry.x, geometry.y))
+                 for monitor, geometry
+                 in self.topology.snapshot().monitors.items()}
+        for monitor, applied in self._state.items():
+            if state.get(monitor) != applied:
+                print("Monitor " + monitor + " was changed outside of "
+                      "rotate_screen")
+        self._state = state
+
+    def applyRequest(self, request):
+        import subprocess
+        angle, position = self._state.get(request.monitor, ("", None))
+        new_position = (None if request.position is None else
+                        (int(request.position[0]), int(request.position[1])))
+        if ((request.angle == "" or request.angle == angle)
+                and (new_position is None or new_position == position)):
+            self.skip(request)
+            return
+        command = [DISPLAY64_EXECUTABLE] + str(request).split()
+        options = ({"creationflags": CREATE_NO_WINDOW}
+                   if sys.platform == "win32" else {})
+        try:
+            result = subprocess.call(command, **options)
+        finally:
+            if self.topology is not None:
+                self.topology.invalidate()
+        if result != 0:
+            # what display64 left on the screen is not known any more
+            self._state.pop(request.monitor, None)
+            raise IOError(ERROR_DISPLAY64(request, result))
+        self.mode_sets.inc()
+        self._state[request.monitor] = (request.angle or angle,
+                                        new_position or position)
+
+    def stageRequest(self, request):
+        # nothing can be prepared for display64.exe
+        pass
+
+class FakeDisplayBackend(DisplayBackend):
+    # In-process backend for measuring latency and testing layouts without
+    # Windows. Keeps the geometry of every monitor, the applied requests, the
+    # changed monitors of every transaction and the time.perf_counter() at
+    # which each apply started, and the monitors of every staged and
+    # discarded transaction.
+    # monitors: {monitor number: MonitorGeometry} of the desktop, by default
+    #           FAKE_MONITOR_SIZE monitors are added side by side on request
+    # topology: e.g. FakeMonitorTopology, to check the requested monitors
+    def __init__(self, apply_delay=0.0, monitors=None, topology=None):
+        self.apply_delay    = apply_delay
+        self.applied        = []
+        self.calls          = []
+        self.transactions   = []
+        self.staged         = []
+        self.discarded      = []
+        self.monitors       = dict(monitors or {})
+        self.add_monitors   = monitors is None
+        DisplayBackend.__init__(self, topology)
+
+    def applyRequest(self, request):
+        self.calls.append((time.perf_counter(), request))
+        if self.apply_delay:
+            time.sleep(self.apply_delay)
+        self._addMonitor(request)
+        DisplayBackend.applyRequest(self, request)
+        self.applied.append(request)
+
+    def stageRequest(self, request):
+        self._addMonitor(request)
+        DisplayBackend.stageRequest(self, request)
+
+    def _addMonitor(self, request):
+        if self.add_monitors and request.monitor not in self.monitors:
+            x = max((m.right() for m in self.monitors.values()), default=0)
+            self.monitors[request.monitor] = MonitorGeometry(
+                request.monitor, "0", x, 0, *FAKE_MONITOR_SIZE)
+
+    def currentLayout(self):
+        return dict(self.monitors)
+
+    def applyLayout(self, target, changed):
+        for monitor in changed:
+            self.monitors[monitor] = target[monitor]
+        self.transactions.append(changed)
+
+    def stageLayout(self, target, changed):
+        self.staged.append(changed)
+
+    def discardLayout(self, changed):
+        self.discarded.append(changed)
+
+class DisplayStager:
+    # Stages the display requests of the gyroscope predictions (prediction.py)
+    # request:          orientation index -> DisplayRequest or None
+    # rotation_control: RotationControl (control.py), nothing is staged while
+    #                   it is paused
+    def __init__(self, backend, request, rotation_control=None):
+        self.backend            = backend
+        self.request            = request
+        self.rotation_control   = rotation_control
+
+    def stage(self, orientation):
+        if self.rotation_control is not None and self.rotation_control.paused:
+            return
+        request = self.request(orientation)
+        if request is not None:
+            self.backend.stage(request)
+
+    def rollback(self):
+        self.backend.unstage()
+
+### Functions ##################################################################
+
+def printApplied(request):
+    if request.skipped:
+        print(str(request) + " already applied")
+    else:
+        print(str(request) + " applied in "
+              + "{:.1f} ms".format(1000*request.apply_time))
+
+def importWin32():
+    global win32api, win32con
+    if win32api is None:
+        import win32api
+        import win32con
+
+DISPLAY_BACKENDS = {
+    "win32"     : Win32DisplayBackend,
+    "display64" : Display64Backend,
+    "fake"      : FakeDisplayBackend
+}
+
+def createBackend(name):
+    if name not in DISPLAY_BACKENDS:
+        raise ValueError(ERROR_UNKNOWN_BACKEND(name))
+    return DISPLAY_BACKENDS[name]()
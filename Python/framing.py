@@ -0,0 +1,103 @@
+#  Binary framing of the serial link (see Arduino/include/Orientation.h)
+#  framing.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Frame layout (little endian):
+#  SYNC | VERSION | TYPE | SEQ | LEN | PAYLOAD (LEN bytes) | CRC16
+#  The CRC16-CCITT (initial value 0xFFFF) covers VERSION to the end of PAYLOAD.
+#  SYNC (0xA5) never appears in the text protocol, so text lines and frames can
+#  share the same stream.
+
+### IMPORTS ####################################################################
+
+import struct
+import binascii
+import itertools
+
+### Global Constants ###########################################################
+
+FRAME_SYNC                      = 0xA5
+FRAME_VERSION                   = 1
+FRAME_MAX_PAYLOAD               = 64
+# SYNC, VERSION, TYPE, SEQ, LEN
+FRAME_HEADER                    = struct.Struct("<BBBBB")
+FRAME_CRC                       = struct.Struct("<H")
+FRAME_OVERHEAD                  = FRAME_HEADER.size + FRAME_CRC.size
+
+# Frame types
+FRAME_ORIENTATION               = 0x01  # Arduino -> PC, 1 byte orientation
+FRAME_CONFIG                    = 0x02  # PC -> Arduino, CONFIG_PAYLOAD
+FRAME_HEARTBEAT                 = 0x03  # PC -> Arduino, "Connected"
+FRAME_SAMPLE                    = 0x04  # Arduino -> PC, SAMPLE_PAYLOAD
+FRAME_MOTION                    = 0x05  # Arduino -> PC, MOTION_PAYLOAD
+
+# SamplingRate, NumberStableSamples, XThreshold, YThreshold, ZThreshold
+CONFIG_PAYLOAD                  = struct.Struct("<HHfff")
+# Raw acceleration x, y, z in Gs (host classification)
+SAMPLE_PAYLOAD                  = struct.Struct("<fff")
+# Raw sample followed by the angular rate x, y, z in degrees per second
+MOTION_PAYLOAD                  = struct.Struct("<ffffff")
+
+# Same order as enum Orientation in Orientation.h
+ORIENTATION_NAMES               = ("X_POS", "X_NEG", "Y_POS", "Y_NEG", "FLAT")
+ORIENTATION_INDEX = {name: index for index, name in
+                     enumerate(ORIENTATION_NAMES)}
+
+# Token appended to the ready and confirmation messages to agree on binary
+# framing: "Ready BIN1" / "Confirmation BIN1 <baud rate>"
+BINARY_TOKEN                    = "BIN" + str(FRAME_VERSION)
+BINARY_BAUD_RATE                = 115200
+
+### Classes ####################################################################
+
+class Frame:
+    def __init__(self, type, seq, payload):
+        self.type       = type
+        self.seq        = seq
+        self.payload    = payload
+
+### Functions ##################################################################
+
+_sequence = itertools.count()
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def encodeFrame(type, payload=b"", seq=None):
+    if seq is None:
+        seq = next(_sequence) & 0xFF
+    body = FRAME_HEADER.pack(FRAME_SYNC, FRAME_VERSION, type, seq,
+                             len(payload)) + payload
+    return body + FRAME_CRC.pack(crc16(body[1:]))
+
+def decodeFrame(buffer, start=0):
+    # Decodes the frame starting at buffer[start] (which must be FRAME_SYNC).
+    # Returns (frame, size): size is 0 if the frame is not complete yet, and
+    # frame is None if the bytes are not a valid frame.
+    # buffer can be a memoryview: only the payload is copied.
+    available = len(buffer) - start
+    if available < FRAME_HEADER.size:
+        return None, 0
+    _, version, type, seq, length = FRAME_HEADER.unpack_from(buffer, start)
+    if version != FRAME_VERSION or length > FRAME_MAX_PAYLOAD:
+        return None, 1
+    size = FRAME_OVERHEAD + length
+    if available < size:
+        return None, 0
+    end = start + FRAME_HEADER.size + length
+    (crc,) = FRAME_CRC.unpack_from(buffer, end)
+    if crc != crc16(buffer[start+1:end]):
+        return None, 1
+    return Frame(type, seq, bytes(buffer[start+FRAME_HEADER.size:end])), size
+
+def configFrame(sampling_rate, number_stable_samples,
+                x_threshold, y_threshold, z_threshold):
+    return encodeFrame(FRAME_CONFIG, CONFIG_PAYLOAD.pack(
+        sampling_rate, number_stable_samples,
+        x_threshold, y_threshold, z_threshold))
+
+def heartbeatFrame():
+    return encodeFrame(FRAME_HEARTBEAT)
@@ -0,0 +1,27 @@
+#  Latency statistics shared by the serial reader and the display backends
+#  latency.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+class LatencyStats:
+    # Running latency statistics (in seconds), e.g. from byte arrival to
+    # dispatch of a serial frame or the time taken to apply a rotation.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+        self.last  = 0.0
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.last   = latency
+        if latency > self.max:
+            self.max = latency
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+    def __str__(self):
+        return ("last {:.2f} ms, mean {:.2f} ms, max {:.2f} ms ({} samples)"
+                .format(1000*self.last, 1000*self.mean(), 1000*self.max,
+                        self.count))
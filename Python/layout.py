@@ -0,0 +1,116 @@
+#  Desktop layout planner: rotation and position of every monitor at once
+#  layout.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  A DisplayRequest rotates and/or moves one monitor, but Windows reflows the
+#  desktop after every mode set and leaves its neighbours where they were.
+#  planLayout() computes the whole target desktop first:
+#  - the rotated monitor swaps its width and height (90 or 270 degrees)
+#  - the requested position is its new top left corner
+#  - monitors touching its right or bottom edge keep touching it, and so on
+#    for the monitors touching them, so no gap is opened and no overlap is
+#    created by the size change
+#  - the layout is refused (LayoutError) if two monitors still overlap
+#  The display backend then applies every changed monitor in one transaction
+#  (see DisplayBackend.applyRequest). Pure functions, no Windows needed.
+
+### IMPORTS ####################################################################
+
+import copy
+
+### Error messages #############################################################
+
+def ERROR_UNKNOWN_MONITOR(monitor):
+    return "Monitor " + monitor + " is not connected."
+
+def ERROR_OVERLAP(first, second):
+    return ("The new layout is refused, monitors " + first.monitor + " and "
+            + second.monitor + " would overlap: " + str(first) + ", "
+            + str(second))
+
+### Classes ####################################################################
+
+class LayoutError(ValueError):
+    pass
+
+class MonitorGeometry:
+    # angle:            "0", "90", "180" or "270" (display64 angles)
+    # x, y:             top left corner on the desktop
+    # width, height:    size as displayed, swapped in portrait
+    def __init__(self, monitor, angle, x, y, width, height):
+        self.monitor    = monitor
+        self.angle      = angle
+        self.x          = x
+        self.y          = y
+        self.width      = width
+        self.height     = height
+
+    def right(self):
+        return self.x + self.width
+
+    def bottom(self):
+        return self.y + self.height
+
+    def overlaps(self, other):
+        return (self.x < other.right() and other.x < self.right()
+                and self.y < other.bottom() and other.y < self.bottom())
+
+    def key(self):
+        return (self.angle, self.x, self.y, self.width, self.height)
+
+    def __str__(self):
+        return ("{} {}x{}+{}+{} rotated {}".format(self.monitor, self.width,
+                self.height, self.x, self.y, self.angle))
+
+### Functions ##################################################################
+
+def _touches(edge, start, end, other_start, other_end):
+    # edge is shared and the sides overlap on more than a corner
+    return edge and start < other_end and other_start < end
+
+def planLayout(current, request):
+    # current: {monitor: MonitorGeometry} of the desktop
+    # Returns (target, changed): the target desktop and the monitors whose
+    # geometry changes, in the order they should be applied
+    if request.monitor not in current:
+        raise LayoutError(ERROR_UNKNOWN_MONITOR(request.monitor))
+    target = {monitor: copy.copy(geometry)
+              for monitor, geometry in current.items()}
+    geometry = target[request.monitor]
+    if request.angle != "":
+        if (int(request.angle) - int(geometry.angle)) % 180:
+            geometry.width, geometry.height = geometry.height, geometry.width
+        geometry.angle = request.angle
+    if request.position is not None:
+        geometry.x = int(request.position[0])
+        geometry.y = int(request.position[1])
+
+    # Neighbours follow the right and bottom edges of the monitors that moved
+    moved = [request.monitor]
+    for monitor in moved:
+        old, new = current[monitor], target[monitor]
+        dx, dy = new.right() - old.right(), new.bottom() - old.bottom()
+        for other, geometry in target.items():
+            if other in moved:
+                continue
+            neighbour = current[other]
+            if dx and _touches(neighbour.x == old.right(), neighbour.y,
+                               neighbour.bottom(), old.y, old.bottom()):
+                geometry.x += dx
+                moved.append(other)
+            elif dy and _touches(neighbour.y == old.bottom(), neighbour.x,
+                                 neighbour.right(), old.x, old.right()):
+                geometry.y += dy
+                moved.append(other)
+
+    monitors = list(target.values())
+    for i, first in enumerate(monitors):
+        for second in monitors[i+1:]:
+            if first.overlaps(second):
+                raise LayoutError(ERROR_OVERLAP(first, second))
+    changed = [monitor for monitor in moved
+               if target[monitor].key() != current[monitor].key()]
+    return target, changed
@@ -0,0 +1,227 @@
+#  Metrics registry: counters, gauges and latency histograms
+#  metrics.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Every metric lives in REGISTRY and is updated in place by the code it
+#  measures (a lock and an addition). Nothing is formatted until someone asks:
+#  - MetricsServer (metrics_server.py, only imported when an endpoint is
+#    asked for) answers HTTP requests on a Unix socket or a local TCP port:
+#      /metrics        Prometheus text format
+#      /metrics.json   JSON snapshot
+#  - SnapshotWriter writes the JSON snapshot to a file every interval
+#  Gauges are functions called when a snapshot is taken, for values that are
+#  already counted elsewhere (LineSplitter errors, rotation counters...).
+#
+#  curl --unix-socket /tmp/rotate_screen.sock http://localhost/metrics
+
+### IMPORTS ####################################################################
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from latency import LatencyStats
+
+### Global Constants ###########################################################
+
+# Upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS               = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SNAPSHOT_INTERVAL               = 60    # seconds
+
+### Classes ####################################################################
+
+class Counter:
+    def __init__(self):
+        self.value  = 0
+        self._lock  = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    def __init__(self, function):
+        self.function = function
+
+    def snapshot(self):
+        try:
+            return self.function()
+        except Exception:
+            return None
+
+class Histogram(LatencyStats):
+    # LatencyStats with bucket counts, so the percentiles of long runs can be
+    # estimated without keeping every value
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        LatencyStats.__init__(self)
+        self.buckets    = buckets
+        self.counts     = [0] * (len(buckets) + 1)     # last one is +Inf
+        self._lock      = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            LatencyStats.add(self, latency)
+            self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+
+    def time(self):
+        # with histogram.time(): ...
+        return _Timer(self)
+
+    def quantile(self, fraction):
+        # upper bound of the bucket holding the quantile (max for +Inf)
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count" : self.count,
+                "sum"   : self.total,
+                "max"   : self.max,
+                "last"  : self.last,
+                "p50"   : self.quantile(0.50),
+                "p99"   : self.quantile(0.99),
+                "buckets" : dict(zip([str(bound) for bound in self.buckets]
+                                     + ["+Inf"], self.counts))
+            }
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.add(time.perf_counter() - self.start)
+        return False
+
+class Registry:
+    # Metrics by (name, labels). Asking twice for the same metric returns the
+    # same object, so modules don't have to share references.
+    def __init__(self):
+        self.started    = time.time()
+        self._metrics   = {}
+        self._lock      = threading.Lock()
+
+    def _get(self, name, labels, create):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = create()
+            return metric
+
+    def counter(self, name, **labels):
+        return self._get(name, labels, Counter)
+
+    def histogram(self, name, **labels):
+        return self._get(name, labels, Histogram)
+
+    def gauge(self, name, function, **labels):
+        # replaces the function of an existing gauge (e.g. new serial reader)
+        gauge = self._get(name, labels, lambda: Gauge(function))
+        gauge.function = function
+        return gauge
+
+    def snapshot(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        values = {}
+        for (name, labels), metric in metrics:
+            values.setdefault(name, []).append(
+                {"labels": dict(labels), "value": metric.snapshot()})
+        return {"time": time.time(), "uptime": time.time() - self.started,
+                "metrics": values}
+
+    def prometheusText(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for (name, labels), metric in metrics:
+            if isinstance(metric, Histogram):
+                value = metric.snapshot()
+                cumulative = 0
+                for bound, count in value["buckets"].items():
+                    cumulative += count
+                    lines.append(_line(name + "_bucket",
+                                       labels + (("le", bound),), cumulative))
+                lines.append(_line(name + "_sum", labels, value["sum"]))
+                lines.append(_line(name + "_count", labels, value["count"]))
+            else:
+                value = metric.snapshot()
+                if value is not None:
+                    lines.append(_line(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+class SnapshotWriter:
+    def __init__(self, registry, filename, interval=SNAPSHOT_INTERVAL):
+        self.registry   = registry
+        self.filename   = filename
+        self.interval   = interval
+        self._thread    = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def write(self):
+        # replace the file at once, readers never see half a snapshot
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.registry.snapshot(), file, indent=2)
+        os.replace(temporary, self.filename)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as error:
+                print("Metrics snapshot failed: " + str(error))
+
+### Functions ##################################################################
+
+def _line(name, labels, value):
+    if labels:
+        name += "{" + ",".join(key + '="' + label + '"'
+                               for key, label in labels) + "}"
+    return name + " " + str(value)
+
+REGISTRY = Registry()
+
+def counter(name, **labels):
+    return REGISTRY.counter(name, **labels)
+
+def histogram(name, **labels):
+    return REGISTRY.histogram(name, **labels)
+
+def gauge(name, function, **labels):
+    return REGISTRY.gauge(name, function, **labels)
+
+def startExporters(address=None, snapshot=None, interval=SNAPSHOT_INTERVAL):
+    # address: Unix socket path or TCP port of the HTTP endpoint (None: off)
+    # snapshot: JSON file written every interval seconds (None: off)
+    exporters = []
+    if address is not None:
+        from metrics_server import MetricsServer    # http.server is slow
+        exporters.append(MetricsServer(REGISTRY, address).start())
+        print("Metrics served on " + str(address))
+    if snapshot is not None:
+        exporters.append(SnapshotWriter(REGISTRY, snapshot, interval).start())
+    return exporters
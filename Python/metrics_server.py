@@ -0,0 +1,84 @@
+#  HTTP endpoint of the metrics registry (see metrics.py)
+#  metrics_server.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Imported by metrics.startExporters() only, http.server takes longer to
+#  import than the rest of rotate_screen.py.
+
+### IMPORTS ####################################################################
+
+import os
+import json
+import socket
+import threading
+import socketserver
+import http.server
+
+### Global Constants ###########################################################
+
+METRICS_HOST                    = "127.0.0.1"
+
+### Classes ####################################################################
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == "/metrics":
+            body = registry.prometheusText().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path in ("/", "/metrics.json"):
+            body = json.dumps(registry.snapshot(), indent=2).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address)
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+if hasattr(socket, "AF_UNIX"):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+class MetricsServer:
+    # address: path of a Unix socket, or local TCP port number
+    def __init__(self, registry, address):
+        if isinstance(address, int):
+            self.server = _TCPServer((METRICS_HOST, address), _Handler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)      # left by a previous run
+            self.server = _UnixServer(address, _Handler)
+        self.server.registry = registry
+        self.address = address
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.address, int):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
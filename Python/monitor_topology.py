@@ -0,0 +1,261 @@
+#  Monitor topology: cached snapshot of the connected monitors
+#  monitor_topology.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  The configuration validation (MonitorNumber, [DEVICES]) and the display
+#  backends read the monitors from one TopologySnapshot instead of
+#  enumerating them every time. A snapshot is only taken again:
+#  - on display change events (Win32MonitorTopology: WM_DISPLAYCHANGE,
+#    received by a hidden window, the snapshot is taken in its thread)
+#  - when it is older than the ttl of a topology without events
+#    (XrandrMonitorTopology, or Win32MonitorTopology if the window can't be
+#    created)
+#  - after invalidate()
+#  FakeMonitorTopology serves a given desktop, for tests and benchmarks.
+#  Monitors are numbered from "1" like in the configuration file.
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+import time
+import threading
+
+import metrics
+from layout import MonitorGeometry
+
+### Global Constants ###########################################################
+
+# Interval in seconds between two enumerations of a topology without events
+TOPOLOGY_TTL                    = 5
+
+XRANDR_EXECUTABLE               = "xrandr"
+# xrandr rotations to display64 angles
+XRANDR_ANGLES = {
+    "normal"    : "0",
+    "left"      : "90",
+    "inverted"  : "180",
+    "right"     : "270"
+}
+# DEVMODE display orientations to display64 angles
+DMDO_ANGLES                     = ("0", "90", "180", "270")
+
+WINDOW_CLASS_NAME               = "RotateScreenTopology"
+
+### Classes ####################################################################
+
+class TopologySnapshot:
+    # monitors: {monitor number: MonitorGeometry} (resolution, rotation and
+    #           origin of every monitor)
+    # devices:  {monitor number: device name of the backend}, e.g.
+    #           \\.\DISPLAY1 or HDMI-1
+    # time:     time.monotonic() of the enumeration
+    def __init__(self, monitors, devices):
+        self.monitors   = monitors
+        self.devices    = devices
+        self.time       = time.monotonic()
+
+    def __contains__(self, monitor):
+        return monitor in self.monitors
+
+    def __len__(self):
+        return len(self.monitors)
+
+    def layout(self):
+        # {monitor number: MonitorGeometry} for planLayout()
+        return dict(self.monitors)
+
+class MonitorTopology:
+    # Base class. Subclasses implement enumerate(), and call refresh() from
+    # their event thread if they have one (then ttl is None).
+    def __init__(self, ttl=TOPOLOGY_TTL):
+        topology = type(self).__name__
+        self.ttl            = ttl
+        self.enumerations   = metrics.counter("monitor_enumerations_total",
+                                              topology=topology)
+        self.changes        = metrics.counter("monitor_topology_changes_total",
+                                              topology=topology)
+        self.enumerate_time = metrics.histogram("monitor_enumeration_seconds",
+                                                topology=topology)
+        self._snapshot      = None
+        self._lock          = threading.Lock()
+
+    def snapshot(self):
+        # Current TopologySnapshot, taken again only if it was invalidated or
+        # is older than ttl
+        snapshot = self._snapshot
+        if snapshot is None or (self.ttl is not None
+                                and time.monotonic() - snapshot.time
+                                >= self.ttl):
+            return self.refresh()
+        return snapshot
+
+    def refresh(self):
+        with self._lock:
+            start = time.perf_counter()
+            monitors, devices = self.enumerate()
+            self.enumerations.inc()
+            self.enumerate_time.add(time.perf_counter() - start)
+            old, self._snapshot = self._snapshot, TopologySnapshot(monitors,
+                                                                   devices)
+            snapshot = self._snapshot
+        if old is not None and _keys(old) != _keys(snapshot):
+            self.changes.inc()
+            print("Monitors changed: " + ", ".join(
+                str(geometry) for geometry in snapshot.monitors.values()))
+        return snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def enumerate(self):
+        # ({monitor number: MonitorGeometry}, {monitor number: device name})
+        raise NotImplementedError
+
+class Win32MonitorTopology(MonitorTopology):
+    # Display devices attached to the desktop, numbered like the /device
+    # numbers of display64 (EnumDisplayDevices order, \\.\DISPLAY1 first), so
+    # MonitorNumber and [DEVICES] keep targeting the same screens as with
+    # display64.exe. EnumDisplayMonitors lists the monitors in an order that
+    # Windows doesn't guarantee to be the same.
+    # Taken again in the thread of a hidden window on WM_DISPLAYCHANGE.
+    def __init__(self):
+        import win32api
+        import win32con
+        self.win32api, self.win32con = win32api, win32con
+        MonitorTopology.__init__(self, ttl=None)
+        self._window = threading.Thread(target=self._runWindow, daemon=True)
+        self._window.start()
+
+    def enumerate(self):
+        monitors, devices = {}, {}
+        for device in self._desktopDevices():
+            devmode = self.win32api.EnumDisplaySettings(
+                device, self.win32con.ENUM_CURRENT_SETTINGS)
+            monitor = str(len(monitors) + 1)
+            devices[monitor] = device
+            monitors[monitor] = MonitorGeometry(
+                monitor, DMDO_ANGLES[devmode.DisplayOrientation],
+                devmode.Position_x, devmode.Position_y,
+                devmode.PelsWidth, devmode.PelsHeight)
+        return monitors, devices
+
+    def _desktopDevices(self):
+        # device names of the display devices attached to the desktop
+        index = 0
+        while True:
+            try:
+                device = self.win32api.EnumDisplayDevices(None, index)
+            except self.win32api.error:     # no more devices
+                return
+            index += 1
+            if (device.StateFlags
+                    & self.win32con.DISPLAY_DEVICE_ATTACHED_TO_DESKTOP):
+                yield device.DeviceName
+
+    def _runWindow(self):
+        # WM_DISPLAYCHANGE is only sent to top-level windows: a window that is
+        # never shown, and its message loop
+        try:
+            import win32gui
+            window_class = win32gui.WNDCLASS()
+            window_class.lpszClassName = WINDOW_CLASS_NAME
+            window_class.lpfnWndProc = {
+                self.win32con.WM_DISPLAYCHANGE: self._onDisplayChange
+            }
+            atom = win32gui.RegisterClass(window_class)
+            win32gui.CreateWindow(atom, WINDOW_CLASS_NAME, 0, 0, 0, 0, 0,
+                                  0, 0, 0, None)
+        except Exception as error:
+            print("No display change events (" + str(error) + "), monitors "
+                  "are enumerated every " + str(TOPOLOGY_TTL) + " s")
+            self.ttl = TOPOLOGY_TTL
+            return
+        win32gui.PumpMessages()
+
+    def _onDisplayChange(self, hwnd, message, wparam, lparam):
+        self.refresh()
+        return 0
+
+class XrandrMonitorTopology(MonitorTopology):
+    # Active outputs of xrandr --query, in the order listed. No events,
+    # enumerated again every ttl seconds.
+    def enumerate(self):
+        import subprocess
+        output = subprocess.run([XRANDR_EXECUTABLE, "--query"],
+                                capture_output=True, text=True,
+                                check=True).stdout
+        return parseXrandr(output)
+
+class FakeMonitorTopology(MonitorTopology):
+    # monitors: {monitor number: MonitorGeometry} of the desktop, replaced
+    #           with setMonitors() like a monitor being plugged or unplugged
+    def __init__(self, monitors=None):
+        self.monitors = dict(monitors or {})
+        MonitorTopology.__init__(self, ttl=None)
+
+    def setMonitors(self, monitors):
+        # display change event
+        self.monitors = dict(monitors)
+        self.refresh()
+
+    def enumerate(self):
+        return (dict(self.monitors),
+                {monitor: "FAKE" + monitor for monitor in self.monitors})
+
+### Functions ##################################################################
+
+def _keys(snapshot):
+    return {monitor: geometry.key()
+            for monitor, geometry in snapshot.monitors.items()}
+
+def parseXrandr(output):
+    # "HDMI-1 connected primary 1080x1920+1920+0 left (normal left ...) ..."
+    # -> ({monitor number: MonitorGeometry}, {monitor number: output name})
+    # Connected outputs without a mode (disabled) are left out.
+    monitors, devices = {}, {}
+    for line in output.splitlines():
+        words = line.split()
+        if len(words) < 3 or words[1] != "connected":
+            continue
+        words = [word for word in words[2:] if word != "primary"]
+        try:
+            size, x, y = words[0].split("+")
+            width, height = size.split("x")
+            geometry = (int(x), int(y), int(width), int(height))
+        except ValueError:
+            continue
+        angle = XRANDR_ANGLES.get(words[1] if len(words) > 1 else "", "0")
+        monitor = str(len(monitors) + 1)
+        monitors[monitor] = MonitorGeometry(monitor, angle, *geometry)
+        devices[monitor] = line.split()[0]
+    return monitors, devices
+
+def createTopology():
+    # Topology of this computer, None if the monitors can't be enumerated
+    # (e.g. virtual devices and benchmarks without a display)
+    if sys.platform == "win32":
+        try:
+            return Win32MonitorTopology()
+        except ImportError:
+            return None
+    if os.environ.get("DISPLAY"):
+        import shutil
+        if shutil.which(XRANDR_EXECUTABLE):
+            return XrandrMonitorTopology()
+    return None
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def sharedTopology():
+    # The topology read by the configuration and the display backend,
+    # created on first use
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = [createTopology()]
+        return _shared[0]
@@ -0,0 +1,366 @@
+#  Offline sweep of the orientation detection parameters
+#  parameter_sweep.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Replays recorded accelerometer data through the model of
+#  IMUData::detect in classifier.py for every combination of
+#  SamplingRate, NumberStableSamples, X/YThreshold and ZThreshold, and reports
+#  the detection latency against the false positive rate of each setting.
+#  The best setting is printed as a section for rotate_screen_config.ini.
+#
+#  Recordings are read in chunks of CHUNK_SAMPLES, so their length is only
+#  limited by the disk:
+#  - text: one "x y z [ORIENTATION]" sample per line (tabs, spaces or commas),
+#    e.g. the output of displayAcceleration(). Other lines are ignored.
+#  - binary (.f32, .bin): packed little endian float32 x, y, z
+#  All samples must be recorded at --recording-rate, swept sampling rates must
+#  be multiples of it.
+#
+#  The true orientation comes from the ORIENTATION column if the recording
+#  has one. Otherwise a sample starts a true orientation if the sensor stays
+#  in it for TRUTH_WINDOW_MS with the TRUTH_* thresholds.
+#
+#  python parameter_sweep.py recording.tsv [--recording-rate 10]
+#         [--sampling-rates 10,20,40] [--stable-samples 3,5,10,15]
+#         [--xy-thresholds 0.75,0.8,0.85,0.9] [--z-thresholds 0.75,0.9]
+
+### IMPORTS ####################################################################
+
+import os
+import argparse
+import itertools
+
+import numpy as np
+
+from classifier import (
+    StreamingClassifier, classifySamples, START_ORIENTATION, NO_ORIENTATION
+)
+from framing import ORIENTATION_NAMES
+
+### Global Constants ###########################################################
+
+CHUNK_SAMPLES                   = 1 << 20
+BINARY_EXTENSIONS               = (".f32", ".bin")
+NO_LABEL                        = -1
+
+# Default grid
+RECORDING_RATE_MS               = 10
+SAMPLING_RATES                  = "10,20,30,40"
+STABLE_SAMPLES                  = "3,5,10,15,20"
+XY_THRESHOLDS                   = "0.75,0.80,0.85,0.90"
+Z_THRESHOLDS                    = "0.75,0.90"
+
+# Derived true orientation
+TRUTH_WINDOW_MS                 = 1000
+TRUTH_THRESHOLDS                = (0.90, 0.90, 0.75)
+
+# Selection of the best setting
+MAX_FALSE_POSITIVES_PER_HOUR    = 0
+MAX_MISSED_RATIO                = 0
+LATENCY_PERCENTILE              = 95
+SECTION_NAME                    = "SWEEP"
+
+### Classes ####################################################################
+
+class Setting:
+    # One point of the grid and the changes it detected, as indices of the
+    # recorded samples
+    def __init__(self, sampling_rate, number_stable_samples, xy_threshold,
+                 z_threshold):
+        self.sampling_rate          = sampling_rate
+        self.number_stable_samples  = number_stable_samples
+        self.xy_threshold           = xy_threshold
+        self.z_threshold            = z_threshold
+        self.detections             = []
+        self.classifier             = None
+        self.latencies              = []
+        self.missed                 = 0
+        self.false_positives        = 0
+        self.transitions            = 0
+
+    def thresholds(self):
+        return self.xy_threshold, self.xy_threshold, self.z_threshold
+
+    def configSection(self, name=SECTION_NAME):
+        return ("[" + name + "]\n"
+                + "SamplingRate = " + str(self.sampling_rate) + "\n"
+                + "NumberStableSamples = " + str(self.number_stable_samples)
+                + "\n"
+                + "XThreshold = " + "{:.2f}".format(self.xy_threshold) + "\n"
+                + "YThreshold = " + "{:.2f}".format(self.xy_threshold) + "\n"
+                + "ZThreshold = " + "{:.2f}".format(self.z_threshold) + "\n")
+
+class TrueOrientations:
+    # An orientation is true once the sensor stays in it for window samples.
+    # It starts with its first sample after the last sample of the previous
+    # true orientation, so short bumps don't delay it.
+    def __init__(self, window):
+        self.window         = window
+        self.orientation    = START_ORIENTATION
+        self.position       = 0
+        self._run           = None      # (orientation, start, length)
+        self._first         = {}        # orientation -> first sample
+
+    def feed(self, samples):
+        classes = classifySamples(samples, *TRUTH_THRESHOLDS)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(classes)) + 1))
+        lengths = np.diff(np.append(starts, len(classes)))
+        orientations = classes[starts]
+        starts = starts + self.position
+        if self._run is not None and self._run[0] == orientations[0]:
+            starts[0] = self._run[1]
+            lengths[0] += self._run[2]
+        elif self._run is not None:
+            orientations = np.insert(orientations, 0, self._run[0])
+            starts = np.insert(starts, 0, self._run[1])
+            lengths = np.insert(lengths, 0, self._run[2])
+        # the last run may go on in the next chunk
+        self._run = (orientations[-1], starts[-1], lengths[-1])
+        self.position += len(classes)
+        return self._changes(orientations[:-1], starts[:-1], lengths[:-1])
+
+    def finish(self):
+        run, self._run = self._run, None
+        if run is None:
+            return []
+        return self._changes(*(np.array([value]) for value in run))
+
+    def _changes(self, orientations, starts, lengths):
+        changes = []
+        for orientation, start, length in zip(orientations.tolist(),
+                                              starts.tolist(), lengths.tolist()):
+            if orientation == NO_ORIENTATION:
+                continue
+            if orientation == self.orientation:
+                self._first.clear()
+                continue
+            first = self._first.setdefault(orientation, start)
+            if length >= self.window:
+                self.orientation = orientation
+                self._first.clear()
+                changes.append((first, orientation))
+        return changes
+
+### Functions ##################################################################
+
+def parseList(text, type):
+    return [type(value) for value in text.split(",") if value.strip() != ""]
+
+def readChunks(filename, chunk_samples=CHUNK_SAMPLES):
+    # Yields (samples, labels): float32 array of shape (n, 3) and int8 array
+    # of orientations (NO_LABEL if the recording has none)
+    if os.path.splitext(filename)[1].lower() in BINARY_EXTENSIONS:
+        with open(filename, "rb") as file:
+            while True:
+                values = np.fromfile(file, dtype="<f4", count=3*chunk_samples)
+                samples = values[:len(values) - len(values) % 3].reshape(-1, 3)
+                if not len(samples):
+                    return
+                yield samples, np.full(len(samples), NO_LABEL, dtype=np.int8)
+        return
+    with open(filename) as file:
+        while True:
+            lines = list(itertools.islice(file, chunk_samples))
+            if not lines:
+                return
+            samples = []
+            labels = []
+            for line in lines:
+                values = line.replace(",", " ").split()
+                try:
+                    samples.append([float(value) for value in values[:3]])
+                except ValueError:
+                    continue
+                if len(samples[-1]) != 3:
+                    del samples[-1]
+                    continue
+                label = values[3] if len(values) > 3 else None
+                labels.append(ORIENTATION_NAMES.index(label)
+                              if label in ORIENTATION_NAMES else NO_LABEL)
+            if samples:
+                yield (np.array(samples, dtype=np.float32),
+                       np.array(labels, dtype=np.int8))
+
+def labelTransitions(labels, start, previous):
+    # (index, orientation) where the label changes, previous is the label of
+    # the sample before this chunk
+    changes = np.flatnonzero(np.diff(labels, prepend=previous))
+    return [(start + i, int(labels[i])) for i in changes
+            if labels[i] != NO_LABEL]
+
+def sweepRecording(filename, settings, recording_rate):
+    # Feeds the recording to every setting, returns the true transitions and
+    # the number of samples
+    truth_classifier = TrueOrientations(
+        max(1, round(TRUTH_WINDOW_MS / recording_rate)))
+    truth_labelled = []
+    truth_derived = []
+    previous_label = START_ORIENTATION
+    for setting in settings:
+        setting.classifier = StreamingClassifier(
+            setting.number_stable_samples, *setting.thresholds())
+    # settings sharing a sampling rate and thresholds share the classification
+    groups = {}
+    for setting in settings:
+        key = (setting.sampling_rate, setting.thresholds())
+        groups.setdefault(key, []).append(setting)
+
+    position = 0
+    for samples, labels in readChunks(filename):
+        truth_labelled += labelTransitions(labels, position, previous_label)
+        previous_label = labels[-1]
+        truth_derived += truth_classifier.feed(samples)
+        for (sampling_rate, thresholds), group in groups.items():
+            # one sample out of sampling_rate / recording_rate is kept
+            step = sampling_rate // recording_rate
+            offset = -position % step
+            kept = samples[offset::step]
+            if not len(kept):
+                continue
+            classes = classifySamples(kept, *thresholds)
+            for setting in group:
+                for index, orientation in setting.classifier.feedClasses(
+                        classes):
+                    setting.detections.append((index*step, orientation))
+        position += len(samples)
+    truth_derived += truth_classifier.finish()
+
+    truth = truth_labelled if truth_labelled else truth_derived
+    for setting in settings:
+        evaluate(setting, truth)
+        setting.detections = []
+        setting.classifier = None
+    return truth, position
+
+def evaluate(setting, truth):
+    # Latency: from the start of a true orientation to its detection.
+    # False positive: detection of another orientation than the true one.
+    # Missed: true orientation never detected before the next one.
+    if not setting.detections:
+        setting.missed += len(truth)
+        setting.transitions += len(truth)
+        return
+    detected_at = np.array([index for index, _ in setting.detections])
+    detected = np.array([orientation for _, orientation in setting.detections])
+    starts = np.array([index for index, _ in truth], dtype=np.int64)
+    orientations = np.array([START_ORIENTATION]
+                            + [orientation for _, orientation in truth])
+    true_at_detection = orientations[np.searchsorted(starts, detected_at,
+                                                     side="right")]
+    setting.false_positives += int(np.count_nonzero(
+        detected != true_at_detection))
+
+    for j, (start, orientation) in enumerate(truth):
+        end = truth[j+1][0] if j + 1 < len(truth) else np.inf
+        i = np.searchsorted(detected_at, start)
+        # orientation already detected (state before the true change)
+        if i > 0 and detected[i-1] == orientation:
+            setting.latencies.append(0)
+            continue
+        matches = np.flatnonzero((detected_at[i:] < end)
+                                 & (detected[i:] == orientation))
+        if len(matches):
+            setting.latencies.append(int(detected_at[i + matches[0]] - start))
+        else:
+            setting.missed += 1
+    setting.transitions += len(truth)
+
+def summary(setting, recording_rate, hours):
+    latencies = np.array(setting.latencies, dtype=np.float64) * recording_rate
+    return {
+        "mean_ms"       : latencies.mean() if len(latencies) else np.inf,
+        "percentile_ms" : (np.percentile(latencies, LATENCY_PERCENTILE)
+                           if len(latencies) else np.inf),
+        "missed"        : setting.missed,
+        "missed_ratio"  : setting.missed / max(setting.transitions, 1),
+        "fp_per_hour"   : setting.false_positives / hours if hours else 0
+    }
+
+def bestSetting(results, max_false_positives, max_missed):
+    # Fastest setting within the limits, or the one closest to them
+    within = [(setting, result) for setting, result in results
+              if result["fp_per_hour"] <= max_false_positives
+              and result["missed_ratio"] <= max_missed]
+    if within:
+        return min(within, key=lambda r: (r[1]["percentile_ms"],
+                                          r[1]["mean_ms"]))
+    return min(results, key=lambda r: (r[1]["fp_per_hour"],
+                                       r[1]["missed_ratio"],
+                                       r[1]["percentile_ms"]))
+
+def printTable(results, rows):
+    print("{:>6}{:>8}{:>7}{:>7}{:>11}{:>11}{:>8}{:>9}".format(
+        "rate", "stable", "xy", "z", "mean ms",
+        "p" + str(LATENCY_PERCENTILE) + " ms", "missed", "fp/h"))
+    for setting, result in results[:rows]:
+        print("{:>6}{:>8}{:>7.2f}{:>7.2f}{:>11.1f}{:>11.1f}{:>8}{:>9.2f}"
+              .format(setting.sampling_rate, setting.number_stable_samples,
+                      setting.xy_threshold, setting.z_threshold,
+                      result["mean_ms"], result["percentile_ms"],
+                      result["missed"], result["fp_per_hour"]))
+
+### Main function ##############################################################
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recordings", nargs="+")
+    parser.add_argument("--recording-rate", type=int, default=RECORDING_RATE_MS,
+                        help="interval between recorded samples in ms")
+    parser.add_argument("--sampling-rates", default=SAMPLING_RATES)
+    parser.add_argument("--stable-samples", default=STABLE_SAMPLES)
+    parser.add_argument("--xy-thresholds", default=XY_THRESHOLDS)
+    parser.add_argument("--z-thresholds", default=Z_THRESHOLDS)
+    parser.add_argument("--max-false-positives", type=float,
+                        default=MAX_FALSE_POSITIVES_PER_HOUR,
+                        help="per hour, for the best setting")
+    parser.add_argument("--max-missed", type=float, default=MAX_MISSED_RATIO,
+                        help="ratio of true orientations, for the best setting")
+    parser.add_argument("--section", default=SECTION_NAME)
+    parser.add_argument("--rows", type=int, default=20)
+    args = parser.parse_args()
+
+    sampling_rates = parseList(args.sampling_rates, int)
+    for sampling_rate in sampling_rates:
+        if sampling_rate % args.recording_rate:
+            parser.error("sampling rates must be multiples of the recording "
+                         "rate (" + str(args.recording_rate) + " ms)")
+    settings = [Setting(*values) for values in itertools.product(
+        sampling_rates, parseList(args.stable_samples, int),
+        parseList(args.xy_thresholds, float),
+        parseList(args.z_thresholds, float))]
+
+    samples = 0
+    transitions = 0
+    for filename in args.recordings:
+        truth, length = sweepRecording(filename, settings, args.recording_rate)
+        print(filename + ": " + str(length) + " samples, "
+              + str(len(truth)) + " orientation changes")
+        samples += length
+        transitions += len(truth)
+    hours = samples * args.recording_rate / 3600000
+
+    results = [(setting, summary(setting, args.recording_rate, hours))
+               for setting in settings]
+    results.sort(key=lambda r: (r[1]["fp_per_hour"], r[1]["missed_ratio"],
+                                r[1]["percentile_ms"]))
+    print()
+    printTable(results, args.rows)
+
+    setting, result = bestSetting(results, args.max_false_positives,
+                                  args.max_missed)
+    print()
+    print("; best of " + str(len(settings)) + " settings over "
+          + "{:.2f}".format(hours) + " h: p" + str(LATENCY_PERCENTILE)
+          + " latency " + "{:.0f} ms".format(result["percentile_ms"]) + ", "
+          + "{:.2f}".format(result["fp_per_hour"]) + " false positives per "
+          + "hour, " + str(result["missed"]) + "/" + str(transitions)
+          + " missed")
+    print(setting.configSection(args.section))
+
+################################################################################
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,158 @@
+#  Serial port presence: attach and detach events for the engine
+#  port_watch.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Two backends:
+#  - InotifyPortWatcher (Linux): blocks on inotify events of /dev and only
+#    enumerates the ports when a tty node is created or deleted.
+#  - PollingPortWatcher (fallback, Windows): enumerates the ports every ttl
+#    seconds. Calls to ports() in between are served from the cache. There
+#    is no event on Windows: a port is found missing up to ttl seconds after
+#    it was unplugged.
+#  Events are put in the notify queue given to the watcher as PortEvent objects.
+#  They are dated from when the port changed as far as the watcher can tell:
+#  the inotify event, or the last enumeration that still saw the old ports
+#  when polling. The detach and attach latencies include the polling delay.
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+import time
+import struct
+import threading
+
+import metrics
+
+### Global Constants ###########################################################
+
+PORT_ATTACHED                   = "attached"
+PORT_DETACHED                   = "detached"
+
+# Interval in seconds
+PORT_CACHE_TTL                  = 1
+
+INOTIFY_DIRECTORY               = b"/dev"
+INOTIFY_PREFIX                  = b"tty"
+IN_CREATE                       = 0x00000100
+IN_DELETE                       = 0x00000200
+IN_CLOEXEC                      = 0o2000000
+INOTIFY_EVENT                   = struct.Struct("iIII")
+
+### Classes ####################################################################
+
+class PortEvent:
+    # time: time.perf_counter() of the change (see PortWatcher.refresh())
+    def __init__(self, kind, port, time):
+        self.kind = kind
+        self.port = port
+        self.time = time
+
+    def __str__(self):
+        return "Port " + self.port + " " + self.kind
+
+class PortWatcher:
+    # Base class. list_ports returns the current list of Arduino ports,
+    # subclasses call refresh() whenever the ports may have changed.
+    def __init__(self, list_ports, notify):
+        self.list_ports     = list_ports
+        self.notify         = notify
+        # port change to detected, attach to reconnected (filled by the
+        # engine, async_engine.py)
+        self.detach_latency = metrics.histogram("port_detach_seconds")
+        self.attach_latency = metrics.histogram("port_attach_seconds")
+        self._ports         = list(list_ports())
+        self._updated       = time.monotonic()
+        # time.perf_counter() of the last enumeration
+        self._seen          = time.perf_counter()
+        self._lock          = threading.Lock()
+        self._thread        = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def ports(self):
+        with self._lock:
+            return list(self._ports)
+
+    def refresh(self, changed=None):
+        # changed: time.perf_counter() of the OS event that reported a change,
+        # None when polling: the change happened after the last enumeration
+        new_ports = list(self.list_ports())
+        with self._lock:
+            old_ports, self._ports = self._ports, new_ports
+            self._updated = time.monotonic()
+            if changed is None:
+                changed = self._seen
+            self._seen = time.perf_counter()
+        for port in old_ports:
+            if port not in new_ports:
+                self.notify.put(PortEvent(PORT_DETACHED, port, changed))
+        for port in new_ports:
+            if port not in old_ports:
+                self.notify.put(PortEvent(PORT_ATTACHED, port, changed))
+
+    def _run(self):
+        raise NotImplementedError
+
+class PollingPortWatcher(PortWatcher):
+    def __init__(self, list_ports, notify, ttl=PORT_CACHE_TTL):
+        self.ttl = ttl
+        PortWatcher.__init__(self, list_ports, notify)
+
+    def ports(self):
+        with self._lock:
+            expired = time.monotonic() - self._updated >= self.ttl
+        if expired:
+            self.refresh()
+        return PortWatcher.ports(self)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                remaining = self._updated + self.ttl - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                self.refresh()
+
+class InotifyPortWatcher(PortWatcher):
+    def __init__(self, list_ports, notify):
+        import ctypes.util              # starts subprocess, Linux only
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0 or libc.inotify_add_watch(
+                self._fd, INOTIFY_DIRECTORY, IN_CREATE | IN_DELETE) < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        PortWatcher.__init__(self, list_ports, notify)
+
+    def _run(self):
+        while True:
+            # blocks until a file is created or deleted in /dev
+            events = os.read(self._fd, 4096)
+            received = time.perf_counter()
+            offset = 0
+            changed = False
+            while offset < len(events):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(events, offset)
+                offset += INOTIFY_EVENT.size
+                name = events[offset:offset+length]
+                offset += length
+                if name.startswith(INOTIFY_PREFIX):
+                    changed = True
+            if changed:
+                self.refresh(received)
+
+### Functions ##################################################################
+
+def createPortWatcher(list_ports, notify):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyPortWatcher(list_ports, notify).start()
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingPortWatcher(list_ports, notify).start()
@@ -0,0 +1,472 @@
+#  Gyroscope-assisted prediction of the next orientation
+#  prediction.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  With Prediction = gyro (and Classification = host), the Arduino adds the
+#  angular rate of the LSM6DS3 gyroscope to every raw sample. The rate is
+#  integrated while it exceeds PREDICTION_RATE_THRESHOLD. Once the rotation
+#  reaches PREDICTION_ANGLE, the acceleration at the start of the movement is
+#  turned by the nearest quarter turn (at least one) around the same axis,
+#  which predicts the next orientation:
+#  - the display request of the prediction is staged on the display backend
+#    (display_backend.py), nothing changes on the screen yet
+#  - it is committed once PREDICTION_CONFIRM_SAMPLES samples in a row give
+#    the predicted orientation and the turn has ended: the rate stayed under
+#    PREDICTION_RATE_THRESHOLD for PREDICTION_SETTLE_SAMPLES samples, or the
+#    rotation already reached PREDICTION_COMMIT_ANGLE. Samples of a wobble
+#    give the predicted orientation too at the top of the wobble, so a commit
+#    on PREDICTION_CONFIRM_SAMPLES alone made 4 to 7 times more false
+#    rotations than the classifier
+#  - it is rolled back if the samples go back to the old orientation, if the
+#    classifier decides another orientation or after PREDICTION_TIMEOUT
+#  A committed orientation that the classifier doesn't decide within
+#  PREDICTION_TIMEOUT (e.g. the monitor was only tilted and came back) is
+#  reverted: the screen goes back to the old orientation, which counts as a
+#  false rotation.
+#
+#  python prediction.py RECORDING [--device N] replays a recording of
+#  recorder.py made with angular rates, or --synthetic ROTATIONS random turns
+#  and wobbles, through the classifier alone and with prediction, and prints
+#  the median latency from the start of the movement to the screen change and
+#  the false rotations per hour of both.
+
+### IMPORTS ####################################################################
+
+import math
+import random
+import argparse
+
+import numpy as np
+
+import metrics
+from classifier import (
+    StreamingClassifier, classifySamples, X_POS, X_NEG, Y_POS, Y_NEG, FLAT,
+    START_ORIENTATION
+)
+from framing import ORIENTATION_NAMES
+
+### Global Constants ###########################################################
+
+# Angular rates in degrees per second, angles in degrees, times in seconds
+PREDICTION_RATE_THRESHOLD       = 60
+PREDICTION_ANGLE                = 45
+PREDICTION_CONFIRM_SAMPLES      = 3
+# the turn has ended after this many samples under PREDICTION_RATE_THRESHOLD,
+# or once the rotation is this close to a quarter turn
+PREDICTION_SETTLE_SAMPLES       = 5
+PREDICTION_COMMIT_ANGLE         = 80
+PREDICTION_TIMEOUT              = 1.0
+# the rotation integrated so far is forgotten after this much time at rest
+PREDICTION_QUIET_TIME           = 0.25
+
+# Default values of rotate_screen_config.ini
+SAMPLING_RATE_MS                = 20
+NUMBER_STABLE_SAMPLES           = 10
+THRESHOLDS                      = (0.90, 0.90, 0.75)
+
+# Synthetic recordings: turns of a monitor around the z axis between the
+# orientations of the desk, and wobbles that come back
+SYNTHETIC_START                 = (1.0, 0.0, 0.0)
+SYNTHETIC_TURN_TIME             = (0.5, 1.2)
+SYNTHETIC_WOBBLE_TIME           = (0.4, 1.0)
+SYNTHETIC_WOBBLE_ANGLE          = (20, 80)
+SYNTHETIC_WOBBLE_RATIO          = 0.3
+SYNTHETIC_REST_TIME             = (1.0, 4.0)
+SYNTHETIC_ACCELERATION_NOISE    = 0.02  # G
+SYNTHETIC_RATE_NOISE            = 2.0   # degrees per second
+
+# Predictor states
+IDLE                            = "idle"
+STAGED                          = "staged"
+COMMITTED                       = "committed"
+
+### Metrics ####################################################################
+# events of every predictor, see PredictiveClassifier.counts
+PREDICTION_EVENTS = ("stages", "commits", "confirmed", "rollbacks",
+                     "false_rotations")
+prediction_counters = {event: metrics.counter("prediction_" + event + "_total")
+                       for event in PREDICTION_EVENTS}
+
+### Classes ####################################################################
+
+class PredictiveClassifier:
+    # StreamingClassifier with gyroscope prediction. feed() and feedBytes()
+    # take the angular rates of the samples as well and return the decisions
+    # of the classifier, the commits and the reverts in sample order.
+    # classifier:       StreamingClassifier of the raw samples
+    # sampling_rate_ms: time between two samples
+    # stager:           object with stage(orientation index) and rollback(),
+    #                   e.g. DisplayStager (display_backend.py), or None
+    def __init__(self, classifier, sampling_rate_ms, stager=None):
+        self.classifier     = classifier
+        self.stager         = stager
+        self.period         = sampling_rate_ms / 1000
+        self.timeout        = max(int(math.ceil(PREDICTION_TIMEOUT
+                                                / self.period)), 1)
+        self.quiet          = max(int(math.ceil(PREDICTION_QUIET_TIME
+                                                / self.period)), 1)
+        # orientation the screen shows, as far as the predictor knows
+        self.orientation    = classifier.orientation
+        self.state          = IDLE
+        self.target         = None      # staged or committed orientation
+        self.counts         = {event: 0 for event in PREDICTION_EVENTS}
+        self._reset()
+        self._previous      = None      # last sample
+        self._still         = 0         # samples at rest
+
+    def _reset(self):
+        self._angle         = [0.0, 0.0, 0.0]   # integrated rotation
+        self._start         = None      # sample before the movement
+        self._elapsed       = 0         # samples since staged or committed
+        self._agree         = 0         # samples in a row at target
+        self._disagree      = 0         # samples in a row at orientation
+
+    def _count(self, event):
+        self.counts[event] += 1
+        prediction_counters[event].inc()
+
+    def feed(self, samples, rates=None):
+        # samples, rates: float32 arrays of shape (n, 3). Returns the list of
+        # (sample index, orientation) like StreamingClassifier.feed().
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1, 3)
+        position = self.classifier.position
+        decisions = self.classifier.feed(samples)
+        if rates is not None:
+            rates = np.asarray(rates, dtype=np.float32).reshape(-1, 3)
+        if rates is None or len(rates) != len(samples):
+            # no angular rate: the decisions of the classifier only
+            for _, orientation in decisions:
+                self._decided(orientation)
+            return decisions
+        classes = classifySamples(samples, *self.classifier.thresholds)
+        changes = []
+        d = 0
+        for i, (sample, rate, sample_class) in enumerate(zip(
+                samples.tolist(), rates.tolist(), classes.tolist())):
+            orientation = self._step(sample, rate, sample_class)
+            if orientation is not None:
+                changes.append((position + i, orientation))
+            while d < len(decisions) and decisions[d][0] <= position + i:
+                self._decided(decisions[d][1])
+                changes.append(decisions[d])
+                d += 1
+        return changes + decisions[d:]
+
+    def feedBytes(self, samples, rates=b""):
+        # Same as feed() for packed float32 x, y, z values. Returns the names
+        # of the orientations decided.
+        changes = self.feed(np.frombuffer(samples, dtype="<f4"),
+                            np.frombuffer(rates, dtype="<f4") if rates
+                            else None)
+        return [ORIENTATION_NAMES[orientation] for _, orientation in changes]
+
+    def _step(self, sample, rate, sample_class):
+        # One sample. Returns the orientation to show now, or None.
+        previous, self._previous = self._previous, sample
+        speed = math.sqrt(rate[0]*rate[0] + rate[1]*rate[1] + rate[2]*rate[2])
+        if speed >= PREDICTION_RATE_THRESHOLD:
+            if self._start is None:
+                self._start = previous or sample
+            self._angle = [angle + value*self.period
+                           for angle, value in zip(self._angle, rate)]
+            self._still = 0
+        else:
+            self._still += 1
+            if self._still >= self.quiet and self.state == IDLE:
+                self._reset()
+
+        if self._start is not None and self.state != COMMITTED:
+            target = self._predict()
+            if target is not None and target != self.target:
+                if target == self.orientation:
+                    self._rollback()
+                else:
+                    self._stage(target)
+
+        if self.state == IDLE:
+            return None
+        self._elapsed += 1
+        self._agree = self._agree + 1 if sample_class == self.target else 0
+        self._disagree = (self._disagree + 1
+                          if sample_class == self.orientation else 0)
+        if self.state == STAGED:
+            if (self._agree >= PREDICTION_CONFIRM_SAMPLES
+                    and (self._still >= PREDICTION_SETTLE_SAMPLES
+                         or self._turned() >= PREDICTION_COMMIT_ANGLE)):
+                # the accelerometer confirms the prediction
+                self.state = COMMITTED
+                self._elapsed = 0
+                self._count("commits")
+                return self.target
+            if (self._disagree >= PREDICTION_CONFIRM_SAMPLES
+                    or self._elapsed >= self.timeout):
+                self._rollback()
+            return None
+        # COMMITTED, the classifier didn't decide it (yet)
+        if (self._disagree >= PREDICTION_CONFIRM_SAMPLES
+                or self._elapsed >= self.timeout):
+            self._count("false_rotations")
+            self.state, self.target = IDLE, None
+            self._reset()
+            return self.orientation
+        return None
+
+    def _turned(self):
+        return math.sqrt(sum(value*value for value in self._angle))
+
+    def _predict(self):
+        # Orientation after the rotation integrated so far, None below
+        # PREDICTION_ANGLE
+        angle = self._turned()
+        if angle < PREDICTION_ANGLE:
+            return None
+        axis = [value / angle for value in self._angle]
+        quarters = max(int(angle / 90 + 0.5), 1)
+        # the gravity seen by the sensor turns the other way
+        return dominantOrientation(rotate(self._start, axis, -90*quarters))
+
+    def _stage(self, target):
+        self.state, self.target = STAGED, target
+        self._elapsed = self._agree = self._disagree = 0
+        self._count("stages")
+        if self.stager is not None:
+            self.stager.stage(target)
+
+    def _rollback(self):
+        if self.state == STAGED:
+            self._count("rollbacks")
+            if self.stager is not None:
+                self.stager.rollback()
+        self.state, self.target = IDLE, None
+        self._reset()
+
+    def _decided(self, orientation):
+        # decision of the classifier, shown on the screen
+        if self.state == COMMITTED and orientation == self.target:
+            self._count("confirmed")
+        elif self.state == COMMITTED:
+            self._count("false_rotations")
+        elif self.state == STAGED and orientation == self.target:
+            # confirmed by the classifier first, applying commits it
+            self._count("confirmed")
+        elif self.state == STAGED:
+            self._rollback()
+        self.state, self.target = IDLE, None
+        self._reset()
+        self.orientation = orientation
+
+### Functions ##################################################################
+
+def rotate(vector, axis, angle):
+    # vector turned by angle (degrees) around the unit vector axis (Rodrigues)
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    x, y, z = vector
+    a, b, c = axis
+    dot = a*x + b*y + c*z
+    cross = (b*z - c*y, c*x - a*z, a*y - b*x)
+    return tuple(v*cos + w*sin + k*dot*(1 - cos)
+                 for v, w, k in zip(vector, cross, axis))
+
+def dominantOrientation(acceleration):
+    # orientation of the axis closest to the acceleration
+    x, y, z = (abs(value) for value in acceleration)
+    if x >= y and x >= z:
+        return X_POS if acceleration[0] > 0 else X_NEG
+    if y >= z:
+        return Y_POS if acceleration[1] > 0 else Y_NEG
+    return FLAT
+
+def turnAxis(start, target):
+    # Unit axis turning the acceleration start to target by a positive angle,
+    # and the angle (degrees)
+    cross = (start[1]*target[2] - start[2]*target[1],
+             start[2]*target[0] - start[0]*target[2],
+             start[0]*target[1] - start[1]*target[0])
+    dot = sum(s*t for s, t in zip(start, target))
+    norm = math.sqrt(sum(value*value for value in cross))
+    if norm < 1e-9:
+        # opposite orientations: any axis perpendicular to start
+        other = (0.0, 0.0, 1.0) if abs(start[2]) < 0.9 else (1.0, 0.0, 0.0)
+        return turnAxis(start, other)[0], (180.0 if dot < 0 else 0.0)
+    return (tuple(value / norm for value in cross),
+            math.degrees(math.atan2(norm, dot)))
+
+def motionAt(start, axis, angle, duration, t, back=False):
+    # (acceleration, angular rate) of the sensor t seconds into a smooth
+    # movement of duration that turns the acceleration start by angle around
+    # axis (turnAxis), and turns it back if back. The angular rate of the
+    # sensor is opposite to the rotation of the acceleration it measures.
+    t = min(max(t, 0), duration)
+    phase = (2 if back else 1) * math.pi * t / duration
+    turned = angle * (1 - math.cos(phase)) / 2
+    rate = angle * (2 if back else 1) * math.pi / duration * math.sin(phase)/2
+    return rotate(start, axis, turned), tuple(-rate*value for value in axis)
+
+def syntheticMotion(rotations, sampling_rate_ms=SAMPLING_RATE_MS, seed=0):
+    # Random turns and wobbles of a monitor with noise. Returns samples and
+    # rates (float32 arrays of shape (n, 3)) and the movements as
+    # (index of the first sample, orientation at the end).
+    rng = random.Random(seed)
+    period = sampling_rate_ms / 1000
+    samples, rates, movements = [], [], []
+    acceleration = SYNTHETIC_START
+
+    def still(duration):
+        for _ in range(int(duration / period)):
+            samples.append(acceleration)
+            rates.append((0.0, 0.0, 0.0))
+
+    def move(axis, angle, duration, back):
+        movements.append((len(samples), None))
+        for i in range(1, int(duration / period) + 1):
+            sample, rate = motionAt(acceleration, axis, angle, duration,
+                                    i*period, back)
+            samples.append(sample)
+            rates.append(rate)
+
+    still(rng.uniform(*SYNTHETIC_REST_TIME))
+    while len(movements) < rotations:
+        axis = (0.0, 0.0, rng.choice((-1.0, 1.0)))
+        if rng.random() < SYNTHETIC_WOBBLE_RATIO:
+            move(axis, rng.uniform(*SYNTHETIC_WOBBLE_ANGLE),
+                 rng.uniform(*SYNTHETIC_WOBBLE_TIME), True)
+        else:
+            move(axis, 90, rng.uniform(*SYNTHETIC_TURN_TIME), False)
+            acceleration = samples[-1]
+        movements[-1] = (movements[-1][0], dominantOrientation(acceleration))
+        still(rng.uniform(*SYNTHETIC_REST_TIME))
+    np_rng = np.random.default_rng(seed)
+    samples = np.asarray(samples, dtype=np.float32)
+    rates = np.asarray(rates, dtype=np.float32)
+    samples += np_rng.normal(0, SYNTHETIC_ACCELERATION_NOISE,
+                             samples.shape).astype(np.float32)
+    rates += np_rng.normal(0, SYNTHETIC_RATE_NOISE,
+                           rates.shape).astype(np.float32)
+    return samples, rates, movements
+
+def recordedMovements(rates, decisions, number_stable_samples):
+    # Movements of a recording, from the decisions of the classifier: the
+    # last burst of angular rate that starts before the window of each
+    # decision (the decision itself if there is none)
+    speed = np.sqrt((rates.astype(np.float64)**2).sum(axis=1))
+    moving = speed >= PREDICTION_RATE_THRESHOLD
+    starts = np.flatnonzero(moving & ~np.concatenate(([False], moving[:-1])))
+    movements = []
+    previous = 0
+    for index, orientation in decisions:
+        window = index - number_stable_samples
+        candidates = starts[(starts >= previous) & (starts <= window)]
+        movements.append((int(candidates[-1]) if len(candidates) else index,
+                          orientation))
+        previous = index + 1
+    return movements
+
+def screenChanges(changes, orientation):
+    # changes of the orientation shown, repeats removed
+    shown = []
+    for index, new in changes:
+        if new != orientation:
+            shown.append((index, new))
+            orientation = new
+    return shown
+
+def evaluate(shown, movements, start, period, samples):
+    # Latencies (seconds) of the movements that change the orientation and
+    # number of screen changes to an orientation the sensor didn't end in
+    latencies = []
+    truth, m = start, 0
+    false_rotations = 0
+    for index, orientation in shown:
+        while m < len(movements) and movements[m][0] <= index:
+            truth, m = movements[m][1], m + 1
+        if orientation != truth:
+            false_rotations += 1
+    before = start
+    for m, (onset, orientation) in enumerate(movements):
+        end = movements[m+1][0] if m + 1 < len(movements) else samples
+        if orientation != before:
+            match = [index for index, new in shown
+                     if onset <= index < end and new == orientation]
+            if match:
+                latencies.append((match[0] - onset) * period)
+        before = orientation
+    return latencies, false_rotations
+
+def compare(samples, rates, movements, sampling_rate_ms, number_stable_samples,
+            thresholds, start=START_ORIENTATION):
+    # Prints the latency and false rotations with and without prediction
+    period = sampling_rate_ms / 1000
+    baseline = StreamingClassifier(number_stable_samples, *thresholds,
+                                   orientation=start)
+    predictive = PredictiveClassifier(
+        StreamingClassifier(number_stable_samples, *thresholds,
+                            orientation=start), sampling_rate_ms)
+    decisions = baseline.feed(samples)
+    if movements is None:
+        movements = recordedMovements(rates, decisions,
+                                      number_stable_samples)
+    hours = len(samples) * period / 3600
+    rotations = 0
+    before = start
+    for _, orientation in movements:
+        rotations += orientation != before
+        before = orientation
+    print("{} samples ({:.1f} min at {} ms), {} rotations".format(
+        len(samples), 60*hours, sampling_rate_ms, rotations))
+    print("{:<18}{:>12}{:>12}{:>10}{:>10}{:>12}".format(
+        "", "median ms", "p90 ms", "missed", "false", "false/hour"))
+    for name, changes in (("classifier", decisions),
+                          ("gyro prediction",
+                           predictive.feed(samples, rates))):
+        latencies, false_rotations = evaluate(
+            screenChanges(changes, start), movements, start, period,
+            len(samples))
+        latencies.sort()
+        middle = (1000*latencies[len(latencies) // 2] if latencies
+                  else float("nan"))
+        p90 = (1000*latencies[min(int(0.9*len(latencies)),
+                                  len(latencies) - 1)]
+               if latencies else float("nan"))
+        print("{:<18}{:>12.0f}{:>12.0f}{:>10}{:>10}{:>12.1f}".format(
+            name, middle, p90, rotations - len(latencies), false_rotations,
+            false_rotations / hours if hours else 0))
+    print("Prediction: " + ", ".join(
+        event + " " + str(count) for event, count in
+        predictive.counts.items()))
+
+################################################################################
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("recording", nargs="?",
+                        help="recording of recorder.py with angular rates")
+    source.add_argument("--synthetic", type=int, metavar="MOVEMENTS",
+                        help="random turns and wobbles instead")
+    parser.add_argument("--device", type=int, default=0,
+                        help="device of the recording")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sampling-rate", type=int, default=SAMPLING_RATE_MS,
+                        help="SamplingRate of the recording (ms)")
+    parser.add_argument("--stable-samples", type=int,
+                        default=NUMBER_STABLE_SAMPLES)
+    parser.add_argument("--thresholds", type=float, nargs=3,
+                        default=THRESHOLDS, metavar=("X", "Y", "Z"))
+    args = parser.parse_args()
+    if args.synthetic is not None:
+        samples, rates, movements = syntheticMotion(
+            args.synthetic, args.sampling_rate, args.seed)
+        start = dominantOrientation(samples[0].tolist())
+    else:
+        from recorder import loadRecording, recordedMotion
+        samples, rates = recordedMotion(loadRecording(args.recording),
+                                        args.device)
+        if len(samples) == 0:
+            parser.error("no sample with an angular rate in "
+                         + args.recording)
+        movements, start = None, START_ORIENTATION
+    compare(samples, rates, movements, args.sampling_rate,
+            args.stable_samples, args.thresholds, start)
@@ -0,0 +1,268 @@
+#  Serial protocol shared with the Arduino (see Arduino/include/Orientation.h)
+#  protocol.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import re
+import time
+import struct
+
+from framing import (
+    FRAME_SYNC, FRAME_ORIENTATION, FRAME_SAMPLE, FRAME_MOTION,
+    ORIENTATION_NAMES, SAMPLE_PAYLOAD, MOTION_PAYLOAD, BINARY_TOKEN,
+    BINARY_BAUD_RATE, decodeFrame, heartbeatFrame
+)
+
+### Global Constants ###########################################################
+
+BAUD_RATE                       = 9600
+# Agree on binary framing (framing.py) and BINARY_BAUD_RATE with Arduinos
+# that support it. Set to False to always use the text protocol.
+BINARY_PROTOCOL                 = True
+
+# Ready and confirmation and connected messages
+# must be the same in Arduino and Python
+
+# Interval are in seconds
+
+READY_MESSAGE                   = "Ready"
+CONFIRMATION_MESSAGE            = "Confirmation"
+CONNECTED_MESSAGE               = "Connected"
+# "Config <rate> <stable samples> <x> <y> <z>": new parameters while running
+# (text protocol, FRAME_CONFIG with binary framing)
+CONFIG_MESSAGE                  = "Config"
+READY_MESSAGE_INTERVAL          = 0.3
+CHECK_CONNECTION_INTERVAL       = 1
+
+COMMAND_START                   = "<"
+COMMAND_END                     = ">"
+
+# Token of the ready and confirmation messages to stream raw acceleration
+# samples instead of orientations (host classification, see classifier.py)
+RAW_TOKEN                       = "RAW"
+SAMPLE_SEPARATOR                = b"\t"
+# Token of the ready and confirmation messages to add the angular rate to the
+# raw samples (gyroscope, see prediction.py)
+GYRO_TOKEN                      = "GYRO"
+
+# <CMD> line of every orientation, and the orientation index
+# (ORIENTATION_NAMES) of the bytes received, so commands are never decoded
+COMMAND_LINES = tuple(COMMAND_START + name + COMMAND_END
+                      for name in ORIENTATION_NAMES)
+# (with the line ending of println(), other trailing spaces are stripped
+# first)
+COMMAND_BYTES = {(line + end).encode(): index
+                 for index, line in enumerate(COMMAND_LINES)
+                 for end in ("", "\n", "\r\n")}
+# Text line with its "\n", or the text before a binary frame
+TEXT_LINE                       = re.compile(rb"[^\n]*\n|[^\n]+\Z")
+
+### Classes ####################################################################
+
+class LinkMode:
+    # What was agreed on during the last Ready/Confirmation handshake
+    def __init__(self, binary=False, raw_samples=False, gyro=False):
+        self.binary         = binary
+        self.raw_samples    = raw_samples
+        self.gyro           = gyro
+        # time.monotonic() of the confirmation message (see isStaleReady)
+        self.confirmed      = None
+
+class LineSplitter:
+    # Splits the serial byte stream into lines. The arrival time of a line is
+    # the time at which the chunk holding its first byte was read.
+    # Commands (<CMD> lines and binary orientation frames) are returned as
+    # the index of their orientation in ORIENTATION_NAMES (int), so the rest
+    # of the program doesn't depend on the link mode and maps them to its
+    # display requests by index (see isCommand).
+    # Raw acceleration samples (frames or "x\ty\tz" lines) are packed as
+    # float32 and collected with takeSamples(), the angular rates of the
+    # samples that have one ("x\ty\tz\tgx\tgy\tgz" lines or motion frames)
+    # with takeRates().
+    # Each chunk is appended to one buffer and parsed in place (memoryview,
+    # text lines are matched within the buffer by offsets, only the lines
+    # themselves are created), what was parsed is removed once per chunk.
+    def __init__(self):
+        self._buffer        = bytearray()
+        self._samples       = bytearray()
+        self._rates         = bytearray()
+        self._samples_start = None
+        self._line_start    = None
+        self._last_seq      = None
+        self.crc_errors     = 0
+        self.lost_frames    = 0
+
+    def reset(self):
+        self._buffer.clear()
+        self._samples.clear()
+        self._rates.clear()
+        self._line_start = None
+        self._last_seq = None
+
+    def feed(self, chunk, now):
+        # Returns the list of (line, arrival) completed by chunk.
+        # Empty lines are ignored.
+        lines = []
+        buffer = self._buffer
+        if not buffer:
+            self._line_start = now
+        buffer += chunk
+        position, size = 0, len(buffer)
+        with memoryview(buffer) as view:
+            while position < size:
+                if buffer[position] == FRAME_SYNC:
+                    frame, length = decodeFrame(view, position)
+                    if length == 0:     # incomplete frame
+                        break
+                    position += length
+                    if frame is None:
+                        self.crc_errors += 1
+                        continue
+                    line = self._frameLine(frame)
+                    if line != "":
+                        lines.append((line, self._line_start))
+                    self._line_start = now
+                    continue
+                # text up to the last complete line, or up to the next frame
+                end = buffer.find(FRAME_SYNC, position)
+                if end < 0:
+                    end = buffer.rfind(b"\n", position) + 1
+                    if end == 0:        # incomplete line
+                        break
+                command = COMMAND_BYTES.get
+                for line in TEXT_LINE.findall(buffer, position, end):
+                    line = command(line, line)
+                    if type(line) is bytes:     # not exactly a command
+                        line = self._textLine(line)
+                    if line != "":
+                        lines.append((line, self._line_start))
+                    self._line_start = now
+                position = end
+        del buffer[:position]
+        return lines
+
+    def takeSamples(self):
+        # Returns (samples, arrival) where samples holds the float32 x, y, z
+        # values received since the last call, or (b"", None)
+        samples, arrival = bytes(self._samples), self._samples_start
+        self._samples.clear()
+        self._samples_start = None
+        return samples, arrival
+
+    def takeRates(self):
+        # Packed float32 angular rates x, y, z received since the last call,
+        # one per sample of takeSamples() if the samples have one
+        rates = bytes(self._rates)
+        self._rates.clear()
+        return rates
+
+    def _addSample(self, sample, rate=b""):
+        if not self._samples:
+            self._samples_start = self._line_start
+        self._samples += sample
+        self._rates += rate
+
+    def _textLine(self, line):
+        # line that is not exactly a command: orientation index of a command
+        # followed by spaces, "" for a raw sample, or the decoded line
+        command = COMMAND_BYTES.get(line.rstrip())
+        if command is not None:
+            return command
+        if SAMPLE_SEPARATOR in line:
+            self._textSample(line)
+            return ""
+        return line.decode("utf-8", "ignore").strip()
+
+    def _textSample(self, line):
+        # displayAcceleration() or displayMotion() output
+        try:
+            values = [float(value) for value in line.split(SAMPLE_SEPARATOR)]
+            if len(values) == 6:
+                self._addSample(SAMPLE_PAYLOAD.pack(*values[:3]),
+                                SAMPLE_PAYLOAD.pack(*values[3:]))
+            else:
+                self._addSample(SAMPLE_PAYLOAD.pack(*values))
+        except (ValueError, TypeError, struct.error):
+            pass
+
+    def _frameLine(self, frame):
+        if self._last_seq is not None:
+            self.lost_frames += (frame.seq - self._last_seq - 1) & 0xFF
+        self._last_seq = frame.seq
+        if frame.type == FRAME_SAMPLE \
+                and len(frame.payload) == SAMPLE_PAYLOAD.size:
+            self._addSample(frame.payload)
+            return ""
+        if frame.type == FRAME_MOTION \
+                and len(frame.payload) == MOTION_PAYLOAD.size:
+            self._addSample(frame.payload[:SAMPLE_PAYLOAD.size],
+                            frame.payload[SAMPLE_PAYLOAD.size:])
+            return ""
+        if frame.type == FRAME_ORIENTATION and len(frame.payload) == 1 \
+                and frame.payload[0] < len(ORIENTATION_NAMES):
+            return frame.payload[0]
+        return ""
+
+### Functions ##################################################################
+
+def isCommand(line):
+    # commands are handed over as their orientation index by LineSplitter
+    return type(line) is int
+
+def commandName(line):
+    return ORIENTATION_NAMES[line]
+
+def readLine(ser):
+    # First line received on ser within its timeout, or "" (like readline(),
+    # without reading one byte at a time). Raw samples are skipped.
+    splitter = LineSplitter()
+    deadline = time.monotonic() + (ser.timeout or 0)
+    while True:
+        chunk = ser.read(ser.in_waiting or 1)
+        if not chunk:   # timeout, or read cancelled
+            return ""
+        lines = splitter.feed(chunk, 0)
+        if lines:
+            line = lines[0][0]
+            return COMMAND_LINES[line] if isCommand(line) else line
+        if time.monotonic() >= deadline:
+            return ""
+
+def confirmReady(ser, ready_message, raw_samples=False, gyro=False):
+    # Answers a ready message and returns the LinkMode agreed on. With binary
+    # framing the baud rate is raised to BINARY_BAUD_RATE. Raw samples (and
+    # their angular rate) are only requested if the Arduino advertised them.
+    tokens = ready_message.split()
+    link_mode = LinkMode(BINARY_PROTOCOL and BINARY_TOKEN in tokens,
+                         raw_samples and RAW_TOKEN in tokens)
+    link_mode.gyro = link_mode.raw_samples and gyro and GYRO_TOKEN in tokens
+    message = CONFIRMATION_MESSAGE
+    if link_mode.binary:
+        message += " " + BINARY_TOKEN + " " + str(BINARY_BAUD_RATE)
+    if link_mode.raw_samples:
+        message += " " + RAW_TOKEN
+    if link_mode.gyro:
+        message += " " + GYRO_TOKEN
+    ser.write((message + "\n").encode())
+    link_mode.confirmed = time.monotonic()
+    if link_mode.binary:
+        ser.flush()
+        ser.baudrate = BINARY_BAUD_RATE
+    return link_mode
+
+def isStaleReady(link_mode):
+    # True for a ready message the Arduino sent before it read the last
+    # confirmation, when the configuration was sent without waiting
+    # READY_MESSAGE_INTERVAL. A real reset sends it again after the interval.
+    return (link_mode.confirmed is not None and
+            time.monotonic() - link_mode.confirmed < READY_MESSAGE_INTERVAL)
+
+def sendConnected(ser, link_mode):
+    if link_mode.binary:
+        ser.write(heartbeatFrame())
+    else:
+        ser.write((CONNECTED_MESSAGE + "\n").encode())
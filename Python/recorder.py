@@ -0,0 +1,427 @@
+#  Recorder of the sensor and orientation streams
+#  recorder.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  python rotate_screen.py --record SECONDS keeps the last SECONDS of raw
+#  acceleration samples and orientations received from the Arduinos, and of
+#  the serial bytes they were decoded from, in a ring buffer allocated once (RECORD_RATE records per second at most). Every
+#  record has the same size and is written in place, with its
+#  time.monotonic_ns() time (a chunk of samples through a NumPy view of the
+#  buffer, one slice assignment per field):
+#    time_ns int64 | kind uint8 | orientation int8 | device uint16 |
+#    x, y, z float32                                  (little endian, 24 bytes)
+#  kind is RECORD_SAMPLE (x, y, z set), RECORD_ANGULAR_RATE (x, y, z of the
+#  gyroscope, right after the record of its sample), RECORD_ORIENTATION (sent
+#  by the Arduino), RECORD_DECISION (host classification) or RECORD_RAW,
+#  orientation is an index of ORIENTATION_NAMES or NO_ORIENTATION. The
+#  samples of one serial read share the time of the read: they are in the
+#  order received, SamplingRate apart on the Arduino.
+#  RECORD_RAW records hold the bytes of the serial reads as received, before
+#  any decoding, RAW_BYTES per record in place of x, y, z and their count in
+#  orientation. Fed to protocol.LineSplitter again (recordedReads), they
+#  replay the frame-level problems the decoded records do not show: CRC
+#  failures, resynchronisations and gaps in the sequence numbers.
+#
+#  Recording files are RECORDING_HEADER followed by the records, oldest
+#  first, so they can be memory-mapped (loadRecording). They are written:
+#  - on demand, with the record command of the control socket (control.py)
+#  - continuously with --record-file FILE: a background thread appends the
+#    new records every RECORD_STREAM_INTERVAL
+#
+#  python recorder.py FILE [--samples OUT.f32] prints a summary of a
+#  recording (with the CRC failures and lost frames of its serial reads),
+#  and writes its samples for parameter_sweep.py. Recordings with
+#  angular rates are replayed by prediction.py.
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+import time
+import struct
+import argparse
+import threading
+
+import metrics
+from framing import ORIENTATION_NAMES, ORIENTATION_INDEX, SAMPLE_PAYLOAD
+
+### Global Constants ###########################################################
+
+# Default length of the ring buffer, in seconds
+RECORD_SECONDS                  = 60
+# Records per second kept for RECORD_SECONDS: a sample per millisecond
+# (lowest SamplingRate) and the RECORD_RAW records of a link at
+# BINARY_BAUD_RATE (11520 bytes/s, 960 records)
+RECORD_RATE                     = 2000
+RECORD_STREAM_INTERVAL          = 1     # seconds
+RECORDING_FILENAME              = "rotate_screen_recording.rec"
+
+RECORDING_MAGIC                 = b"RSRECORD"
+RECORDING_VERSION               = 1
+# MAGIC, VERSION, record size, capacity of the ring, time.time_ns() and
+# time.monotonic_ns() at the start of the recorder
+RECORDING_HEADER                = struct.Struct("<8sHHIqq")
+# time_ns, kind, orientation, device (x, y, z follow as SAMPLE_PAYLOAD)
+RECORD_HEADER                   = struct.Struct("<qBbH")
+RECORD_SIZE                     = RECORD_HEADER.size + SAMPLE_PAYLOAD.size
+
+RECORD_SAMPLE                   = 0
+RECORD_ORIENTATION              = 1
+RECORD_DECISION                 = 2
+RECORD_ANGULAR_RATE             = 3
+RECORD_RAW                      = 4
+NO_ORIENTATION                  = -1
+# Serial bytes per RECORD_RAW record
+RAW_BYTES                       = SAMPLE_PAYLOAD.size
+
+### Error messages #############################################################
+
+def ERROR_RECORDING(filename):
+    return filename + " is not a recording of recorder.py."
+
+### Classes ####################################################################
+
+class Recorder:
+    # seconds:  length of the ring buffer at RECORD_RATE records per second
+    # stream:   file the records are appended to, None to only keep them in
+    #           memory
+    # The record methods can be called from any thread.
+    def __init__(self, seconds=RECORD_SECONDS, stream=None):
+        import numpy as np
+        self.capacity       = int(seconds * RECORD_RATE)
+        self._buffer        = bytearray(self.capacity * RECORD_SIZE)
+        self._view          = memoryview(self._buffer)
+        # fields of the same records, for recordSamples()
+        records = np.frombuffer(self._buffer, dtype=writeDtype())
+        self._fields        = tuple(records[field] for field in
+                                    ("time_ns", "kind", "orientation",
+                                     "device", "xyz"))
+        # the same records with x, y, z as bytes, for recordRaw()
+        self._raw           = np.frombuffer(self._buffer,
+                                            dtype=rawDtype())["raw"]
+        # records written since the start, the next one goes to
+        # _written % capacity
+        self._written       = 0
+        self._lock          = threading.Lock()
+        self._header        = RECORDING_HEADER.pack(
+            RECORDING_MAGIC, RECORDING_VERSION, RECORD_SIZE, self.capacity,
+            time.time_ns(), time.monotonic_ns())
+        self.records        = metrics.counter("recorder_records_total")
+        self.overruns       = metrics.counter("recorder_overruns_total")
+        self._stream        = None
+        self._streamed      = 0
+        self._stop          = threading.Event()
+        if stream is not None:
+            self._stream = open(stream, "wb")
+            self._stream.write(self._header)
+            threading.Thread(target=self._runStream, daemon=True).start()
+
+    ### Hot path ###############################################################
+
+    def recordSamples(self, samples, device=0, rates=b""):
+        # samples: packed float32 x, y, z (LineSplitter.takeSamples())
+        # rates:   packed float32 angular rates of the samples
+        #          (LineSplitter.takeRates()), or empty
+        # The whole chunk is written at once, in two pieces if the ring wraps.
+        import numpy as np
+        now = time.monotonic_ns()
+        count = len(samples) // SAMPLE_PAYLOAD.size
+        if count == 0:
+            return
+        paired = len(rates) == len(samples)
+        samples = np.frombuffer(samples, dtype="<f4",
+                                count=3*count).reshape(count, 3)
+        if paired:
+            # sample then angular rate, record after record
+            rates = np.frombuffer(rates, dtype="<f4",
+                                  count=3*count).reshape(count, 3)
+            count *= 2
+        else:
+            rates = None
+        with self._lock:
+            # a chunk longer than the ring only keeps its last records
+            start = max(count - self.capacity, 0)
+            index = (self._written + start) % self.capacity
+            end = min(count, start + self.capacity - index)
+            self._writeSamples(index, start, end, samples, rates, now, device)
+            if end < count:
+                self._writeSamples(0, end, count, samples, rates, now, device)
+            self._written += count
+        self.records.inc(count)
+
+    def recordRaw(self, chunk, device=0):
+        # chunk: bytes of one serial read, before LineSplitter.feed()
+        import numpy as np
+        now = time.monotonic_ns()
+        count = -(-len(chunk) // RAW_BYTES)
+        if count == 0:
+            return
+        raw = np.zeros(count * RAW_BYTES, dtype=np.uint8)
+        raw[:len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        raw = raw.reshape(count, RAW_BYTES)
+        # bytes in the last record
+        rest = len(chunk) - (count - 1) * RAW_BYTES
+        with self._lock:
+            start = max(count - self.capacity, 0)
+            index = (self._written + start) % self.capacity
+            end = min(count, start + self.capacity - index)
+            self._writeRaw(index, start, end, raw, rest, now, device)
+            if end < count:
+                self._writeRaw(0, end, count, raw, rest, now, device)
+            self._written += count
+        self.records.inc(count)
+
+    def recordOrientation(self, orientation, kind=RECORD_ORIENTATION,
+                          device=0):
+        # orientation: name sent by the Arduino (commandName) or decided by
+        # the host classifier
+        now = time.monotonic_ns()
+        with self._lock:
+            offset = (self._written % self.capacity) * RECORD_SIZE
+            RECORD_HEADER.pack_into(self._buffer, offset, now, kind,
+                                    ORIENTATION_INDEX.get(orientation,
+                                                          NO_ORIENTATION),
+                                    device)
+            SAMPLE_PAYLOAD.pack_into(self._buffer,
+                                     offset + RECORD_HEADER.size, 0, 0, 0)
+            self._written += 1
+        self.records.inc()
+
+    def recordDecision(self, orientation, device=0):
+        self.recordOrientation(orientation, RECORD_DECISION, device)
+
+    def _writeSamples(self, index, start, end, samples, rates, now, device):
+        # Records start to end of a chunk, from record index of the ring.
+        # samples, rates: (n, 3) float32, rates None or one per sample (the
+        # chunk is then sample, rate, sample, rate...)
+        last = index + end - start
+        time_ns, kind, orientation, devices, xyz = self._fields
+        time_ns[index:last] = now
+        orientation[index:last] = NO_ORIENTATION
+        devices[index:last] = device
+        kind[index:last] = RECORD_SAMPLE
+        if rates is None:
+            xyz[index:last] = samples[start:end]
+            return
+        first = start % 2               # 1 if the first record is a rate
+        xyz[index+first:last:2] = samples[(start+1)//2:(end+1)//2]
+        xyz[index+1-first:last:2] = rates[start//2:end//2]
+        kind[index+1-first:last:2] = RECORD_ANGULAR_RATE
+
+    def _writeRaw(self, index, start, end, raw, rest, now, device):
+        # Records start to end of the (n, RAW_BYTES) bytes of a read, from
+        # record index of the ring, rest bytes in record n - 1
+        last = index + end - start
+        time_ns, kind, orientation, devices, xyz = self._fields
+        time_ns[index:last] = now
+        kind[index:last] = RECORD_RAW
+        orientation[index:last] = RAW_BYTES
+        devices[index:last] = device
+        self._raw[index:last] = raw[start:end]
+        if end == len(raw):
+            orientation[last-1] = rest
+
+    ### Files ##################################################################
+
+    def dump(self, filename=RECORDING_FILENAME):
+        # Writes the records of the ring buffer, returns how many
+        with self._lock:
+            start = max(self._written - self.capacity, 0)
+            content = self._copy(start, self._written)
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(self._header)
+            file.write(content)
+        os.replace(temporary, filename)
+        return len(content) // RECORD_SIZE
+
+    def close(self):
+        self._stop.set()
+
+    def _copy(self, start, end):
+        # bytes of the records start to end (counts of _written), under _lock
+        first = (start % self.capacity) * RECORD_SIZE
+        size = (end - start) * RECORD_SIZE
+        if first + size <= len(self._buffer):
+            return bytes(self._view[first:first+size])
+        return (bytes(self._view[first:])
+                + bytes(self._view[:first + size - len(self._buffer)]))
+
+    def _runStream(self):
+        stopped = False
+        while not(stopped):
+            stopped = self._stop.wait(RECORD_STREAM_INTERVAL)
+            with self._lock:
+                end = self._written
+                start = max(self._streamed, end - self.capacity)
+                content = self._copy(start, end)
+            if start > self._streamed:
+                # overwritten before they could be written
+                self.overruns.inc(start - self._streamed)
+            self._streamed = end
+            try:
+                self._stream.write(content)
+                self._stream.flush()
+            except (OSError, ValueError) as error:
+                print("Recording stopped: " + str(error))
+                break
+        self._stream.close()
+
+### Functions ##################################################################
+
+def writeDtype():
+    # recordDtype() with x, y, z as one field
+    import numpy as np
+    return np.dtype([("time_ns", "<i8"), ("kind", "u1"),
+                     ("orientation", "i1"), ("device", "<u2"),
+                     ("xyz", "<f4", (3,))])
+
+def rawDtype():
+    # recordDtype() with x, y, z as RAW_BYTES bytes
+    import numpy as np
+    return np.dtype([("time_ns", "<i8"), ("kind", "u1"),
+                     ("orientation", "i1"), ("device", "<u2"),
+                     ("raw", "u1", (RAW_BYTES,))])
+
+def recordDtype():
+    import numpy as np
+    return np.dtype([("time_ns", "<i8"), ("kind", "u1"),
+                     ("orientation", "i1"), ("device", "<u2"),
+                     ("x", "<f4"), ("y", "<f4"), ("z", "<f4")])
+
+def readHeader(filename):
+    # {"capacity", "time_ns", "monotonic_ns"} of a recording
+    with open(filename, "rb") as file:
+        header = file.read(RECORDING_HEADER.size)
+    if len(header) != RECORDING_HEADER.size:
+        raise ValueError(ERROR_RECORDING(filename))
+    magic, version, size, capacity, wall, monotonic = \
+        RECORDING_HEADER.unpack(header)
+    if (magic != RECORDING_MAGIC or version != RECORDING_VERSION
+            or size != RECORD_SIZE):
+        raise ValueError(ERROR_RECORDING(filename))
+    return {"capacity": capacity, "time_ns": wall, "monotonic_ns": monotonic}
+
+def loadRecording(filename):
+    # Records of a recording as a memory-mapped NumPy structured array (see
+    # recordDtype), the file is not read into memory. A record being written
+    # by a stream is left out.
+    import numpy as np
+    readHeader(filename)
+    count = ((os.path.getsize(filename) - RECORDING_HEADER.size)
+             // RECORD_SIZE)
+    if count == 0:
+        return np.zeros(0, dtype=recordDtype())
+    return np.memmap(filename, dtype=recordDtype(), mode="r",
+                     offset=RECORDING_HEADER.size, shape=(count,))
+
+def recordedSamples(records, device=0):
+    # (n, 3) float32 samples of one device, in the order received, e.g. for
+    # classifier.classifySamples()
+    import numpy as np
+    samples = records[(records["kind"] == RECORD_SAMPLE)
+                      & (records["device"] == device)]
+    return np.stack([samples["x"], samples["y"], samples["z"]], axis=1)
+
+def recordedMotion(records, device=0):
+    # (n, 3) float32 samples of one device that have an angular rate, and
+    # their (n, 3) angular rates, e.g. for prediction.py
+    import numpy as np
+    rates = np.flatnonzero((records["kind"] == RECORD_ANGULAR_RATE)
+                           & (records["device"] == device))
+    rates = rates[rates > 0]
+    samples = rates - 1
+    paired = ((records["kind"][samples] == RECORD_SAMPLE)
+              & (records["device"][samples] == device))
+    samples, rates = records[samples[paired]], records[rates[paired]]
+    return (np.stack([samples["x"], samples["y"], samples["z"]], axis=1),
+            np.stack([rates["x"], rates["y"], rates["z"]], axis=1))
+
+def recordedReads(records, device=0):
+    # [(time_ns, bytes)] of the serial reads of one device, in the order
+    # received, e.g. for protocol.LineSplitter.feed(). A read cut by the
+    # start of the ring buffer is kept from its first byte recorded.
+    import numpy as np
+    raw = records[(records["kind"] == RECORD_RAW)
+                  & (records["device"] == device)]
+    if len(raw) == 0:
+        return []
+    content = raw.view(rawDtype())["raw"].reshape(-1)
+    lengths = raw["orientation"].astype(np.int64)
+    valid = (np.arange(RAW_BYTES) < lengths[:, None]).reshape(-1)
+    content = content[valid].tobytes()
+    # the reads start where the time changes
+    times = raw["time_ns"]
+    starts = np.flatnonzero(np.r_[True, times[1:] != times[:-1]])
+    offsets = np.r_[0, np.cumsum(lengths)]
+    reads = []
+    for first, end in zip(starts, np.r_[starts[1:], len(raw)]):
+        reads.append((int(times[first]),
+                      content[offsets[first]:offsets[end]]))
+    return reads
+
+def replayReads(reads):
+    # (crc_errors, lost_frames) of serial reads fed to a LineSplitter
+    from protocol import LineSplitter
+    splitter = LineSplitter()
+    for time_ns, chunk in reads:
+        splitter.feed(chunk, time_ns / 1e9)
+        splitter.takeSamples()
+        splitter.takeRates()
+    return splitter.crc_errors, splitter.lost_frames
+
+def printSummary(filename, records):
+    header = readHeader(filename)
+    print(filename + ": " + str(len(records)) + " records")
+    if len(records) == 0:
+        return
+    start = (header["time_ns"] + int(records["time_ns"][0])
+             - header["monotonic_ns"])
+    print("Start:    " + time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(start / 1e9)))
+    print("Duration: {:.3f} s".format(
+        (int(records["time_ns"][-1]) - int(records["time_ns"][0])) / 1e9))
+    for device in sorted(set(records["device"].tolist())):
+        mine = records[records["device"] == device]
+        print("Device " + str(device) + ": "
+              + str(int((mine["kind"] == RECORD_SAMPLE).sum())) + " samples, "
+              + str(int((mine["kind"] == RECORD_ANGULAR_RATE).sum()))
+              + " angular rates")
+        reads = recordedReads(mine, device)
+        if reads:
+            crc_errors, lost_frames = replayReads(reads)
+            print("  " + str(len(reads)) + " serial reads, "
+                  + str(sum(len(chunk) for time_ns, chunk in reads))
+                  + " bytes, " + str(crc_errors) + " CRC errors, "
+                  + str(lost_frames) + " lost frames")
+        for record in mine[(mine["kind"] == RECORD_ORIENTATION)
+                           | (mine["kind"] == RECORD_DECISION)]:
+            orientation = int(record["orientation"])
+            print("  {:>10.3f} s  {:<9}{}".format(
+                (int(record["time_ns"]) - int(records["time_ns"][0])) / 1e9,
+                "decision" if record["kind"] == RECORD_DECISION
+                else "received",
+                ORIENTATION_NAMES[orientation]
+                if orientation != NO_ORIENTATION else "?"))
+
+################################################################################
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="file written by the recorder")
+    parser.add_argument("--samples",
+                        help="write the samples as float32 x, y, z (.f32)")
+    parser.add_argument("--device", type=int, default=0,
+                        help="device of the samples written")
+    args = parser.parse_args()
+    try:
+        records = loadRecording(args.recording)
+    except (OSError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+    printSummary(args.recording, records)
+    if args.samples:
+        recordedSamples(records, args.device).tofile(args.samples)
@@ -14,18 +14,41 @@
 
 ### IMPORTS ####################################################################
 
+# Only what the first connection needs is imported here. win32api,
+# serial.tools.list_ports (port enumeration) and concurrent.futures (parallel
+# probing) are imported by the functions using them.
+
+import time                             # delays
+STARTUP_TIME = time.perf_counter()      # start of --startup-profile
+
 import sys
+import copy                             # configuration of each Arduino
+import argparse                         # command line options
 import os                               # file paths
 import serial                           # serial connection with Arduino
-import serial.tools.list_ports          # detection of serial ports
 import string
-import time                             # delays
-import threading                        # thread to verify the connection
+import threading                        # parallel probing of the ports
 
-from subprocess import call             # to execute display.exe
 from configparser import ConfigParser   # to read config file
 
-import win32api                         # get the number of screens
+import metrics                          # counters and latency histograms
+import startup                          # last-known-good snapshot
+from protocol import (                  # messages shared with the Arduino
+    BAUD_RATE, READY_MESSAGE, READY_MESSAGE_INTERVAL, CONFIG_MESSAGE, LinkMode,
+    confirmReady, readLine
+)
+from framing import (                   # binary configuration frame
+    ORIENTATION_NAMES, ORIENTATION_INDEX, configFrame
+)
+from display_backend import (           # applies rotations and positions
+    DisplayRequest, createBackend
+)
+from config_watch import (              # configuration file hot-reload
+    ConfigWatcher
+)
+from monitor_topology import (          # cached snapshot of the monitors
+    sharedTopology
+)
 
 ### Global Constants ###########################################################
 
@@ -37,6 +60,13 @@ SAMPLING_RATE_MIN               = 1
 NUMBER_STABLE_SAMPLES_MIN       = 1
 POSSIBLE_ORIENTATIONS           = ("PORTRAIT", "PORTRAIT_FLIPPED", 
                                    "LANDSCAPE", "LANDSCAPE_FLIPPED", "")
+# orientations of the sensor sent by the Arduino
+SENSOR_ORIENTATIONS             = ("X_POS", "Y_POS", "X_NEG", "Y_NEG", "FLAT")
+POSSIBLE_CLASSIFICATIONS        = ("firmware", "host")
+POSSIBLE_PREDICTIONS            = ("off", "gyro")
+HYSTERESIS_MIN                  = 0
+HYSTERESIS_MAX                  = 1
+DEVICES_SECTION                 = "DEVICES"
 
 
 SERIAL_PORT_LABEL               = "COM"
@@ -44,30 +74,34 @@ SERIAL_PORT_LABEL_MIN           = 1
 
 # Serial
 
-BAUD_RATE                       = 9600
 # More valid names can be added here for non original Arduino ports
 VALID_PORT_NAMES = [
     "Arduino",
     "USB Serial Device"
 ]
-# Ready and confirmation and connected messages
-# must be the same in Arduino and Python
-
-# Interval are in seconds
-
-READY_MESSAGE                   = "Ready"  
-CONFIRMATION_MESSAGE            = "Confirmation"
-CONNECTED_MESSAGE               = "Connected"
-READY_MESSAGE_INTERVAL          = 0.3
-
-COMMAND_START                   = "<"
-COMMAND_END                     = ">"
+# The protocol messages, BAUD_RATE and the intervals shared with the Arduino
+# are in protocol.py
 
 # ERROR_COUNT_TIMEOUT             = 10
 ERROR_COUNT_TIMEOUT             = float('inf') # use this for no timeout
 
 SERIAL_CONNECTION_INTERVAL      = 1
-CHECK_CONNECTION_INTERVAL       = 1
+# Maximum number of ports probed at the same time by findPort
+MAX_PARALLEL_PROBES             = 8
+
+# Display
+
+# "win32" changes display settings in-process, "display64" runs display64.exe
+# for every rotation (slower), "fake" only records the requests (testing)
+DISPLAY_BACKEND                 = "win32"
+
+ORIENTATION_ANGLES = {
+    "PORTRAIT_FLIPPED"  : "270" ,
+    "LANDSCAPE"         : "0"   ,
+    "PORTRAIT"          : "90"  ,
+    "LANDSCAPE_FLIPPED" : "180" ,
+    ""                  : ""
+}
 
 ### Error messages #############################################################
 
@@ -99,6 +133,17 @@ ERROR_SCREEN_ORIENTATION = ("Screen orientation is invalid. Valid orientations:"
 
 ERROR_SCREEN_POSITION    = ("Screen coordinates must be integers or empty!")
 
+ERROR_CLASSIFICATION     = ("Classification must be firmware or host!")
+
+ERROR_PREDICTION         = ("Prediction must be off or gyro!")
+
+ERROR_HYSTERESIS         = ("Hysteresis must be a decimal value between "
++ str(HYSTERESIS_MIN) + " and " + str(HYSTERESIS_MAX) + "!")
+
+def ERROR_DEVICE_MONITOR(device, number_of_monitors):
+    return ("Monitor of device " + device + " must be between 1 and "
+            + str(number_of_monitors) + "!")
+
 ERROR_SERIAL_WRONG       = ("Ready message from Arduino was not received. "
 "\nTrying next available port...\n")
 
@@ -110,28 +155,76 @@ ERROR_SERIAL_TIMEOUT     = ("Serial connection timed out. No connection was "
 
 ### Variables ##################################################################
 ser = None # I don't like global variables, but couldn't find a better way...
+link_mode = LinkMode() # agreed on during the last handshake
+
+### Metrics ####################################################################
+# see metrics.py, exported with --metrics-socket/--metrics-port/--metrics-file
+config_load_time        = metrics.histogram("config_load_seconds")
+config_errors           = metrics.counter("config_errors_total")
+probe_time              = metrics.histogram("probe_seconds")
+connection_attempts     = metrics.counter("connection_attempts_total")
+connection_failures     = metrics.counter("connection_failures_total")
+# the metrics of the serial link are counted by async_engine.py
 
 ### Classes ####################################################################
-# https://stackoverflow.com/q/43229939
-# "How to pass a boolean by reference across threads and modules"
-class ConfigurationToken:
+class PortProbe:
+    # Shared state of parallel connection attempts (see probePorts)
     def __init__(self):
-        self.config_sent = False
-    def isSent(self):
-        self.config_sent = True
-    def isNotSent(self):
-        self.config_sent = False
+        self.winner     = None
+        self._handles   = {}
+        self._lock      = threading.Lock()
+
+    def isCancelled(self):
+        return self.winner is not None
+
+    def register(self, port, ser):
+        # returns False if another port already won
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self._handles[port] = ser
+            return True
+
+    def claim(self, port, ser):
+        # returns True for the first port only, and cancels the other attempts
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self.winner = (port, ser)
+            others = [s for p, s in self._handles.items() if p != port]
+        for other in others:
+            try:
+                other.cancel_read()   # unblock readLine()
+            except Exception:
+                pass
+        return True
 
-class ReceiveDataToken:
-    def __init__(self):
-        self.receiving = False
-    def isReceiving(self):
-        self.receiving = True
-    def isNotReceiving(self):
-        self.receiving = False
+class StartupSnapshot:
+    # Saves the validated configuration and the port of the Arduino for the
+    # next start (startup.py), again after every reload of the configuration
+    def __init__(self, port):
+        self.port = port
+
+    def put(self, change):
+        self.save(change.data)
+
+    def save(self, data):
+        try:
+            # the display requests are built again from the values, the port
+            # found by initSerial() is saved on its own
+            values = dict(vars(data))
+            values.pop("requests", None)
+            values.pop("serial_port", None)
+            startup.saveSnapshot(data.filename, values, self.port)
+        except (OSError, TypeError) as error:
+            print("Startup snapshot not saved: " + str(error))
 
 class ConfigurationData:
+    # Validated values of the configuration file. main() and the reloads of
+    # ConfigWatcher (config_watch.py) build new objects instead of modifying
+    # the values of a configuration in use.
     def __init__(self, filename):
+        start = time.perf_counter()
         error_count = 0
         while error_count <= ERROR_COUNT_TIMEOUT:
             value_error = False
@@ -140,138 +233,262 @@ class ConfigurationData:
                 self.filename   = path
                 config = ConfigParser()
                 config.read(path)
+                value_error = self._parseMode(config)
+                value_error = self._parseDevices(config) or value_error
+                if not(value_error):
+                    break
 
-                # Mode
-                self.mode = config['MODE']['Mode']
-                mode_list = [x for x in config.sections() if "MODE" not in x]
-                mode_list.append("DEFAULT")
-                if(self.mode not in mode_list):
-                    print(ERROR_MODE(self.mode, mode_list))
+            else:
+                print(ERROR_FILENAME(filename))
+                value_error = True
+            if value_error:
+                error_count += 1
+                config_errors.inc()
+            time.sleep(1)
+        if value_error:
+            raise IOError(ERROR_SERIAL_TIMEOUT)
+        config_load_time.add(time.perf_counter() - start)
+
+    def _parseMode(self, config, mode=None):
+        # Values of the selected mode (or of mode), returns True if one is
+        # invalid
+        value_error = False
+
+        # Mode
+        self.mode = mode if mode is not None else config['MODE']['Mode']
+        mode_list = modeNames(config)
+        if(self.mode not in mode_list):
+            print(ERROR_MODE(self.mode, mode_list))
+            return True
+        # Monitor number
+
+        if config[self.mode]['MonitorNumber'] == "":
+            self.monitor = ""
+        else:
+            number_of_monitors = numberOfMonitors()
+            try:
+                mon = int(config[self.mode]['MonitorNumber'])
+                if mon <= 0 or mon > number_of_monitors:
+                    print(ERROR_MONITOR_NUMBER(number_of_monitors))
                     value_error = True
-                # Monitor number
+                else:
+                    self.monitor = config[self.mode]['MonitorNumber']
+            except ValueError:
+                print(ERROR_MONITOR_NUMBER(number_of_monitors))
+                value_error = True
 
-                number_of_monitors = len(win32api.EnumDisplayMonitors())
+        # Sampling rate
 
-                if config[self.mode]['MonitorNumber'] == "":
-                    self.monitor = ""
-                else:
-                    try:
-                        mon = int(config[self.mode]['MonitorNumber'])
-                        if mon <= 0 or mon > number_of_monitors:
-                            print(ERROR_MONITOR_NUMBER(number_of_monitors))
-                            value_error = True
-                        else:
-                            self.monitor = config[self.mode]['MonitorNumber']
-                    except ValueError:
-                        print(ERROR_MONITOR_NUMBER(number_of_monitors))
-                        value_error = True
-
-                # Sampling rate
+        try:
+            sam_rate = int(config[self.mode]['SamplingRate'])
+        except ValueError:
+            print(ERROR_SAMPLING_RATE)
+            value_error = True
+        if (sam_rate >= SAMPLING_RATE_MIN):
+            self.sampling_rate = sam_rate
+        else:
+            print(ERROR_SAMPLING_RATE)
+            value_error = True
 
-                try:
-                    sam_rate = int(config[self.mode]['SamplingRate'])
-                except ValueError:
-                    print(ERROR_SAMPLING_RATE)
-                    value_error = True
-                if (sam_rate >= SAMPLING_RATE_MIN):
-                    self.sampling_rate = sam_rate
-                else:
-                    print(ERROR_SAMPLING_RATE)
-                    value_error = True
+        # Number of stable samples
 
-                # Number of stable samples
+        try:
+            num_stable_sam = int(config[self.mode]['NumberStableSamples'])
+        except ValueError:
+            print(ERROR_NUMBER_SAMPLE)
+            value_error = True
+        if (num_stable_sam >= NUMBER_STABLE_SAMPLES_MIN):
+            self.number_stable_samples = num_stable_sam
+        else:
+            print(ERROR_NUMBER_SAMPLE)
+            value_error = True
 
-                try:
-                    num_stable_sam = int(config[self.mode]['NumberStableSamples'])
-                except ValueError:
-                    print(ERROR_NUMBER_SAMPLE)
-                    value_error = True
-                if (num_stable_sam >= NUMBER_STABLE_SAMPLES_MIN):
-                    self.number_stable_samples = num_stable_sam
-                else:
-                    print(ERROR_NUMBER_SAMPLE)
-                    value_error = True
+        # Acceleration thresholds
+        try:
+            x_thr = float(config[self.mode]['XThreshold'])
+            y_thr = float(config[self.mode]['YThreshold'])
+            z_thr = float(config[self.mode]['ZThreshold'])
+        except ValueError:
+            print(ERROR_ACCEL_THR)
+            value_error = True
+        if all(ACCEL_THR_MIN <= thr <= ACCEL_THR_MAX 
+        for thr in (x_thr, y_thr, z_thr)):
+            self.x_threshold = x_thr
+            self.y_threshold = y_thr
+            self.z_threshold = z_thr
+        else:
+            print(ERROR_ACCEL_THR)
+            value_error = True
 
-                # Acceleration thresholds
-                try:
-                    x_thr = float(config[self.mode]['XThreshold'])
-                    y_thr = float(config[self.mode]['YThreshold'])
-                    z_thr = float(config[self.mode]['ZThreshold'])
-                except ValueError:
-                    print(ERROR_ACCEL_THR)
-                    value_error = True
-                if all(ACCEL_THR_MIN <= thr <= ACCEL_THR_MAX 
-                for thr in (x_thr, y_thr, z_thr)):
-                    self.x_threshold = x_thr
-                    self.y_threshold = y_thr
-                    self.z_threshold = z_thr
-                else:
-                    print(ERROR_ACCEL_THR)
-                    value_error = True
+        # Screen orientation
+
+        try:
+            x_p     = str(config[self.mode]['XPos'])
+            y_p     = str(config[self.mode]['YPos'])
+            x_n     = str(config[self.mode]['XNeg'])
+            y_n     = str(config[self.mode]['YNeg'])
+            flat_   = str(config[self.mode]['Flat'])
+        except ValueError:
+            print(ERROR_SCREEN_ORIENTATION)
+            value_error = True
+        if all(orientations in POSSIBLE_ORIENTATIONS
+               for orientations in (x_p, y_p, x_n, y_n, flat_)):
+            self.x_pos = x_p
+            self.y_pos = y_p
+            self.x_neg = x_n
+            self.y_neg = y_n
+            self.flat  = flat_
+        else:
+            print(ERROR_SCREEN_ORIENTATION)
+            value_error = True
+        
+        # Screen position
 
-                # Screen orientation
+        self.x_px = str(config[self.mode]['XPos_x'])
+        self.x_py = str(config[self.mode]['XPos_y'])
 
+        self.y_px = str(config[self.mode]['YPos_x'])
+        self.y_py = str(config[self.mode]['YPos_Y'])
+
+        self.x_nx = str(config[self.mode]['XNeg_x'])
+        self.x_ny = str(config[self.mode]['XNeg_y'])
+
+        self.y_nx = str(config[self.mode]['YNeg_x'])
+        self.y_ny = str(config[self.mode]['YNeg_y'])
+
+        self.fx   = str(config[self.mode]['Flat_x'])
+        self.fy   = str(config[self.mode]['Flat_y'])
+        positions = (self.x_px, self.x_py, self.y_px, self.y_py, 
+                     self.x_nx, self.x_ny, self.y_nx, self.y_ny, 
+                     self.fx, self.fy)
+        for position in positions:
+            if position == "":
+                continue
+            else:
                 try:
-                    x_p     = str(config[self.mode]['XPos'])
-                    y_p     = str(config[self.mode]['YPos'])
-                    x_n     = str(config[self.mode]['XNeg'])
-                    y_n     = str(config[self.mode]['YNeg'])
-                    flat_   = str(config[self.mode]['Flat'])
+                    int(position)
                 except ValueError:
-                    print(ERROR_SCREEN_ORIENTATION)
-                    value_error = True
-                if all(orientations in POSSIBLE_ORIENTATIONS
-                       for orientations in (x_p, y_p, x_n, y_n, flat_)):
-                    self.x_pos = x_p
-                    self.y_pos = y_p
-                    self.x_neg = x_n
-                    self.y_neg = y_n
-                    self.flat  = flat_
-                else:
-                    print(ERROR_SCREEN_ORIENTATION)
+                    print(ERROR_SCREEN_POSITION)
                     value_error = True
-                
-                # Screen position
 
-                self.x_px = str(config[self.mode]['XPos_x'])
-                self.x_py = str(config[self.mode]['XPos_y'])
+        # Orientation detection on the Arduino or on this computer
 
-                self.y_px = str(config[self.mode]['YPos_x'])
-                self.y_py = str(config[self.mode]['YPos_Y'])
+        self.classification = config[self.mode].get('Classification',
+                                                    'firmware')
+        if self.classification not in POSSIBLE_CLASSIFICATIONS:
+            print(ERROR_CLASSIFICATION)
+            value_error = True
+        try:
+            hysteresis = float(config[self.mode].get('Hysteresis', '0'))
+            if HYSTERESIS_MIN <= hysteresis <= HYSTERESIS_MAX:
+                self.hysteresis = hysteresis
+            else:
+                print(ERROR_HYSTERESIS)
+                value_error = True
+        except ValueError:
+            print(ERROR_HYSTERESIS)
+            value_error = True
+
+        # Gyroscope prediction of the next orientation (host classification)
+
+        self.prediction = config[self.mode].get('Prediction', 'off')
+        if self.prediction not in POSSIBLE_PREDICTIONS:
+            print(ERROR_PREDICTION)
+            value_error = True
+        if not(value_error):
+            self._buildRequests()
+        return value_error
+
+    def _buildRequests(self):
+        # Display request of every orientation sent by the Arduino, by index
+        # of ORIENTATION_NAMES, None if nothing has to change in it. Built
+        # with the values of the mode, commands only look it up.
+        values = {
+            "X_POS" : (self.x_pos, self.x_px, self.x_py),
+            "X_NEG" : (self.x_neg, self.x_nx, self.x_ny),
+            "Y_POS" : (self.y_pos, self.y_px, self.y_py),
+            "Y_NEG" : (self.y_neg, self.y_nx, self.y_ny),
+            "FLAT"  : (self.flat, self.fx, self.fy)
+        }
+        requests = []
+        for orientation in ORIENTATION_NAMES:
+            screen, pos_x, pos_y = values[orientation]
+            angle = ORIENTATION_ANGLES[screen]
+            if (pos_x != "" and pos_y != ""):
+                position = (pos_x, pos_y)
+            else:
+                position = None
+            if (angle == "" and position is None):
+                requests.append(None)
+            else:
+                requests.append(DisplayRequest(self.monitor, angle, position))
+        self.requests = tuple(requests)
 
-                self.x_nx = str(config[self.mode]['XNeg_x'])
-                self.x_ny = str(config[self.mode]['XNeg_y'])
+    def _parseDevices(self, config):
+        value_error = False
 
-                self.y_nx = str(config[self.mode]['YNeg_x'])
-                self.y_ny = str(config[self.mode]['YNeg_y'])
+        # Arduinos bound to monitors, by USB serial number or port.
+        # Empty for a single Arduino on MonitorNumber
 
-                self.fx   = str(config[self.mode]['Flat_x'])
-                self.fy   = str(config[self.mode]['Flat_y'])
-                positions = (self.x_px, self.x_py, self.y_px, self.y_py, 
-                             self.x_nx, self.x_ny, self.y_nx, self.y_ny, 
-                             self.fx, self.fy)
-                for position in positions:
-                    if position == "":
+        self.devices = {}
+        if DEVICES_SECTION in config:
+            number_of_monitors = numberOfMonitors()
+            for device, mon in config.items(DEVICES_SECTION):
+                if device in config.defaults():
+                    continue
+                try:
+                    if 0 < int(mon) <= number_of_monitors:
+                        self.devices[device] = mon
                         continue
-                    else:
-                        try:
-                            int(position)
-                        except ValueError:
-                            print(ERROR_SCREEN_POSITION)
-                            value_error = True
-                if not(value_error):
-                    break
-
-
-            else:
-                print(ERROR_FILENAME(filename))
+                except ValueError:
+                    pass
+                print(ERROR_DEVICE_MONITOR(device, number_of_monitors))
                 value_error = True
-            if value_error:
-                error_count += 1
-            time.sleep(1)
-        if value_error:
-            raise IOError(ERROR_SERIAL_TIMEOUT)
-
+        return value_error
+
+    def parsed(self, config):
+        # New ConfigurationData with every section of config (ConfigParser of
+        # the same file) parsed, none of the values of self. None if a value
+        # is invalid.
+        data = ConfigurationData.__new__(ConfigurationData)
+        data.filename = self.filename
+        value_error = data._parseMode(config)
+        value_error = data._parseDevices(config) or value_error
+        return None if value_error else data
+
+    def reloaded(self, config, changed):
+        # New ConfigurationData with the sections of config (ConfigParser of
+        # the same file) that changed parsed again, the other values are the
+        # ones of self. None if a value is invalid.
+        data = copy.copy(self)
+        mode = config['MODE'].get('Mode') if 'MODE' in config else None
+        value_error = False
+        # every mode inherits the DEFAULT values
+        if 'MODE' in changed or 'DEFAULT' in changed or mode in changed:
+            value_error = data._parseMode(config)
+        if DEVICES_SECTION in changed:
+            value_error = data._parseDevices(config) or value_error
+            if data.devices != self.devices:
+                print("Changes to [" + DEVICES_SECTION + "] apply after a "
+                      "restart")
+        return None if value_error else data
+
+    def firmwareParameters(self):
+        # values sent to the Arduino
+        return (self.sampling_rate, self.number_stable_samples,
+                self.x_threshold, self.y_threshold, self.z_threshold)
+
+    def replaceWith(self, data):
+        # Takes all the values of data (a reloaded ConfigurationData) in one
+        # assignment. Returns True if the Arduino or classifier parameters
+        # changed.
+        old = self.firmwareParameters() + (self.hysteresis,)
+        if (data.classification, data.prediction) != (self.classification,
+                                                      self.prediction):
+            print("Classification and prediction changes apply at the next "
+                  "connection")
+        self.__dict__ = dict(vars(data))
+        return old != self.firmwareParameters() + (self.hysteresis,)
 
     def initSerial(self):
         # Serial port
@@ -284,7 +501,9 @@ class ConfigurationData:
                     ser_port_number = int(port[len(SERIAL_PORT_LABEL):])
                     error_count = 0
                     while error_count <= ERROR_COUNT_TIMEOUT:
-                        is_connected, ser = attemptConnection(port)
+                        is_connected, ser = attemptConnection(
+                            port, raw_samples=self.classification == "host",
+                            gyro=self.prediction == "gyro")
                         if is_connected:
                             return port, ser
                         time.sleep(SERIAL_CONNECTION_INTERVAL)
@@ -301,16 +520,47 @@ class ConfigurationData:
                     # os._exit(1)
 
             else:
-                self.serial_port, ser = findPort()
+                self.serial_port, ser = findPort(self.classification == "host",
+                                                 self.prediction == "gyro")
                 return self.serial_port, ser
         else:
             raise ValueError(ERROR_FILENAME(filename))
             # os._exit(1)
             
-    def sendConfigParameters(self, ser):
+    def forMonitor(self, monitor):
+        # Same configuration for an Arduino bound to another monitor
+        data = copy.copy(self)
+        data.monitor = monitor
+        data._buildRequests()
+        return data
+
+    def createClassifier(self, link_mode, stager=None):
+        # Classifier for the raw samples of the Arduino, if agreed on, with
+        # the gyroscope prediction if the angular rates were agreed on too.
+        # stager: DisplayStager of the predictions
+        if not(link_mode.raw_samples):
+            return None
+        from classifier import StreamingClassifier
+        classifier = StreamingClassifier(self.number_stable_samples,
+                                         self.x_threshold, self.y_threshold,
+                                         self.z_threshold, self.hysteresis)
+        if link_mode.gyro and self.prediction == "gyro":
+            from prediction import PredictiveClassifier
+            return PredictiveClassifier(classifier, self.sampling_rate, stager)
+        return classifier
+
+    def sendConfigParameters(self, ser, link_mode=LinkMode()):
         try:
             ser.reset_input_buffer()
             ser.reset_output_buffer()
+            if link_mode.binary:
+                ser.write(configFrame(self.sampling_rate,
+                                      self.number_stable_samples,
+                                      self.x_threshold, self.y_threshold,
+                                      self.z_threshold))
+                # wait until sent, main() resets the output buffer next
+                ser.flush()
+                return
             # time.sleep(0.1)
             # add new line character to integers for proper separation
             ser.write((str(self.sampling_rate)+"\n").encode())
@@ -320,16 +570,90 @@ class ConfigurationData:
             ser.write(str(self.y_threshold).encode())
             ser.write(("\n").encode())
             ser.write(str(self.z_threshold).encode())
+            ser.flush()
         # fall back on default built-in values if an error occurs
         except Exception:
             pass
 
+    def pushConfigParameters(self, ser, link_mode=LinkMode()):
+        # New parameters for an Arduino that is already running, without a
+        # new handshake (nothing received is thrown away)
+        try:
+            if link_mode.binary:
+                ser.write(configFrame(*self.firmwareParameters()))
+            else:
+                ser.write((CONFIG_MESSAGE + " " + " ".join(
+                    str(value) for value in self.firmwareParameters())
+                    + "\n").encode())
+        except Exception:  # unplugged board, sent again on the next handshake
+            pass
+
 
 ### Functions ##################################################################
 
+def numberOfMonitors():
+    # from the snapshot of the monitor topology, not enumerated every time
+    topology = sharedTopology()
+    if topology is None:                # virtual device and benchmarks
+        return float('inf')
+    return len(topology.snapshot())
+
+def modeNames(config):
+    mode_list = [x for x in config.sections() if "MODE" not in x
+                 and x != DEVICES_SECTION]
+    mode_list.append("DEFAULT")
+    return mode_list
+
+def compileModes(data):
+    # {mode: (ConfigurationData, {orientation: (angle, position) or None})} of
+    # every valid mode of the configuration file of data, for the control
+    # socket (control.py). Orientations of the sensor are mapped by the mode,
+    # the ones of the screen only rotate.
+    config = ConfigParser()
+    config.read(data.filename)
+    modes = {}
+    for mode in modeNames(config):
+        mode_data = copy.copy(data)
+        try:
+            if mode_data._parseMode(config, mode):
+                raise ValueError(mode + " is invalid")
+        except Exception as error:      # missing option...
+            print("Mode " + mode + " not available: " + str(error))
+            continue
+        table = {}
+        for orientation in SENSOR_ORIENTATIONS:
+            request = mode_data.requests[ORIENTATION_INDEX[orientation]]
+            table[orientation] = (None if request is None
+                                  else (request.angle, request.position))
+        for orientation in POSSIBLE_ORIENTATIONS:
+            if orientation != "":
+                table[orientation] = (ORIENTATION_ANGLES[orientation], None)
+        modes[mode] = (mode_data, table)
+    return modes
+
+def startControl(data, backend, config_watcher, address, recorder=None):
+    # RotationControl served on address (control.py), None without address
+    if address is None:
+        return None
+    from control import RotationControl, ControlServer
+    rotation_control = RotationControl(data, compileModes, backend, recorder)
+    config_watcher.subscribe(rotation_control)
+    ControlServer(rotation_control, address).start()
+    print("Control socket listening on " + str(address))
+    return rotation_control
+
+def restoreConfiguration(values):
+    # ConfigurationData of a startup snapshot, the file is not read again
+    data = ConfigurationData.__new__(ConfigurationData)
+    data.__dict__.update(values)
+    data._buildRequests()
+    return data
+
 # https://stackoverflow.com/q/24214643
 # "Python to automatically select serial ports (for Arduino)"
-def findPort():
+def findPort(raw_samples=False, gyro=False):
+
+    import serial.tools.list_ports      # detection of serial ports
 
     # List available ports
     print("Available ports:\n")
@@ -342,37 +666,80 @@ def findPort():
     
     error_count = 0
     while error_count <= ERROR_COUNT_TIMEOUT:
-        for port in arduino_ports:
-            is_connected, ser = attemptConnection(port)
-            if is_connected:
-                return port, ser
+        port, ser = probePorts(arduino_ports, raw_samples, gyro)
+        if port is not None:
+            return port, ser
         time.sleep(SERIAL_CONNECTION_INTERVAL)
         error_count += 1
     raise IOError(ERROR_SERIAL_TIMEOUT)
 
-def attemptConnection(port):
+def probePorts(ports, raw_samples=False, gyro=False):
+    # Attempt a connection on all ports at the same time. The first port that
+    # sends the ready message wins, the other attempts are cancelled.
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    probe = PortProbe()
+    pool = ThreadPoolExecutor(max_workers=min(len(ports), MAX_PARALLEL_PROBES))
+    attempts = [pool.submit(attemptConnection, port, probe, raw_samples,
+                            gyro=gyro)
+                for port in ports]
     try:
+        for attempt in as_completed(attempts):
+            is_connected, ser = attempt.result()
+            if is_connected:
+                return probe.winner
+        return None, None
+    finally:
+        # cancelled attempts close their own port in the background
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def attemptConnection(port, probe=None, raw_samples=False, settle=True,
+                      gyro=False):
+    # settle: wait READY_MESSAGE_INTERVAL after the confirmation, False when
+    # the engine ignores the late ready messages (isStaleReady)
+    # gyro:   ask for the angular rates with the raw samples
+    global link_mode
+    start = time.perf_counter()
+    connection_attempts.inc()
+    ser = None
+    try:
+        if probe is not None and probe.isCancelled():
+            return False, None
         print("Attempting serial connection to " + port + "...")
         ser = connectToPort(port)
-        readyMessage = ser.readline().decode("utf-8")
-        # wait a bit to receive the ready message from Arduino
-        time.sleep(READY_MESSAGE_INTERVAL) 
-        if READY_MESSAGE in readyMessage:
+        if probe is not None and not probe.register(port, ser):
+            ser.close()
+            return False, None
+        readyMessage = readLine(ser)
+        if READY_MESSAGE in readyMessage and (probe is None 
+                                              or probe.claim(port, ser)):
             print("Device found on " + port)
             # Send confirmation message before sending configuration. 
-            ser.write(CONFIRMATION_MESSAGE.encode())
-            ser.write(("\n").encode())
+            link_mode = confirmReady(ser, readyMessage, raw_samples, gyro)
+            # wait a bit for the Arduino to stop sending ready messages
+            if settle:
+                time.sleep(READY_MESSAGE_INTERVAL) 
             ser.reset_input_buffer()
             return True, ser
         else:
-            print(ERROR_SERIAL_WRONG)
+            if probe is None or not probe.isCancelled():
+                print(ERROR_SERIAL_WRONG)
+                connection_failures.inc()
+            ser.close()
             return False, None
     except IOError:
         print("Connection failed on " + port + "\n")
+        connection_failures.inc()
+        if ser is not None:
+            ser.close()
         return False, None
-
+    finally:
+        elapsed = time.perf_counter() - start
+        probe_time.add(elapsed)
+        print("Probe of " + port + " took " 
+              + "{:.1f} ms".format(1000*elapsed))
 
 def getArduinoPorts():
+    import serial.tools.list_ports
     arduino_ports = [
         p.device
         for p in serial.tools.list_ports.comports()
@@ -380,6 +747,14 @@ def getArduinoPorts():
     ]
     return arduino_ports
 
+def getSerialNumber(port):
+    # USB serial number of the device on port, used by the [DEVICES] section
+    import serial.tools.list_ports
+    for p in serial.tools.list_ports.comports():
+        if p.device == port:
+            return p.serial_number
+    return None
+
 def connectToPort(port):
     ser = serial.Serial(port, BAUD_RATE, timeout=1,
                         xonxoff=False, rtscts=False, dsrdtr=False)
@@ -388,172 +763,111 @@ def connectToPort(port):
     print("Connection established on " + port)
     return ser
 
-# https://stackoverflow.com/q/21050671
-# "How to check if device is connected Pyserial"
-def checkConnection(port, config_mode, config_filename, data, 
-                    config_token, receive_token):
-    global ser
-    is_connected = True
-    while True:
-        arduino_ports = getArduinoPorts()
-        if port not in arduino_ports:
-            print("Arduino disconnected from " + port)
-            is_connected = False
-            config_token.isNotSent()
-            receive_token.isNotReceiving()
-        if len(arduino_ports) != 0 and not(is_connected):
-            error_count = 0
-            while error_count <= ERROR_COUNT_TIMEOUT:
-                for port in arduino_ports:
-                    try:
-                        time.sleep(2*SERIAL_CONNECTION_INTERVAL)
-                        print("Attempting serial connection to " + port + "...")
-                        ser = connectToPort(port)
-                        is_connected = True
-                        receive_token.isNotReceiving()
-                        break
-                    except IOError:
-                        print("Connection failed on " + port + "\n")
-                        time.sleep(2*SERIAL_CONNECTION_INTERVAL)
-                        error_count += 1
-                break
-            if error_count == ERROR_COUNT_TIMEOUT:
-                raise IOError(ERROR_SERIAL_TIMEOUT)
-
-        if port in arduino_ports:
-            # Don't read a line if currently receiving rotation commands from
-            # the accelerometer
-            #print(not(receive_token.receiving))
-            if not(receive_token.receiving):
-                try:
-                    ready_message = ser.readline().decode("utf-8")
-                except Exception:
-                    pass
-            else:
-                ready_message = ""
-            if READY_MESSAGE in ready_message:
-                print("Ready message received on " + port)
-                receive_token.isReceiving()
-                try:
-                    ser.write(CONFIRMATION_MESSAGE.encode())
-                    ser.write(("\n").encode())
-                # to avoid an error when Arduino is unplugged and 
-                # ser.read/write is excecuted at the same time:
-                except Exception:
-                    pass
-                # Re-read configuration file. 
-                # Enables changing configuration by unplugging the board
-                data.__init__(config_filename)
-                # wait a bit for the arduino to react to the confirmation
-                # message before sending configuration parameters
-                time.sleep(READY_MESSAGE_INTERVAL)
-                data.sendConfigParameters(ser)
-                config_token.isSent()
-                #receive_token.isNotReceiving()
-            # Sending "Connected" message to Arduino to reset watchdog timer
-            elif config_token.config_sent:
-                ser.reset_output_buffer()
-                try:
-                    ser.write(CONNECTED_MESSAGE.encode())
-                    ser.write(("\n").encode())
-                except serial.SerialTimeoutException: # to avoid timeout
-                    pass
-            # print(ready_message)
-        time.sleep(CHECK_CONNECTION_INTERVAL)
-        
+def orientationRequest(orientation, data):
+    # Display request for an orientation index sent by the Arduino, or None
+    # if nothing has to change in this orientation. Looked up in the table of
+    # the configuration, a reload replaces the whole table at once.
+    request = data.requests[orientation]
+    return None if request is None else request.copy()
 
 ### Main function ##############################################################
 
-def main():
+def main(startup_profile=False, control_address=None, recorder=None):
     global ser
-    data = ConfigurationData(CONFIG_FILENAME)
-    # Initialize serial connection with Arduino board
-    port, ser = data.initSerial()
-    # time.sleep(2)
-    # Create a new thread to check connection with Arduino
-    config_token    = ConfigurationToken()
-    receive_token   = ReceiveDataToken()
-    check_connection = threading.Thread(target=checkConnection, 
-                                        args = (port, data.mode, CONFIG_FILENAME, data, 
-                                        config_token, receive_token))
-    check_connection.setDaemon(True)
-    check_connection.start()
+    profile = startup.StartupProfile(STARTUP_TIME, startup_profile)
+    profile.mark("imports")
+    # Last validated configuration and port, if the file didn't change
+    snapshot = startup.loadSnapshot(CONFIG_FILENAME)
+    if snapshot is not None:
+        data = restoreConfiguration(snapshot["configuration"])
+        profile.mark("snapshot")
+    else:
+        data = ConfigurationData(CONFIG_FILENAME)
+        profile.mark("configuration")
+    backend = createBackend(DISPLAY_BACKEND)
+    profile.mark("display backend")
+    # A configuration restored from the snapshot is validated again by the
+    # first check of the watcher
+    config_watcher = ConfigWatcher(data, verify=snapshot is not None)
+    if data.devices:
+        # The event loop connects and serves every Arduino of [DEVICES]
+        from async_engine import runDevices
+        profile.report()
+        saver = StartupSnapshot(None)
+        saver.save(data)
+        config_watcher.subscribe(saver)
+        rotation_control = startControl(data, backend, config_watcher,
+                                        control_address, recorder)
+        runDevices(data, CONFIG_FILENAME, backend, getArduinoPorts,
+                   connectToPort, orientationRequest, getSerialNumber,
+                   config_watcher=config_watcher,
+                   rotation_control=rotation_control, recorder=recorder)
+        return
+
+    # Initialize serial connection with Arduino board, on the port that
+    # worked last time first
+    is_connected = False
+    if snapshot is not None and snapshot["port"]:
+        port = snapshot["port"]
+        is_connected, ser = attemptConnection(
+            port, raw_samples=data.classification == "host", settle=False,
+            gyro=data.prediction == "gyro")
+        profile.mark("cached port")
+    if not(is_connected):
+        port, ser = data.initSerial()
+        profile.mark("port discovery")
     
     # Send configuration file parameters
-    data.sendConfigParameters(ser)
-    config_token.isSent()
-
-    orientationAngles = {
-        "PORTRAIT_FLIPPED"  : "270"  ,
-        "LANDSCAPE"         : "0"   ,
-        "PORTRAIT"          : "90" ,
-        "LANDSCAPE_FLIPPED" : "180" ,
-        ""                  : ""
-    }
+    data.sendConfigParameters(ser, link_mode)
     ser.reset_input_buffer()
     ser.reset_output_buffer()
-    receive_token.isReceiving()
-    while True:
-        while receive_token.receiving:
-            try:
-                line = ser.readline().decode("utf-8")
-            # Don't throw an error when Arduino is unplugged.
-            # This is handled in the check_connection thread.
-            except Exception:
-                pass
-            if line == "": # ignore empty lines
-                continue
-            # check for the command start indicator at index 0
-            if line.find(COMMAND_START) == 0:
-                orientation = line[1:line.find(COMMAND_END)]
-                print(orientation)
-                if orientation   == "X_POS":
-                    angle = orientationAngles[data.x_pos]
-                    pos_x = data.x_px
-                    pos_y = data.x_py
-                elif orientation == "Y_POS":
-                    angle = orientationAngles[data.y_pos]
-                    pos_x = data.y_px
-                    pos_y = data.y_py
-                elif orientation == "X_NEG":
-                    angle = orientationAngles[data.x_neg]
-                    pos_x = data.x_nx
-                    pos_y = data.x_ny
-                elif orientation == "Y_NEG":
-                    angle = orientationAngles[data.y_neg]
-                    pos_x = data.y_nx
-                    pos_y = data.y_ny
-                elif orientation == "FLAT":
-                    angle = orientationAngles[data.flat]
-                    pos_x = data.fx
-                    pos_y = data.fy
-
-                monitor = data.monitor
-
-                if (angle != ""):
-                    angle = " /rotate " + angle
-                else:
-                    angle = ""
-
-                if (pos_x != "" and pos_y != ""):
-                    position = " /position " + pos_x + " " + pos_y
-                else:
-                    position = ""
-                if (monitor == ""):
-                    monitor = " /device 1"
-                else:
-                    monitor = " /device " + monitor
-                if all(param == "" for param in [angle, pos_x, pos_y]):
-                    continue
-                else:
-                    command = "display64.exe " + monitor + angle + position
-                    # shell = True to prevent apparition of console
-                    call(command, shell=True)
-        time.sleep(CHECK_CONNECTION_INTERVAL)
+    profile.mark("configuration sent")
+    profile.report()
+    saver = StartupSnapshot(port)
+    saver.save(data)
+    config_watcher.subscribe(saver)
+    rotation_control = startControl(data, backend, config_watcher,
+                                    control_address, recorder)
+
+    # The event loop serves the Arduino from now on (async_engine.py)
+    from async_engine import runEngine
+    runEngine(data, CONFIG_FILENAME, port, ser, link_mode, backend,
+              getArduinoPorts, connectToPort, orientationRequest,
+              config_watcher=config_watcher,
+              rotation_control=rotation_control, recorder=recorder)
 
     
 
 ################################################################################
 
 if __name__=="__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics-socket",
+                        help="serve metrics over HTTP on this Unix socket")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over HTTP on this local port")
+    parser.add_argument("--metrics-file",
+                        help="write a JSON metrics snapshot to this file")
+    parser.add_argument("--metrics-interval", type=float,
+                        default=metrics.SNAPSHOT_INTERVAL,
+                        help="seconds between metrics snapshots")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="print the time of every startup phase")
+    parser.add_argument("--control-socket",
+                        help="accept control commands on this Unix socket")
+    parser.add_argument("--control-port", type=int,
+                        help="accept control commands on this local port")
+    parser.add_argument("--record", type=float, metavar="SECONDS",
+                        help="keep the last SECONDS of samples and "
+                        "orientations received (see recorder.py)")
+    parser.add_argument("--record-file",
+                        help="write every record to this file as well")
+    args = parser.parse_args()
+    metrics.startExporters(args.metrics_socket or args.metrics_port,
+                           args.metrics_file, args.metrics_interval)
+    recorder = None
+    if args.record is not None or args.record_file is not None:
+        from recorder import Recorder, RECORD_SECONDS
+        recorder = Recorder(args.record or RECORD_SECONDS, args.record_file)
+    main(args.startup_profile, args.control_socket or args.control_port,
+         recorder)
@@ -0,0 +1,99 @@
+#  Fast startup: last-known-good snapshot and startup profile
+#  startup.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  After every start, the validated configuration values and the port of the
+#  Arduino are saved in SNAPSHOT_FILENAME with a hash of the configuration
+#  file. If the file has not changed, the next start uses them as they are:
+#  the configuration file is not parsed, the monitors and the serial ports are
+#  not enumerated and the cached port is tried first. rotate_screen.py then
+#  validates the configuration in the background.
+#
+#  python rotate_screen.py --startup-profile prints the time of every phase.
+
+### IMPORTS ####################################################################
+
+import os
+import json
+import time
+import hashlib
+
+import metrics
+
+### Global Constants ###########################################################
+
+SNAPSHOT_FILENAME               = "rotate_screen_snapshot.json"
+# Snapshots of another version are ignored
+SNAPSHOT_VERSION                = 2
+# From the first import to the configuration sent to the Arduino, in seconds
+STARTUP_BUDGET                  = 1.0
+
+### Classes ####################################################################
+
+class StartupProfile:
+    # Time of every startup phase. mark() ends the current phase, which
+    # started at the previous mark (or at start, in time.perf_counter()).
+    def __init__(self, start=None, enabled=False):
+        self.start      = start if start is not None else time.perf_counter()
+        self.enabled    = enabled
+        self.phases     = []
+        self._last      = self.start
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        metrics.histogram("startup_phase_seconds", phase=name).add(
+            now - self._last)
+        self._last = now
+
+    def total(self):
+        return self._last - self.start
+
+    def report(self):
+        total = self.total()
+        metrics.histogram("startup_seconds").add(total)
+        if self.enabled:
+            print("Startup profile:")
+            for name, duration in self.phases:
+                print("  {:<24}{:>8.1f} ms".format(name, 1000*duration))
+            print("  {:<24}{:>8.1f} ms".format("total", 1000*total))
+        if total > STARTUP_BUDGET:
+            print("Startup took {:.0f} ms, more than {:.0f} ms".format(
+                1000*total, 1000*STARTUP_BUDGET)
+                + ("" if self.enabled else " (see --startup-profile)"))
+
+### Functions ##################################################################
+
+def contentHash(filename):
+    with open(filename, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def loadSnapshot(config_filename, filename=SNAPSHOT_FILENAME):
+    # Returns {"configuration": values, "port": port or None} if the snapshot
+    # was taken with the same configuration file, None otherwise
+    try:
+        with open(filename) as file:
+            snapshot = json.load(file)
+        if (snapshot.get("version") == SNAPSHOT_VERSION and
+                snapshot.get("hash") == contentHash(config_filename)):
+            return snapshot
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+def saveSnapshot(config_filename, values, port, filename=SNAPSHOT_FILENAME):
+    # values: attributes of a validated ConfigurationData
+    snapshot = {
+        "version"       : SNAPSHOT_VERSION,
+        "hash"          : contentHash(config_filename),
+        "configuration" : values,
+        "port"          : port
+    }
+    # replace the file at once, a crash never leaves half a snapshot
+    temporary = filename + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(snapshot, file, indent=2)
+    os.replace(temporary, filename)
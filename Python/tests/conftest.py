@@ -0,0 +1,15 @@
+#  Test configuration: the modules of rotate_screen are imported from Python/
+#  tests/conftest.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  python -m pytest Python/tests
+
+### IMPORTS ####################################################################
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
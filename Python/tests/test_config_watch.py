@@ -0,0 +1,79 @@
+#  Tests of the hot-reload of the configuration file
+#  tests/test_config_watch.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import os
+import shutil
+
+import pytest
+
+from rotate_screen import (
+    ConfigurationData, CONFIG_FILENAME, restoreConfiguration
+)
+from config_watch import ConfigWatcher
+
+### Fixtures ###################################################################
+
+@pytest.fixture
+def filename(tmp_path):
+    path = tmp_path / CONFIG_FILENAME
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), CONFIG_FILENAME), path)
+    return str(path)
+
+class Subscriber:
+    def __init__(self):
+        self.changes = []
+
+    def put(self, change):
+        self.changes.append(change)
+
+### Tests ######################################################################
+
+def test_same_file_gives_equal_configurations(filename):
+    assert vars(ConfigurationData(filename)) == vars(
+        ConfigurationData(filename))
+
+def test_unchanged_values_are_not_a_reload(filename):
+    watcher = ConfigWatcher(ConfigurationData(filename), verify=True)
+    subscriber = Subscriber()
+    watcher.subscribe(subscriber)
+    reloads = watcher.reloads.value
+    # every section is parsed again, no value differs
+    watcher._read(full=True)
+    assert watcher.reloads.value == reloads
+    assert len(subscriber.changes) == 1
+
+def test_changed_value_is_a_reload(filename):
+    watcher = ConfigWatcher(ConfigurationData(filename))
+    watcher._read()
+    with open(filename) as file:
+        text = file.read()
+    with open(filename, "w") as file:
+        file.write(text.replace("XThreshold = 0.90", "XThreshold = 0.80", 1))
+    reloads = watcher.reloads.value
+    watcher._read()
+    assert watcher.reloads.value == reloads + 1
+    assert watcher.data.x_threshold == 0.80
+
+def test_snapshot_that_does_not_match_is_replaced(filename, capsys):
+    data = ConfigurationData(filename)
+    # values of an older snapshot of the same file
+    values = dict(vars(data), x_threshold=0.5, stale="value")
+    values.pop("requests")
+    restored = restoreConfiguration(values)
+    watcher = ConfigWatcher(restored, verify=True)
+    subscriber = Subscriber()
+    watcher.subscribe(subscriber)
+    watcher._read(full=True)
+    [change] = subscriber.changes
+    assert vars(change.data) == vars(data)
+    # the running configuration takes the values parsed from the file
+    restored.replaceWith(change.data)
+    assert vars(restored) == vars(data)
+    assert "stale, x_threshold" in capsys.readouterr().out
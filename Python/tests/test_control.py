@@ -0,0 +1,92 @@
+#  Tests of the commands and the answers of the control socket
+#  tests/test_control.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import json
+import socket
+import types
+
+import pytest
+
+from control import (
+    RotationControl, ControlServer, ControlError, CONTROL_HOST, sendCommand
+)
+
+### Fixtures ###################################################################
+
+class Backend:
+    # submit() fails with error if it is set
+    def __init__(self):
+        self.submitted  = []
+        self.error      = None
+
+    def submit(self, request):
+        if self.error is not None:
+            raise self.error
+        self.submitted.append(request)
+        return request
+
+def compileModes(data):
+    table = {"X_POS": ("90", None), "Y_POS": ("0", None), "FLAT": None}
+    return {"DEFAULT": (data, table), "DRAWING": (data, dict(table))}
+
+@pytest.fixture
+def control():
+    data = types.SimpleNamespace(mode="DEFAULT", devices={}, monitor="2")
+    return RotationControl(data, compileModes, Backend())
+
+@pytest.fixture
+def port(control):
+    server = ControlServer(control, 0).start()
+    yield server.server.server_address[1]
+    server.close()
+
+### Tests ######################################################################
+
+def test_rotate(control):
+    answer = control.execute("rotate x_pos")
+    assert answer["mode"] == "DEFAULT"
+    [request] = control.backend.submitted
+    assert (request.monitor, request.angle) == ("2", "90")
+
+def test_wrong_number_of_arguments(control):
+    for line in ("rotate", "pause now", "rotate X_POS 2 3", "mode"):
+        with pytest.raises(ControlError, match="Wrong number of arguments"):
+            control.execute(line)
+
+def test_type_error_of_a_command_is_not_an_argument_error(control):
+    control.backend.error = TypeError("unsupported operand")
+    with pytest.raises(TypeError, match="unsupported operand"):
+        control.execute("rotate X_POS")
+
+def test_invalid_values(control):
+    with pytest.raises(ControlError):
+        control.execute("rotate SIDEWAYS")
+    with pytest.raises(ControlError):
+        control.execute("rotate X_POS 7")
+    with pytest.raises(ControlError):
+        control.execute("mode GAMING")
+    with pytest.raises(ControlError):
+        control.execute("shutdown")
+
+def test_answers(port):
+    assert sendCommand(port, "pause")["paused"] is True
+    answer = sendCommand(port, "rotate")
+    assert answer == {"ok": False,
+                      "error": "Wrong number of arguments for rotate"}
+
+def test_internal_error_is_answered(control, port):
+    control.backend.error = KeyError("3")
+    with socket.create_connection((CONTROL_HOST, port), 5) as client, \
+            client.makefile("rwb") as stream:
+        stream.write(b"rotate X_POS\nstatus\n")
+        stream.flush()
+        answer = json.loads(stream.readline())
+        assert answer["ok"] is False and "KeyError" in answer["error"]
+        # the connection still answers
+        assert json.loads(stream.readline())["ok"] is True
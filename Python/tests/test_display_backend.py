@@ -0,0 +1,59 @@
+#  Tests of the display64 backend with stand-ins for display64.exe
+#  tests/test_display_backend.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import shutil
+
+import pytest
+
+import display_backend
+from layout import MonitorGeometry
+from display_backend import DisplayRequest, Display64Backend
+from monitor_topology import FakeMonitorTopology
+
+pytestmark = pytest.mark.skipif(shutil.which("true") is None
+                                or shutil.which("false") is None,
+                                reason="true and false stand for display64")
+
+### Fixtures ###################################################################
+
+@pytest.fixture
+def backend():
+    topology = FakeMonitorTopology({
+        "1": MonitorGeometry("1", "0", 0, 0, 1920, 1080),
+        "2": MonitorGeometry("2", "0", 1920, 0, 1920, 1080)
+    })
+    backend = Display64Backend(topology)
+    yield backend
+    backend.close()
+
+### Tests ######################################################################
+
+def test_successful_rotation_is_applied(backend, monkeypatch):
+    monkeypatch.setattr(display_backend, "DISPLAY64_EXECUTABLE", "true")
+    request = backend.apply(DisplayRequest("2", "90"))
+    assert request.error is None and not request.skipped
+    # the same rotation again starts no process
+    assert backend.apply(DisplayRequest("2", "90")).skipped
+
+def test_failed_rotation_raises(backend, monkeypatch):
+    monkeypatch.setattr(display_backend, "DISPLAY64_EXECUTABLE", "false")
+    errors = backend.errors.value
+    request = backend.apply(DisplayRequest("2", "90"))
+    assert isinstance(request.error, IOError)
+    assert backend.errors.value == errors + 1
+    # not counted as applied: the next request tries again
+    monkeypatch.setattr(display_backend, "DISPLAY64_EXECUTABLE", "true")
+    request = backend.apply(DisplayRequest("2", "90"))
+    assert request.error is None and not request.skipped
+
+def test_missing_executable_fails(backend, monkeypatch):
+    monkeypatch.setattr(display_backend, "DISPLAY64_EXECUTABLE",
+                        "display64-missing.exe")
+    request = backend.apply(DisplayRequest("1", "180"))
+    assert isinstance(request.error, OSError)
@@ -0,0 +1,122 @@
+#  Tests of the layout planner and the stage/commit/rollback path of the
+#  display backends
+#  tests/test_layout.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import pytest
+
+from layout import MonitorGeometry, LayoutError, planLayout
+from display_backend import DisplayRequest, FakeDisplayBackend
+from monitor_topology import FakeMonitorTopology
+
+### Fixtures ###################################################################
+
+def desktop():
+    # 1 2 3 side by side, 4 below 2
+    return {
+        "1": MonitorGeometry("1", "0", 0, 0, 1920, 1080),
+        "2": MonitorGeometry("2", "0", 1920, 0, 1920, 1080),
+        "3": MonitorGeometry("3", "0", 3840, 0, 1920, 1080),
+        "4": MonitorGeometry("4", "0", 1920, 1080, 1920, 1080)
+    }
+
+@pytest.fixture
+def backend():
+    monitors = desktop()
+    backend = FakeDisplayBackend(monitors=monitors,
+                                 topology=FakeMonitorTopology(monitors))
+    yield backend
+    backend.close()
+
+def geometry(backend, monitor):
+    return backend.monitors[monitor].key()
+
+### Tests ######################################################################
+
+def test_rotation_of_a_secondary_monitor(backend):
+    request = backend.apply(DisplayRequest("2", "90"))
+    assert request.error is None and not request.skipped
+    assert geometry(backend, "2") == ("90", 1920, 0, 1080, 1920)
+    assert geometry(backend, "1") == ("0", 0, 0, 1920, 1080)
+
+def test_neighbours_follow_the_right_and_bottom_edges(backend):
+    backend.apply(DisplayRequest("2", "90"))
+    # 3 touched the right edge of 2, 4 its bottom edge
+    assert geometry(backend, "3") == ("0", 3000, 0, 1920, 1080)
+    assert geometry(backend, "4") == ("0", 1920, 1920, 1920, 1080)
+    # one transaction for every monitor that changed
+    assert backend.transactions == [["2", "3", "4"]]
+
+def test_neighbours_follow_transitively():
+    current = {
+        "1": MonitorGeometry("1", "0", 0, 0, 1920, 1080),
+        "2": MonitorGeometry("2", "0", 1920, 0, 1920, 1080),
+        "3": MonitorGeometry("3", "0", 3840, 0, 1920, 1080)
+    }
+    target, changed = planLayout(current, DisplayRequest("1", "270"))
+    assert changed == ["1", "2", "3"]
+    assert (target["2"].x, target["3"].x) == (1080, 3000)
+
+def test_rotation_back_restores_the_layout(backend):
+    backend.apply(DisplayRequest("2", "90"))
+    backend.apply(DisplayRequest("2", "0"))
+    assert {monitor: geometry.key()
+            for monitor, geometry in backend.monitors.items()} == {
+        monitor: geometry.key() for monitor, geometry in desktop().items()}
+
+def test_overlapping_layout_is_refused(backend):
+    request = backend.apply(DisplayRequest("2", position=(100, 0)))
+    assert isinstance(request.error, LayoutError)
+    assert backend.transactions == []
+    assert geometry(backend, "2") == ("0", 1920, 0, 1920, 1080)
+
+def test_overlap_check():
+    current = desktop()
+    with pytest.raises(LayoutError):
+        planLayout(current, DisplayRequest("4", position=(0, 500)))
+    # touching edges don't overlap
+    target, changed = planLayout(current,
+                                 DisplayRequest("4", position=(0, 1080)))
+    assert changed == ["4"]
+
+def test_unknown_monitor_is_refused(backend):
+    request = backend.apply(DisplayRequest("5", "90"))
+    assert isinstance(request.error, LayoutError)
+    assert backend.transactions == []
+
+def test_no_op_change_is_skipped(backend):
+    request = backend.apply(DisplayRequest("2", "0", (1920, 0)))
+    assert request.skipped and request.error is None
+    assert backend.transactions == []
+    backend.apply(DisplayRequest("2", "90"))
+    request = backend.apply(DisplayRequest("2", "90"))
+    assert request.skipped
+    assert len(backend.transactions) == 1
+
+def test_staged_request_is_committed(backend):
+    backend.stage(DisplayRequest("2", "90")).wait()
+    assert backend.staged == [["2", "3", "4"]]
+    assert geometry(backend, "2") == ("0", 1920, 0, 1920, 1080)
+    commits = backend.commits.value
+    backend.apply(DisplayRequest("2", "90"))
+    assert backend.commits.value == commits + 1
+    assert geometry(backend, "2") == ("90", 1920, 0, 1080, 1920)
+    assert backend.discarded == []
+
+def test_staged_request_is_rolled_back(backend):
+    backend.stage(DisplayRequest("2", "90")).wait()
+    backend.unstage().wait()
+    assert backend.discarded == [["2", "3", "4"]]
+    assert backend.transactions == []
+    assert geometry(backend, "2") == ("0", 1920, 0, 1920, 1080)
+
+def test_other_request_discards_the_staged_one(backend):
+    backend.stage(DisplayRequest("2", "90")).wait()
+    backend.apply(DisplayRequest("2", "180"))
+    assert backend.discarded == [["2", "3", "4"]]
+    assert geometry(backend, "2") == ("180", 1920, 0, 1920, 1080)
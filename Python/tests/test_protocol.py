@@ -0,0 +1,177 @@
+#  Tests of the serial stream parser and of the binary framing
+#  tests/test_protocol.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+from framing import (
+    FRAME_SYNC, FRAME_ORIENTATION, FRAME_SAMPLE, FRAME_MOTION,
+    FRAME_MAX_PAYLOAD, FRAME_HEADER, ORIENTATION_INDEX, SAMPLE_PAYLOAD,
+    MOTION_PAYLOAD, encodeFrame, decodeFrame
+)
+from protocol import (
+    LineSplitter, COMMAND_LINES, isCommand, commandName, readLine
+)
+
+### Functions ##################################################################
+
+def lines(splitter, *chunks):
+    # lines of every chunk, fed at time 0, 1, 2...
+    result = []
+    for now, chunk in enumerate(chunks):
+        result += splitter.feed(chunk, now)
+    return result
+
+def orientationFrame(name, seq=0):
+    return encodeFrame(FRAME_ORIENTATION, bytes([ORIENTATION_INDEX[name]]),
+                       seq)
+
+### Text lines #################################################################
+
+def test_commands_are_orientation_indices():
+    splitter = LineSplitter()
+    for index, line in enumerate(COMMAND_LINES):
+        for end in (b"\n", b"\r\n", b"  \r\n"):
+            [(command, _)] = splitter.feed(line.encode() + end, 0)
+            assert isCommand(command) and command == index
+            assert commandName(command) == line[1:-1]
+
+def test_line_split_across_reads():
+    splitter = LineSplitter()
+    assert lines(splitter, b"<X_", b"PO", b"S>\r") == []
+    # arrival is the read of the first byte of the line
+    assert lines(splitter, b"\n") == [(ORIENTATION_INDEX["X_POS"], 0)]
+
+def test_concatenated_commands_in_one_read():
+    splitter = LineSplitter()
+    assert lines(splitter, b"<FLAT>\r\n<Y_NEG>\r\n<X_") == [
+        (ORIENTATION_INDEX["FLAT"], 0), (ORIENTATION_INDEX["Y_NEG"], 0)]
+    assert lines(splitter, b"NEG>\n") == [(ORIENTATION_INDEX["X_NEG"], 0)]
+
+def test_tokens_without_line_ending_are_not_commands():
+    splitter = LineSplitter()
+    [(line, _)] = lines(splitter, b"<X_POS><FLAT>\n")
+    assert not isCommand(line) and line == "<X_POS><FLAT>"
+
+def test_unknown_commands_are_text():
+    splitter = LineSplitter()
+    result = lines(splitter, b"<UPSIDE_DOWN>\r\n<x_pos>\n\n<FLAT\n")
+    assert [line for line, _ in result] == ["<UPSIDE_DOWN>", "<x_pos>",
+                                            "<FLAT"]
+    assert not any(isCommand(line) for line, _ in result)
+
+def test_text_samples_are_collected():
+    splitter = LineSplitter()
+    assert lines(splitter, b"0.50\t-0.25\t1.00\r\n",
+                 b"0.1\t0.2\t0.3\t10\t20\t30\n") == []
+    samples, arrival = splitter.takeSamples()
+    assert arrival == 0
+    assert list(SAMPLE_PAYLOAD.iter_unpack(samples)) == [
+        (0.5, -0.25, 1.0), SAMPLE_PAYLOAD.unpack(
+            SAMPLE_PAYLOAD.pack(0.1, 0.2, 0.3))]
+    assert splitter.takeRates() == SAMPLE_PAYLOAD.pack(10, 20, 30)
+    assert splitter.takeSamples() == (b"", None)
+
+### Binary frames ##############################################################
+
+def test_frame_round_trip():
+    frame, size = decodeFrame(orientationFrame("Y_POS", 7))
+    assert size == len(orientationFrame("Y_POS"))
+    assert (frame.type, frame.seq, frame.payload) == (
+        FRAME_ORIENTATION, 7, bytes([ORIENTATION_INDEX["Y_POS"]]))
+
+def test_incomplete_frame_waits():
+    data = orientationFrame("FLAT")
+    for end in range(1, len(data)):
+        assert decodeFrame(data[:end]) == (None, 0)
+    splitter = LineSplitter()
+    assert lines(splitter, data[:3], data[3:]) == [
+        (ORIENTATION_INDEX["FLAT"], 0)]
+
+def test_bad_crc_is_dropped():
+    data = bytearray(orientationFrame("X_NEG"))
+    data[-1] ^= 0xFF
+    assert decodeFrame(data) == (None, 1)
+    splitter = LineSplitter()
+    result = lines(splitter, bytes(data) + orientationFrame("Y_NEG", 1))
+    assert splitter.crc_errors == 1
+    assert [line for line, _ in result if isCommand(line)] == [
+        ORIENTATION_INDEX["Y_NEG"]]
+
+def test_wrong_length_is_dropped():
+    # length field changed: the CRC doesn't match any more
+    data = bytearray(orientationFrame("X_NEG"))
+    data[4] = 0
+    assert decodeFrame(data + b"\x00" * 8) == (None, 1)
+    # longer than any payload: dropped without waiting for it
+    header = FRAME_HEADER.pack(FRAME_SYNC, 1, FRAME_ORIENTATION, 0,
+                               FRAME_MAX_PAYLOAD + 1)
+    assert decodeFrame(header) == (None, 1)
+    # valid frame whose payload doesn't have the size of its type
+    splitter = LineSplitter()
+    assert lines(splitter, encodeFrame(FRAME_ORIENTATION, b"\x00\x01"),
+                 encodeFrame(FRAME_SAMPLE, b"\x00" * 4),
+                 encodeFrame(FRAME_ORIENTATION, b"\x09")) == []
+    assert splitter.takeSamples() == (b"", None)
+
+def test_resync_after_garbage():
+    splitter = LineSplitter()
+    data = (b"\x00\x13garbage" + bytes([FRAME_SYNC]) + b"\x07"
+            + orientationFrame("X_POS", 0) + orientationFrame("FLAT", 1))
+    result = lines(splitter, data)
+    assert [line for line, _ in result if isCommand(line)] == [
+        ORIENTATION_INDEX["X_POS"], ORIENTATION_INDEX["FLAT"]]
+    assert splitter.lost_frames == 0
+
+def test_resync_across_reads():
+    splitter = LineSplitter()
+    data = b"noise" + orientationFrame("Y_POS")
+    result = lines(splitter, *[data[i:i+2] for i in range(0, len(data), 2)])
+    assert [line for line, _ in result if isCommand(line)] == [
+        ORIENTATION_INDEX["Y_POS"]]
+
+def test_lost_frames_are_counted():
+    splitter = LineSplitter()
+    lines(splitter, orientationFrame("X_POS", 254),
+          orientationFrame("X_NEG", 2))
+    assert splitter.lost_frames == 3
+
+def test_sample_and_motion_frames():
+    splitter = LineSplitter()
+    lines(splitter, encodeFrame(FRAME_SAMPLE, SAMPLE_PAYLOAD.pack(1, 0, 0)),
+          encodeFrame(FRAME_MOTION, MOTION_PAYLOAD.pack(0, 1, 0, 90, 0, 0)))
+    samples, arrival = splitter.takeSamples()
+    assert samples == (SAMPLE_PAYLOAD.pack(1, 0, 0)
+                       + SAMPLE_PAYLOAD.pack(0, 1, 0))
+    assert arrival == 0
+    assert splitter.takeRates() == SAMPLE_PAYLOAD.pack(90, 0, 0)
+
+def test_text_and_frames_share_the_stream():
+    splitter = LineSplitter()
+    result = lines(splitter, b"Ready BIN1\r\n" + orientationFrame("FLAT")
+                   + b"<X_POS>\r\n")
+    assert [line for line, _ in result] == [
+        "Ready BIN1", ORIENTATION_INDEX["FLAT"], ORIENTATION_INDEX["X_POS"]]
+
+### readLine ###################################################################
+
+class FakeSerial:
+    def __init__(self, data):
+        self.data       = data
+        self.timeout    = 0.1
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data), 3)
+
+    def read(self, size):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+def test_read_line_returns_command_lines():
+    assert readLine(FakeSerial(orientationFrame("Y_NEG"))) == "<Y_NEG>"
+    assert readLine(FakeSerial(b"Ready BIN1 RAW\r\n")) == "Ready BIN1 RAW"
+    assert readLine(FakeSerial(b"<FLA")) == ""
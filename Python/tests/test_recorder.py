@@ -0,0 +1,83 @@
+#  Tests of the recorder of the serial streams
+#  tests/test_recorder.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+### IMPORTS ####################################################################
+
+import time
+import itertools
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from framing import FRAME_SAMPLE, SAMPLE_PAYLOAD, encodeFrame
+from recorder import (
+    Recorder, RECORD_RAW, loadRecording, recordDtype, recordedReads,
+    recordedSamples, replayReads
+)
+
+### Functions ##################################################################
+
+def sampleFrame(seq, x=0.0, y=0.0, z=1.0):
+    return encodeFrame(FRAME_SAMPLE, SAMPLE_PAYLOAD.pack(x, y, z), seq)
+
+def corrupted(frame):
+    # frame with a wrong payload byte, its CRC no longer matches
+    return frame[:6] + bytes([frame[6] ^ 0xFF]) + frame[7:]
+
+def record(recorder, chunks, device=0):
+    # records chunks as separate serial reads
+    for chunk in chunks:
+        recorder.recordRaw(chunk, device)
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # a distinct time for every read, the reads are told apart by their time
+    times = itertools.count(1000)
+    monkeypatch.setattr(time, "monotonic_ns", lambda: next(times))
+
+### Tests ######################################################################
+
+def test_reads_are_recorded_as_received(tmp_path):
+    chunks = [sampleFrame(0) + sampleFrame(1)[:5], sampleFrame(1)[5:],
+              b"", b"x" * 12, b"Ready\r\n"]
+    recorder = Recorder(seconds=1)
+    record(recorder, chunks)
+    recorder.recordSamples(SAMPLE_PAYLOAD.pack(1, 2, 3))
+    filename = str(tmp_path / "recording.rec")
+    recorder.dump(filename)
+    records = loadRecording(filename)
+    reads = recordedReads(records)
+    assert [chunk for time_ns, chunk in reads] == [chunk for chunk in chunks
+                                                   if chunk]
+    # decoded records are unchanged
+    assert recordedSamples(records).tolist() == [[1, 2, 3]]
+    assert recordedReads(records, device=1) == []
+
+def test_replay_shows_frame_errors():
+    recorder = Recorder(seconds=1)
+    record(recorder, [sampleFrame(0), corrupted(sampleFrame(1)),
+                      b"\x00\x01garbage", sampleFrame(2), sampleFrame(5)])
+    record(recorder, [sampleFrame(0)], device=2)
+    records = np.frombuffer(bytes(recorder._buffer),
+                            dtype=recordDtype())
+    records = records[:recorder._written]
+    assert (records["kind"] == RECORD_RAW).all()
+    # frame 1 failed its CRC, frames 1, 3 and 4 are missing
+    assert replayReads(recordedReads(records)) == (1, 3)
+    assert replayReads(recordedReads(records, device=2)) == (0, 0)
+
+def test_ring_keeps_the_last_bytes():
+    recorder = Recorder(seconds=0.002)      # 4 records
+    chunk = bytes(range(60))
+    recorder.recordRaw(chunk)
+    records = np.frombuffer(recorder._copy(recorder._written
+                                           - recorder.capacity,
+                                           recorder._written),
+                            dtype=recordDtype())
+    [(time_ns, kept)] = recordedReads(records)
+    assert kept == chunk[12:]
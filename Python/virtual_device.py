@@ -0,0 +1,431 @@
+#  Virtual Arduino: emulates the firmware protocol over a pseudo terminal
+#  virtual_device.py
+
+#  Author:           Nguyen Vincent
+#  Created:          Feb, 03, 2021
+#  Updated:          Feb, 06, 2021
+
+#  Emulates Arduino/src/main.cpp and Orientation.cpp on POSIX systems:
+#  - "Reset", then "Ready BIN1 RAW GYRO" every READY_MESSAGE_INTERVAL until a
+#    confirmation message is received (text or binary link, raw samples,
+#    angular rates)
+#  - configuration parameters (text numbers or binary frame), and new ones
+#    while running ("Config ..." line or binary frame)
+#  - watchdog: reset if no "Connected" message for WATCHDOG_INTERVAL
+#  - orientations (<CMD> or frames) set by the caller, or raw samples every
+#    sampling rate in raw mode
+#  - with detection, the rolling stable-sample window of IMUData::detect on a
+#    sample every sampling rate, so orientations are reported within
+#    reportLatencyBound() of the change, like the firmware loop
+#  - physical turns of the sensor (turn()): the raw samples and angular rates
+#    follow the movement, orientations are sent at the end of it
+#  The script side opens device.port like a real serial port.
+
+### IMPORTS ####################################################################
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+
+from framing import (
+    FRAME_SYNC, FRAME_ORIENTATION, FRAME_CONFIG, FRAME_HEARTBEAT,
+    FRAME_SAMPLE, FRAME_MOTION, CONFIG_PAYLOAD, SAMPLE_PAYLOAD, MOTION_PAYLOAD,
+    ORIENTATION_NAMES, BINARY_TOKEN, decodeFrame, encodeFrame
+)
+from protocol import (
+    READY_MESSAGE, CONFIRMATION_MESSAGE, CONNECTED_MESSAGE, CONFIG_MESSAGE,
+    RAW_TOKEN, GYRO_TOKEN, COMMAND_START, COMMAND_END
+)
+
+### Global Constants ###########################################################
+
+# Same values as Orientation.h, intervals in seconds
+RESET_MESSAGE                   = "Reset"
+WATCHDOG_INTERVAL               = 5
+READY_MESSAGE_INTERVAL          = 0.3
+# Serial.parseFloat() gives up on the last configuration value after this
+PARSE_TIMEOUT                   = 0.05
+
+# Default configuration values
+SAMPLING_RATE_MS                = 20
+NUMBER_STABLE_SAMPLES           = 10
+
+# Duration of turn() in seconds
+TURN_DURATION                   = 0.8
+
+# Gravity vector of every orientation (raw samples)
+ORIENTATION_ACCELERATIONS = {
+    "X_POS" : ( 1.0,  0.0,  0.0),
+    "X_NEG" : (-1.0,  0.0,  0.0),
+    "Y_POS" : ( 0.0,  1.0,  0.0),
+    "Y_NEG" : ( 0.0, -1.0,  0.0),
+    "FLAT"  : ( 0.0,  0.0,  1.0)
+}
+
+# Firmware states
+STATE_READY                     = "ready"       # waiting for confirmation
+STATE_CONFIG                    = "config"      # waiting for configuration
+STATE_RUNNING                   = "running"
+STATE_UNPLUGGED                 = "unplugged"
+
+### Classes ####################################################################
+
+class VirtualArduino:
+    # binary / raw_samples / gyro: what the firmware advertises in its ready
+    # message
+    # serial_number: USB serial number reported for the port
+    # detection: emulate the stable-sample window in orientation mode,
+    #            instead of reporting the orientations set at once
+    def __init__(self, binary=True, raw_samples=True,
+                 watchdog_interval=WATCHDOG_INTERVAL, serial_number=None,
+                 gyro=False, detection=False):
+        self.serial_number      = serial_number
+        self.advertise_binary   = binary
+        self.advertise_raw      = raw_samples
+        self.advertise_gyro     = gyro
+        self.detection          = detection
+        self.watchdog_interval  = watchdog_interval
+        self.port               = None
+        self.binary             = False
+        self.raw_samples        = False
+        self.gyro               = False
+        self.sampling_rate_ms   = SAMPLING_RATE_MS
+        self.number_stable_samples = NUMBER_STABLE_SAMPLES
+        self.thresholds         = (0.90, 0.90, 0.75)
+        self.orientation        = "FLAT"
+        self.acceleration       = ORIENTATION_ACCELERATIONS["FLAT"]
+        self.rate               = (0.0, 0.0, 0.0)
+        # IMUData::detect state: reported orientation, candidate and its
+        # stable samples
+        self._detected          = None
+        self._candidate         = None
+        self._stable            = 0
+        # (start time, start acceleration, axis, angle, duration, orientation)
+        # of the turn in progress
+        self._turn              = None
+        # (time.perf_counter(), orientation) of every orientation sent
+        self.sent               = []
+        self.resets             = 0
+        self.heartbeats         = 0
+        self.configured         = threading.Event()
+        self.configured_time    = None
+        self.state              = STATE_UNPLUGGED
+        self._master            = None
+        self._slave             = None
+        self._buffer            = bytearray()
+        self._lock              = threading.RLock()
+        self._thread            = None
+
+    ### Cable ##################################################################
+
+    def plug(self):
+        # Creates a new pseudo terminal (like a new COM port) and boots
+        with self._lock:
+            self._master, self._slave = pty.openpty()
+            tty.setraw(self._slave)
+            # a full buffer (nobody reading) must not block the firmware
+            os.set_blocking(self._master, False)
+            self.port = os.ttyname(self._slave)
+            self._reset()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def unplug(self):
+        with self._lock:
+            self.state = STATE_UNPLUGGED
+            self.configured.clear()
+            for fd in (self._master, self._slave):
+                try:
+                    os.close(fd)
+                except (OSError, TypeError):
+                    pass
+            self._master = self._slave = None
+        if self._thread is not None:
+            self._thread.join()
+
+    def isPlugged(self):
+        return self.state != STATE_UNPLUGGED
+
+    ### Sensor #################################################################
+
+    def setOrientation(self, orientation):
+        # Physical orientation. In orientation mode the firmware reports it
+        # right away (unless detection is emulated), in raw mode or with
+        # detection the samples change and the time of the change is
+        # recorded in sent.
+        with self._lock:
+            self._turn = None
+            self.orientation = orientation
+            self.acceleration = ORIENTATION_ACCELERATIONS[orientation]
+            self.rate = (0.0, 0.0, 0.0)
+            if self.state == STATE_RUNNING and not(self._sampled()):
+                self._sendOrientation(orientation)
+            elif self.state == STATE_RUNNING:
+                self.sent.append((time.perf_counter(), orientation))
+
+    def turn(self, orientation, duration=TURN_DURATION):
+        # Physical rotation to orientation (see prediction.motionAt). The
+        # start of the movement is recorded in sent in raw mode, orientation
+        # mode reports the orientation at the end.
+        from prediction import turnAxis
+        with self._lock:
+            target = ORIENTATION_ACCELERATIONS[orientation]
+            axis, angle = turnAxis(self.acceleration, target)
+            self._turn = (time.monotonic(), self.acceleration, axis, angle,
+                          duration, orientation)
+            if self.state == STATE_RUNNING and self._sampled():
+                self.sent.append((time.perf_counter(), orientation))
+
+    def _move(self, now):
+        # position of the turn in progress at time.monotonic() now
+        from prediction import motionAt
+        start, acceleration, axis, angle, duration, orientation = self._turn
+        if now - start >= duration:
+            self._turn = None
+            self.orientation = orientation
+            self.acceleration = ORIENTATION_ACCELERATIONS[orientation]
+            self.rate = (0.0, 0.0, 0.0)
+            if self.state == STATE_RUNNING and not(self._sampled()):
+                self._sendOrientation(orientation)
+            return
+        self.acceleration, self.rate = motionAt(acceleration, axis, angle,
+                                                duration, now - start)
+
+    def _sampled(self):
+        # True if the acceleration is read every sampling rate
+        return self.raw_samples or self.detection
+
+    def _sendOrientation(self, orientation, record=True):
+        if self.binary:
+            self._write(encodeFrame(FRAME_ORIENTATION, bytes(
+                [ORIENTATION_NAMES.index(orientation)])))
+        else:
+            self._write((COMMAND_START + orientation + COMMAND_END
+                         + "\r\n").encode())
+        if record:
+            self.sent.append((time.perf_counter(), orientation))
+
+    def _detect(self):
+        # IMUData::detect() on the current acceleration
+        new = firmwareOrientation(self.acceleration, self.thresholds,
+                                  self._detected)
+        if new != self._candidate:
+            self._candidate, self._stable = new, 0
+        elif self._stable < self.number_stable_samples:
+            self._stable += 1
+        if (self._candidate != self._detected
+                and self._stable >= self.number_stable_samples):
+            self._detected = self._candidate
+            self._sendOrientation(self._detected, record=False)
+
+    def _sendSample(self):
+        values = tuple(self.acceleration)
+        if self.gyro:
+            values += tuple(self.rate)
+        if self.binary and self.gyro:
+            self._write(encodeFrame(FRAME_MOTION, MOTION_PAYLOAD.pack(*values)))
+        elif self.binary:
+            self._write(encodeFrame(FRAME_SAMPLE, SAMPLE_PAYLOAD.pack(*values)))
+        else:
+            self._write(("\t".join("{:.2f}".format(value) for value in values)
+                         + "\r\n").encode())
+
+    ### Firmware ###############################################################
+
+    def _reset(self):
+        # setup(): Serial.begin, "Reset", then establishContact()
+        self.resets += 1
+        self.state = STATE_READY
+        self.binary = False
+        self.raw_samples = False
+        self.gyro = False
+        self.configured.clear()
+        self._buffer.clear()
+        self._write((RESET_MESSAGE + "\r\n").encode())
+        self._next_ready = time.monotonic()
+        self._idle_since = time.monotonic()
+
+    def _write(self, data):
+        try:
+            os.write(self._master, data)
+        except (OSError, TypeError):
+            pass
+
+    def _run(self):
+        master = self._master
+        while self.state != STATE_UNPLUGGED:
+            timeout = self._step()
+            try:
+                readable, _, _ = select.select([master], [], [], timeout)
+                chunk = os.read(master, 4096) if readable else b""
+            except OSError:
+                # unplugged, or no process has the port open
+                time.sleep(timeout)
+                continue
+            with self._lock:
+                if self.state != STATE_UNPLUGGED and chunk:
+                    self._buffer += chunk
+                    self._idle_since = time.monotonic()
+                    self._receive()
+
+    def _step(self):
+        # Timed firmware actions, returns the time to wait for input
+        now = time.monotonic()
+        with self._lock:
+            if self.state == STATE_READY:
+                if now >= self._next_ready:
+                    ready = READY_MESSAGE
+                    if self.advertise_binary:
+                        ready += " " + BINARY_TOKEN
+                    if self.advertise_raw:
+                        ready += " " + RAW_TOKEN
+                    if self.advertise_raw and self.advertise_gyro:
+                        ready += " " + GYRO_TOKEN
+                    self._write((ready + "\r\n").encode())
+                    self._next_ready = now + READY_MESSAGE_INTERVAL
+                return max(self._next_ready - now, 0)
+            if self.state == STATE_CONFIG:
+                if not(self.binary):
+                    self._parseTextConfig(now)
+                return PARSE_TIMEOUT
+            if self.state == STATE_RUNNING:
+                if now - self._last_heartbeat >= self.watchdog_interval:
+                    self._reset()
+                    return 0
+                timeout = self._last_heartbeat + self.watchdog_interval - now
+                if self._turn is not None:
+                    self._move(now)
+                    if not(self._sampled()) and self._turn is not None:
+                        timeout = min(timeout, self._turn[0] + self._turn[4]
+                                      - now)
+                if self._sampled():
+                    if now >= self._next_sample:
+                        if self.raw_samples:
+                            self._sendSample()
+                        else:
+                            self._detect()
+                        self._next_sample += self.sampling_rate_ms / 1000
+                    timeout = min(timeout, max(self._next_sample - now, 0))
+                return timeout
+        return PARSE_TIMEOUT
+
+    def _receive(self):
+        if self.state == STATE_READY:
+            while b"\n" in self._buffer:
+                end = self._buffer.index(b"\n")
+                line = self._buffer[:end].decode("utf-8", "ignore").strip()
+                del self._buffer[:end+1]
+                if line.startswith(CONFIRMATION_MESSAGE):
+                    tokens = line.split()
+                    self.binary = BINARY_TOKEN in tokens
+                    self.raw_samples = RAW_TOKEN in tokens
+                    self.gyro = self.raw_samples and GYRO_TOKEN in tokens
+                    self.state = STATE_CONFIG
+                    break
+        if self.state == STATE_CONFIG and self.binary:
+            for frame in self._frames():
+                if frame.type == FRAME_CONFIG \
+                        and len(frame.payload) == CONFIG_PAYLOAD.size:
+                    self._configure(*CONFIG_PAYLOAD.unpack(frame.payload))
+                    break
+        if self.state == STATE_RUNNING:
+            # heartbeats of the engine
+            if self.binary:
+                for frame in self._frames():
+                    if frame.type == FRAME_HEARTBEAT:
+                        self._heartbeat()
+                    elif frame.type == FRAME_CONFIG \
+                            and len(frame.payload) == CONFIG_PAYLOAD.size:
+                        self._configure(*CONFIG_PAYLOAD.unpack(frame.payload))
+            else:
+                while b"\n" in self._buffer:
+                    end = self._buffer.index(b"\n")
+                    line = self._buffer[:end].decode("utf-8", "ignore").strip()
+                    del self._buffer[:end+1]
+                    if line == CONNECTED_MESSAGE:
+                        self._heartbeat()
+                    elif line.startswith(CONFIG_MESSAGE):
+                        self._parseConfigMessage(line)
+
+    def _frames(self):
+        while self._buffer:
+            start = self._buffer.find(FRAME_SYNC)
+            if start < 0:
+                self._buffer.clear()
+                return
+            del self._buffer[:start]
+            frame, size = decodeFrame(self._buffer)
+            if size == 0:
+                return
+            del self._buffer[:size]
+            if frame is not None:
+                yield frame
+
+    def _parseTextConfig(self, now):
+        # getConfigParams(): Serial.parseInt() x2, Serial.parseFloat() x3
+        tokens = self._buffer.split()
+        complete = len(tokens) > 5 or (len(tokens) == 5 and (
+            self._buffer[-1:].isspace()
+            or now - self._idle_since >= PARSE_TIMEOUT))
+        if complete:
+            try:
+                values = (int(tokens[0]), int(tokens[1]), float(tokens[2]),
+                          float(tokens[3]), float(tokens[4]))
+            except ValueError:
+                values = (SAMPLING_RATE_MS, NUMBER_STABLE_SAMPLES) \
+                         + self.thresholds
+            self._buffer.clear()
+            self._configure(*values)
+
+    def _parseConfigMessage(self, line):
+        # parseConfigMessage(): the configuration is kept unless 5 values
+        try:
+            values = [float(value) for value in line.split()[1:6]]
+        except ValueError:
+            return
+        if len(values) == 5:
+            self._configure(int(values[0]), int(values[1]), *values[2:])
+
+    def _configure(self, sampling_rate, number_stable_samples,
+                   x_threshold, y_threshold, z_threshold):
+        first = self.state == STATE_CONFIG
+        self.sampling_rate_ms = sampling_rate
+        self.number_stable_samples = number_stable_samples
+        self.thresholds = (x_threshold, y_threshold, z_threshold)
+        if first:
+            # Watchdog.enable() and first orientation
+            self.state = STATE_RUNNING
+            self._last_heartbeat = time.monotonic()
+            self._next_sample = time.monotonic()
+            self.configured_time = time.perf_counter()
+            self.configured.set()
+            # the first orientation is detected like the next ones
+            self._detected = self._candidate = None
+            self._stable = 0
+            if not(self._sampled()):
+                self._sendOrientation(self.orientation)
+
+    def _heartbeat(self):
+        self.heartbeats += 1
+        self._last_heartbeat = time.monotonic()
+
+### Functions ##################################################################
+
+def firmwareOrientation(acceleration, thresholds, old):
+    # IMUData::getOrientation(): old if no threshold is exceeded
+    for axis, (value, threshold) in enumerate(zip(acceleration, thresholds)):
+        if abs(value) > threshold:
+            if axis == 2:
+                return "FLAT"
+            return ("X_POS", "X_NEG", "Y_POS", "Y_NEG")[2*axis + (value < 0)]
+    return old
+
+def reportLatencyBound(sampling_rate_ms, number_stable_samples):
+    # Longest time in seconds from a change of orientation to its report by
+    # the firmware loop: up to one sampling rate until the first sample, then
+    # number_stable_samples more (see loop() in main.cpp)
+    return (number_stable_samples + 1) * sampling_rate_ms / 1000